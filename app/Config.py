@@ -1,4 +1,5 @@
 #from GoogleMercatorProjection import LatLng
+import os
 import platform
 
 bFullScreen = False # has to be True for R-Pi touchscreen version
@@ -8,7 +9,17 @@ bFullScreen = False # has to be True for R-Pi touchscreen version
 # completed under the RADAR section
 primary_coordinates = -121.95, 36.9764016   # Change to your Lat/Lon
 location = primary_coordinates
-openweatherPrefix = 'https://api.openweathermap.org/data/3.0/'
+# Degrees: locations are snapped to this grid, so nearby kiosks share forecasts and cache entries.
+# 0.01 is about 1 km. 0 keeps them as given, to 4 decimals (about 10 m).
+location_grid = 0.01
+# WX_OPENWEATHER_PREFIX lets the load test (bench/loadtest.py) point the app at a local fake server
+openweatherPrefix = os.environ.get('WX_OPENWEATHER_PREFIX', 'https://api.openweathermap.org/data/3.0/')
+openweatherIconPrefix = 'http://openweathermap.org/img/wn/'
+# Forecast source, see providers.PROVIDERS: 'openweather' or 'nws'
+forecast_provider = 'openweather'
+# Optional second source for hedged requests: asked when forecast_provider is slower than its p95.
+hedge_provider = None   # e.g. 'nws'
+hedge_default_delay = 2.0   # seconds, used until enough latency samples are collected
 #primary_location = LatLng(primary_coordinates[0], primary_coordinates[1])
 
 # Goes with light blue config (like the default one)
@@ -29,7 +40,65 @@ digitalsize = 200
 metric = 1  # 0 = English, 1 = Metric
 radar_refresh = 10      # minutes
 weather_refresh = 30    # minutes
+# minutes, the hourly and daily forecasts are fetched this often. In between, the current conditions are
+# fetched every weather_refresh with a call that leaves the forecasts out. 0 fetches all every weather_refresh.
+forecast_refresh = 60
+fetch_minutely = False  # fetch the minutely nowcast with the current conditions
 home_refresh = 1        # temp and humidity at home
+sensor_stale = 15       # minutes without a reading before a home sensor is shown as not reporting
+# Sensor plot on /now: 'png' drawn by matplotlib or 'svg' drawn by svgplot; a request can pick one with ?plot=svg
+plot_format = os.environ.get('WX_PLOT_FORMAT', 'png')
+dashboard_threads = 4   # threads that render the /dashboard panels
+fragment_cache_size = 1000  # rendered forecast DIVs kept per process, see fragment_cache.py
+parsed_cache_size = 8   # forecasts kept parsed and formatted for display per process, by location and time zone
+# Static export, see static_export.py: pages are rendered to files under export_dir for nginx to serve.
+# Off when export_dir is not set. Each home is one set of page arguments, as the page buttons pass them.
+export_dir = os.environ.get('WX_EXPORT_DIR')
+export_homes = [{'home_name': '', 'lon_lat': None, 'tz': -8, 'radar_type': ''}]
+export_routes = ('now', 'daily', 'hourly_divs', 'hourly_chart.svg')
+export_interval = 30    # seconds between checks for a new forecast or sensor reading
+# written by the MQTT client process, one JSON reading per line
+sensor_log = os.environ.get('WX_SENSOR_LOG', '../sensors/mqtt_rcv.log')
+# Sensor history kept as 5 minute, hourly and daily min/max/mean, see rollups.py
+rollup_path = os.environ.get('WX_ROLLUP_PATH', '../cache/rollups.json')
+rollup_save_interval = 300  # seconds
+rollup_keep = {300: 8*86400, 3600: 400*86400, 86400: 10*365*86400}   # resolution: seconds of history kept
+fetch_timeout = 10      # seconds to wait for an upstream fetch (OpenWeather, NWS)
+use_async_fetch = True  # fetch through the async_fetch event loop instead of blocking urlopen
+stream_json = False     # decode OpenWeather responses with ijson as they arrive, see selective_json.py
+# Circuit breaker around the forecast fetch: after breaker_failures failures in a row, pages are served
+# from the last good forecast for breaker_reset seconds, then one request probes the provider again.
+breaker_failures = 3
+breaker_reset = 60      # seconds
+# OpenWeather call budget, see quota.py. Forecasts are refreshed less often when it runs short.
+api_daily_budget = 1000     # billed calls allowed in any 24 hours
+api_free_calls = 1000       # calls a day that OneCall 3.0 does not bill
+api_call_price = 0.0015     # price of each call beyond those, USD
+quota_target = 0.9          # share of the budget the refresh intervals plan to use, the rest is headroom
+quota_max_refresh = 6*3600  # seconds, the longest a forecast is used when the budget is short
+quota_path = os.environ.get('WX_QUOTA_PATH', '../cache/quota.json')
+quota_save_interval = 300   # seconds
+# Cache of forecasts and plots, see shared_cache.py: 'memory' (this process only), 'file', 'sqlite' or 'redis'.
+# Use 'sqlite' or 'file' when pi_uwsgi.ini has processes > 1, so forecasts and plots are made once per host,
+# and 'redis' to share forecasts between several Pis.
+cache_backend = os.environ.get('WX_CACHE_BACKEND', 'memory')
+cache_path = os.environ.get('WX_CACHE_PATH', '../cache/wx_cache.sqlite')
+cache_dir = os.environ.get('WX_CACHE_DIR', '../cache/files')
+redis_url = os.environ.get('WX_REDIS_URL', 'redis://localhost:6379/0')
+redis_timeout = 0.5     # seconds; Redis is skipped for a while after repeated failures
+cache_codec = 'msgpack'     # or 'json'; msgpack is used only if installed (pip install msgpack)
+cache_keep = 24*3600    # seconds a forecast is kept to serve as the last good one
+
+# Request profiling, see profiling.py. Off unless one of the first two is set.
+profile_requests = False    # profile every request
+profile_secret = None       # profile requests signed with this secret: python profiling.py /now
+profile_dir = '../profiles'
+profile_keep = 20           # number of captures to keep
+# Per module log level, overrides the level in setup_logger, e.g. {'sensor_in': 'INFO', 'timeplot': 'WARNING'}
+log_levels = {}
+# Steps run by warmup.py in the uwsgi master before the workers fork: 'templates', 'tz', 'plot', 'forecast'
+warmup_steps = ('templates', 'tz', 'plot', 'forecast')
+template_auto_reload = True     # check templates for changes on each use; False saves a stat per page
 # Wind in degrees instead of cardinal 0 = cardinal, 1 = degrees
 wind_degrees = True
 # Depreciated: use 'satellite' key in radar section, on a per radar basis
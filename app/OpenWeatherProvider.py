@@ -6,25 +6,43 @@
 
 from urllib.request import urlopen,Request
 from urllib.parse import urlencode
+import collections
+import concurrent.futures
 import json
 import datetime as dt
+import hashlib
 import os
+import platform
+import threading
 
 from flask import url_for
 
 import Config
 import ApiKeys
+import breaker
+import forecast_cache
+from fragment_cache import fragments
 import logging
+import metrics
 import my_logger
+import providers
+import quota
+import rollups
+import selective_json
+import shared_cache
 from jinja2 import Environment, FileSystemLoader, PackageLoader, select_autoescape
-import tail
-import timeplot
 import tzinfo_4us as tzhelp
 
 from Config import get_node_addr
-from sensor_in import read_log, sensor_devs
+import sensor_in
+from sensor_in import read_log
 
 logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+hot_logger = my_logger.sampled(logger)    # for messages repeated in loops over records
+
+forecasts = forecast_cache.ForecastCache()     # fresh and last good forecasts by location
+fetch_breaker = breaker.CircuitBreaker('forecast', failure_threshold=Config.breaker_failures,
+                                       reset_timeout=Config.breaker_reset)
 
 # units for values: temperature, wind
 METRIC=0
@@ -40,6 +58,24 @@ Pacific  = tzhelp.USTimeZone(-8, "Pacific",  "PST", "PDT")
 
 myTZ = {'-5':Eastern, '-6':Central, '-7': Mountain, '-8':Pacific}
 
+CHART_HOURS = 48     # hours of forecast in the hourly chart
+
+def page_args(lon_lat=None, home_name='', tzoff=-8, radar_type=''):
+    '''
+    :return: query string that the page buttons pass on to the next page, e.g. 'home_name=Home&tz=-8'
+    '''
+    # construct the request args if any
+    args = {}
+    if lon_lat:
+        args['lon_lat'] = lon_lat
+    if home_name and len(home_name) > 0:
+        args['home_name'] = home_name
+    if tzoff:
+        args['tz'] = tzoff
+    if radar_type and len(radar_type) > 0:
+        args['radar_type'] = radar_type
+    return urlencode(args)
+
 def make_buttons(exclude=[], lon_lat=None, home_name='', tzoff=-8, radar_type=''):
     '''
     Make page change buttons, but exclude some.
@@ -55,18 +91,8 @@ def make_buttons(exclude=[], lon_lat=None, home_name='', tzoff=-8, radar_type=''
     NAV_BUT['hourly']   = ('Today Fcst', None, 'hourly_divs')   # this is a flask page
     NAV_BUT['daily']    = ('Daily Fcst', None, 'daily')         # this is a flask page
 
-    # construct the request args if any
-    args = {}
-    if lon_lat:
-        args['lon_lat'] = lon_lat
-    if home_name and len(home_name) > 0:
-        args['home_name'] = home_name
-    if tzoff:
-        args['tz'] = tzoff
-    if radar_type and len(radar_type) > 0:
-        args['radar_type'] = radar_type
-    req_args = urlencode(args)
-    logger.debug('make_buttons: req = {}'.format(req_args))
+    req_args = page_args(lon_lat, home_name, tzoff, radar_type)
+    logger.debug('make_buttons: req = %s', req_args)
     for key in exclude:     # some of the buttons should not be present on the page
         NAV_BUT.pop(key)
     for key,item in NAV_BUT.items():
@@ -107,6 +133,17 @@ def metric_to_english(key, value):
     else:
         return value,' '
 
+_shared = {}    # one copy of each repeated string or tuple of strings, used by all parsed records
+_formatted = {} # (app_key, value, units) to the display strings in (METRIC, US), also shared by all records
+FORMATTED_MAX = 50000
+
+def shared(value):
+    '''
+    :param value: str, or tuple of str, that recurs in many records, e.g. a units string or description
+    :return: the one shared copy of value
+    '''
+    return _shared.setdefault(value, value)
+
 class DataParse:
     '''
     Abstract Class.
@@ -116,15 +153,34 @@ class DataParse:
     Each of these items contains different sets of data with different keys.
     Once the data is parsed, the application can then request that the
     data be returned as a string, ready for display.
+    A parsed record is a few tuples in __slots__, laid out by the class's fields, rather than dicts:
+    a forecast has over 50 records and several locations may be cached.
     '''
+    __slots__ = ('values', 'units', 'display')
+    obsKeys = []
+    fields = ()     # app_key of each value, in obsKeys order, set for each child class
+    index = {}      # app_key to position in fields
+    source_keys = frozenset()   # keys of the OneCall record that obsKeys read
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = []
+        for key in cls.obsKeys:
+            if key[1] == 'dt':
+                fields.extend(('day_name', 'hour_name'))    # derived from 'dt', stored before it
+            fields.append(key[0])
+        cls.fields = tuple(fields)
+        cls.index = {name: i for i,name in enumerate(fields)}
+        cls.source_keys = frozenset(key[1][0] if isinstance(key[1], (list,tuple)) else key[1] for key in cls.obsKeys)
+
     def __init__(self,wxdata,dataKeys,tzoff=-8):
-        logger.debug('DataParse: tzoff={}'.format(tzoff))
+        hot_logger.debug('DataParse: tzoff=%s', tzoff)     # once per forecast record
         tzoffStr = str(tzoff)
         if tzoffStr in myTZ:
             tz_local = myTZ[tzoffStr]
         else:
             tz_local = None     # we won't be able to correct times that are returned by OpenWeather
-        self.obs = {}
+        obs = {}
         for key in dataKeys:
             if isinstance(key[1],(list,tuple)):
                 try:
@@ -139,7 +195,7 @@ class DataParse:
                         data_dict = wxdata[kk[0]]
                     data = data_dict[kk[1]]
                 except:
-                    logger.error('key=%s, wxdata=%s' %(str(kk),str(wxdata[kk[0]])))
+                    logger.error('key=%s, wxdata=%s', kk, wxdata[kk[0]])
             else:
                 if key[1] in wxdata:
                     data = wxdata[key[1]]
@@ -159,9 +215,9 @@ class DataParse:
                         data = dt.datetime.fromtimestamp(data,tzobj)
                         if key[1] == 'dt':
                             # 'dt' is time of current obs or future forecast. Get day and hour from it for display use.
-                            self.obs['day_name'] = [data.strftime('%A'),'']
+                            obs['day_name'] = [data.strftime('%A'),'']
                             #logger.debug('store dt={}, day={}'.format(str(data),data.strftime('%A')))
-                            self.obs['hour_name'] = [data.strftime('%I'),' '+data.strftime('%p')]
+                            obs['hour_name'] = [data.strftime('%I'),' '+data.strftime('%p')]
                         elif key[1] in ('sunrise', 'sunset'):
 
                             #logger.debug('sunrise/sunset: {}'.format(str(data)))
@@ -171,18 +227,82 @@ class DataParse:
                     #logger.debug('key=%s, data=%s' %(key[1],str(data)))
                 else:
                     # DarkSky has optional fields, so it's OK if key[1] not found
-                    logger.info('DataParse: key=%s not present in wxdata' %(key[1]))
+                    hot_logger.info('DataParse: key=%s not present in wxdata', key[1])
                     continue
             if key[2] == -1 or key[2] == Config.metric:
                 # TODO: should probably eliminate key[2]: column 3
                 # Config.metric has value of either 0 or 1
-                self.obs[key[0]] = [data,key[3]]
+                obs[key[0]] = [data,key[3]]
                 #logger.debug('save obs: key=%s, value=%s' %(key[0],str(self.obs[key[0]])))
             else:
                 # key[2] != Config.metric, so skip this obs
                 # NOTE: this clause only applied to wunderground, which returned some data
                 # in both metric and US. OpenWeatherMap only returns one or the other - as requested.
                 pass
+        self.store(obs)
+
+    def store(self, obs):
+        '''
+        Keep the parsed values, and format every value for display in both unit systems,
+        so getObsStr and getObsVal are lookups.
+        :param obs: dict of app_key to [value, units]
+        '''
+        absent = [None, None]
+        pairs = [obs.get(name, absent) for name in self.fields]
+        self.values = tuple(shared(v) if isinstance(v, str) else v for v,_ in pairs)
+        self.units = shared(tuple(u for _,u in pairs))
+        metric = []
+        us = []
+        for name,(v,u) in zip(self.fields, pairs):
+            if v is None and u is None:
+                both = (None, None)
+            elif name in dt_keys or isinstance(v, dt.datetime):
+                # times are different in every record, not worth sharing; equal times in other zones print differently
+                both = (self.format_obs(name, v, u, METRIC), self.format_obs(name, v, u, US))
+            else:
+                both = _formatted.get((name, v, u))
+                if both is None:
+                    if len(_formatted) >= FORMATTED_MAX:
+                        _formatted.clear()  # forget values from long ago, rather than grow for weeks
+                    both = _formatted[(name, v, u)] = (self.format_obs(name, v, u, METRIC),
+                                                       self.format_obs(name, v, u, US))
+            metric.append(both[0])
+            us.append(both[1])
+        self.display = (tuple(metric), tuple(us))
+
+    @property
+    def obs(self):
+        '''
+        :return: dict of app_key to [value, units], the values found in the data
+        '''
+        return {name: [v, u] for name,v,u in zip(self.fields, self.values, self.units) if u is not None}
+
+    @staticmethod
+    def format_obs(key, value, unit, units=US):
+        '''
+        Convert and round one value for display.
+        :return: (value string, units string as getObsVal returns it, display string with units as getObsStr returns it)
+        '''
+        unitStr = None
+        if key in dt_keys:
+            # must interpret as str, this is really important when fetching hour_name
+            obsVal = value
+        else:
+            # TODO: the obs tables should have a conversion function
+            try:
+                # attempt numeric conversion
+                obsVal = float(value)
+                if units==US:
+                    obsVal,unitStr = metric_to_english(key,obsVal)
+                if abs(obsVal) >= 10.0:
+                    obsVal = int(obsVal + 0.5)  # get rid of decimal places
+                else:
+                    obsVal = float('%.1f' %(obsVal))
+            except:
+                # could not convert to float, so assume it's a string
+                obsVal = value
+        # getObsStr falls back on the units of the obs table, getObsVal does not
+        return str(obsVal), unitStr or '', str(obsVal) + (unitStr or unit)
 
     def getObsStr(self, key, units=US):
         '''
@@ -191,58 +311,21 @@ class DataParse:
         :param units:
         :return: a string for display
         '''
-        if key in self.obs:
-            # TODO: the obs tables should have a conversion function
-            unitStr = None
-            if key in dt_keys:
-                # must interpret as str, this is really important when fetching hour_name
-                obsVal = self.obs[key][0]
-            else:
-                try:
-                    # attempt numeric conversion
-                    obsVal = float(self.obs[key][0])
-                    if units==US:
-                        obsVal,unitStr = metric_to_english(key,obsVal)
-                    if abs(obsVal) >= 10.0:
-                        obsVal = int(obsVal + 0.5)  # get rid of decimal places
-                    else:
-                        obsVal = float('%.1f' %(obsVal))
-                except:
-                    # could not convert to float, so assume it's a string
-                    obsVal = self.obs[key][0]
-            if not unitStr: # None or empty ''
-                unitStr = self.obs[key][1]
-            retval = str(obsVal) + unitStr
-            return retval
-        else:
-            logger.warning('key=%s not found' %(key))
+        i = self.index.get(key)
+        formatted = None if i is None else self.display[US if units == US else METRIC][i]
+        if formatted is None:
+            logger.warning('key=%s not found', key)
             return None
+        return formatted[2]
 
     def getObsVal(self, key, units=US):
         # Get value from wxdata + the appropriate units string
-        if key in self.obs:
-            unitStr = ''
-            if key in dt_keys:
-                # must interpret as str, this is really important when fetching hour_name
-                obsVal = self.obs[key][0]
-            else:
-                # TODO: the obs tables should have a conversion function
-                try:
-                    obsVal = float(self.obs[key][0])
-                    if units==US:
-                        obsVal,unitStr = metric_to_english(key,obsVal)
-                    if abs(obsVal) >= 10.0:
-                        obsVal = int(obsVal + 0.5)  # get rid of decimal places
-                    else:
-                        obsVal = float('%.1f' % (obsVal))
-                except:
-                    # could not convert to float, so assume it's a string
-                    obsVal = self.obs[key][0]
-            retval = str(obsVal)
-            return retval,unitStr
-        else:
-            logger.warning('key=%s not found' % (key))
+        i = self.index.get(key)
+        formatted = None if i is None else self.display[US if units == US else METRIC][i]
+        if formatted is None:
+            logger.warning('key=%s not found', key)
             return None,''
+        return formatted[0],formatted[1]
 
     @classmethod
     def wind_compass(cls, degrees):
@@ -259,6 +342,7 @@ class DataParse:
 
 
 class CurrentObs(DataParse):
+    __slots__ = ()
     # Lookup table for key used in application display,
     # key used in wxdata returned by wunderground,
     # metric=1 or English=0 units or no_units=-1
@@ -297,10 +381,12 @@ class CurrentObs(DataParse):
     # other keys: precipProbability, precipType, dewPoint, cloudCover, uvIndex, visibility, ozone
     def __init__(self, wxdata, tzoff=-8):
         #print(wxdata['current'])
-        logger.debug('CurrentObs: tzoff={}'.format(tzoff))
-        DataParse.__init__(self,wxdata['current'],self.obsKeys, tzoff)
+        logger.debug('CurrentObs: tzoff=%s', tzoff)
+        with metrics.dataparse.labels('CurrentObs').time():
+            DataParse.__init__(self,wxdata['current'],self.obsKeys, tzoff)
 
 class FcstDailyData(DataParse):
+    __slots__ = ()
     # Lookup table for key used in application display,
     # key used in wxdata returned by wunderground,
     # metric=1 or English=0 units,
@@ -337,9 +423,11 @@ class FcstDailyData(DataParse):
     # other keys: sunriseTime, sunsetTime, moonPhase, precipIntensityMax, precipIntensityMaxTime, more
     def __init__(self,wxdata,iday, tzoff=-8):
         if len(wxdata['daily']) > iday:
-            DataParse.__init__(self,wxdata['daily'][iday],self.obsKeys, tzoff)
+            with metrics.dataparse.labels('FcstDailyData').time():
+                DataParse.__init__(self,wxdata['daily'][iday],self.obsKeys, tzoff)
 
 class FcstHourlyData(DataParse):
+    __slots__ = ()
     # Lookup table for key used in application display,
     # key used in wxdata returned by wunderground,
     # metric=1 or English=0 units,
@@ -365,7 +453,78 @@ class FcstHourlyData(DataParse):
     ]
     # other keys: apparentTemperature, dewPoint, humidity, pressure, windSpeed, windGust, windBearing, cloudCover, uvIndex, visibility, ozone
     def __init__(self,wxdata,ihour, tzoff=-8):
-        DataParse.__init__(self,wxdata['hourly'][ihour],self.obsKeys,tzoff)
+        with metrics.dataparse.labels('FcstHourlyData').time():
+            DataParse.__init__(self,wxdata['hourly'][ihour],self.obsKeys,tzoff)
+
+# the OneCall fields to keep when a response is decoded: what the tables above read, and the forecast chart
+selective_json.register_fields('current', CurrentObs.source_keys)
+selective_json.register_fields('hourly', FcstHourlyData.source_keys | {'dt', 'temp', 'pop', 'wind_speed'})
+selective_json.register_fields('daily', FcstDailyData.source_keys)
+
+class ParsedForecast:
+    '''
+    CurrentObs and every FcstHourlyData and FcstDailyData of one forecast, parsed and formatted
+    for display in one pass when the forecast is first used, then shared by all pages.
+    '''
+    __slots__ = ('current', 'hourly', 'daily')
+
+    def __init__(self, wxdata, tzoff=-8, reuse=None):
+        '''
+        :param reuse: dict of section name to that section already parsed, e.g. the hourly and daily
+        forecasts when only the current obs were fetched again
+        '''
+        reuse = reuse or {}
+        self.current = reuse['current'] if 'current' in reuse else CurrentObs(wxdata, tzoff)
+        self.hourly = reuse['hourly'] if 'hourly' in reuse else [FcstHourlyData(wxdata, i, tzoff) for i in range(len(wxdata['hourly']))]
+        self.daily = reuse['daily'] if 'daily' in reuse else [FcstDailyData(wxdata, i, tzoff) for i in range(len(wxdata['daily']))]
+
+_parsed = collections.OrderedDict()     # (forecast_id, tzoff) to ParsedForecast, oldest first
+_parsed_sections = collections.OrderedDict()    # (section, forecast_id of the section, tzoff) to the parsed section
+_parsed_lock = threading.Lock()
+
+def get_parsed(data, tzoff=-8):
+    '''
+    :param data: ForecastBundle
+    :return: ParsedForecast of data, parsed on first use; None for a plain OneCall dict.
+    Sections that were not fetched again since the last parse are not parsed again.
+    '''
+    if not hasattr(data, 'fetched'):
+        return None
+    key = (forecast_id(data), tzoff)
+    parsed = _parsed.get(key)
+    if parsed is None:
+        section_keys = {section: (section, forecast_id(data, section), tzoff) for section in ParsedForecast.__slots__}
+        reuse = {section: _parsed_sections[k] for section,k in section_keys.items() if k in _parsed_sections}
+        parsed = ParsedForecast(data, tzoff, reuse)
+        with _parsed_lock:
+            _parsed[key] = parsed
+            for section,k in section_keys.items():
+                _parsed_sections[k] = getattr(parsed, section)
+            while len(_parsed) > Config.parsed_cache_size:
+                _parsed.popitem(last=False)
+            while len(_parsed_sections) > 3 * Config.parsed_cache_size:
+                _parsed_sections.popitem(last=False)
+    return parsed
+
+_env = None     # one jinja Environment per process, it caches the compiled templates
+
+def get_template(name):
+    '''
+    :param name: file name in templates/
+    :return: compiled template, compiled on first use and then reused
+    '''
+    global _env
+    if _env is None:
+        path = os.path.join(os.path.dirname(__file__), 'templates')
+        _env = Environment(loader=FileSystemLoader(searchpath=path), auto_reload=Config.template_auto_reload)
+    return _env.get_template(name)
+
+def render(templ, *args, **kwargs):
+    '''
+    templ.render, timed for the /metrics page.
+    '''
+    with metrics.template_render.labels(templ.name).time():
+        return templ.render(*args, **kwargs)
 
 # I think this is only used for testing
 def make_html(obs, hourly, daily, heading='Current'):
@@ -374,99 +533,96 @@ def make_html(obs, hourly, daily, heading='Current'):
     :param obs: object of CurrentObs, FcstDailyData, or FcstHourlyData
     :return:
     '''
-    path = os.path.join(os.path.dirname(__file__), 'templates')
-    loader = FileSystemLoader(searchpath=path)
-    env = Environment(loader=loader)
-    templ = env.get_template('wx_now_all.html')
+    templ = get_template('wx_now_all.html')
     ihour = 12
     iday = 1    # tomorrow
     obs_vals = [[key,obs.getObsStr(key)] for key in obs.obs]
     hourly_vals = [[key,hourly.getObsStr(key)] for key in hourly.obs]
     daily_vals = [[key,daily.getObsStr(key)] for key in daily.obs]
-    return templ.render(heading=heading, obs=obs_vals, hourly=hourly_vals, hour_name='13', daily=daily_vals, daily_name='Someday')
-
-def get_home_sensors(fname, sys_name='gn-pi-zero-1'):
-    '''
-    Read latest lines from sensor logfiles. Search for match with sys_name.
-    Parse the lines which have been written in my custom text format.
-    :param fname: logfile written by process mqtt_rcv.py
-    :param sys_name: computer name for sensors
-    :return: dict that contains sensor names as key to values. Values are strings
-    '''
-    val_dict = {}
-    f = open(fname, 'r')
-    sens_str = tail.tail(f, lines=4)
-    sens_lines = sens_str.split('\n')
-    # lines look like this:
-    # gn_home/gn-pi-zero-1/pm25: time=2021-05-03T14:31:01,PM1.0=2,PM2.5=4,PM10.0=9
-    # gn_home/gn-pi-zero-1/bme280: time=2021-05-03T14:31:06,temp_c=21.2,humidity=44.7,pressure=1008.1
-    for line in sens_lines:
-        l = line.split(':',maxsplit=1)
-        if sys_name and l[0].find(sys_name) == -1:
-            # might have readings from more than one sensor computer
-            # don't yet have a proper way to handle that, so only accept one of them
+    return render(templ, heading=heading, obs=obs_vals, hourly=hourly_vals, hour_name='13', daily=daily_vals, daily_name='Someday')
+
+def get_home_sensors(sys_name=None):
+    '''
+    Newest home sensor values for the "home sensors" box, from the index kept by sensor_in.
+    Where several topics have the same field, the value of the topic that reported last is used.
+    :param sys_name: only use topics of this sensor computer, e.g. 'gn-pi-zero-2', None for all
+    :return: dict of field name to display string, plus 'time' of the newest reading and
+        'stale', the sensors with no reading for Config.sensor_stale minutes
+    '''
+    sensors = {'stale': []}
+    topics = sensor_in.latest.snapshot(stale_after=Config.sensor_stale*60)
+    for topic,entry in reversed(list(topics.items())):  # oldest first, so newer values replace older ones
+        if sys_name and sys_name not in topic:
             continue
-        # l[0] is the sensor topic
-        # l[1] is the values, including time
-        logger.debug('get_home_sensors: sensor={}'.format(l[0]))
-        values_list = l[1].split(',')
-        # stuff the values_list into a dict
-        for value in values_list:
-            logger.debug('get_home_sensors: value={}'.format(value))
-            try:
-                val = value.split('=')
-                sens_key = val[0].strip().lower().replace('.','_') + '_sens'
-                sens_val = val[1]
-                if sens_key == 'time_sens':
-                    dt_obs = dt.datetime.strptime(sens_val, '%Y-%m-%dT%H:%M:%S')
-                    sens_val = dt_obs.strftime('%I:%M %p') # only want HH:MM for display
-                    units = ''
-                else:
-                    sens_val,units = metric_to_english(sens_key, sens_val)
-                    #logger.debug('get_home_sensors: metric_to_english={},{}'.format(sens_val,units))
-                    if l[0].find('bme280') != -1:
-                        # bme280 returns float values
-                        sens_val = '{:.1f}'.format(float(sens_val))
-                    elif l[0].find('pm25') != -1:
-                        # pm25 returns integers
-                        pass
-            except Exception as e:
-                logger.debug('ERROR: get_home_sensors: value={}'.format(value))
-                #logger.debug(e)
-            val_dict[sens_key] = sens_val
-    logger.debug('get_home_sensors: {}'.format(str(val_dict)))
-    return val_dict
-
-def get_latest_sensors(sensors):
-    '''
-    Collect most recent values of all sensors.
-    :param sensors: dict of SensorVals, e.g., BME280, PM25
-    :return: dict with sensor as key and current value
-    '''
-    sens_vals = {}   # key is sensor name
-    for s in sensors:
-        for dev in sensors[s].vals:
-            logger.debug('get_latest_sensors: {}, {}'.format(s, dev))
-            sens_vals[dev+'_sens'] = sensors[s].vals[dev][-1]
-    logger.debug('latest sensors: {}'.format(str(sens_vals)))
-    return sens_vals
-
-def make_wx_current(the_vals, heading='Current Obs', tzoff=-8, lon_lat=None, home_name='', radar_type=''):
+        for field,value in entry['values'].items():
+            if isinstance(value, float):
+                value = ('{:.0f}' if field.startswith('pm') else '{:.1f}').format(value)  # particle counts are integers
+            sensors[field] = value
+        sensors['time'] = dt.datetime.fromisoformat(entry['time']).strftime('%I:%M %p')
+        if entry['stale']:
+            sensors['stale'].append(topic.split('/')[2])  # e.g. 'bme280' from 'gn_home/gn-pi-zero-2/bme280/J'
+    logger.debug('get_home_sensors: %s', sensors)
+    return sensors
+
+def update_sensors():
+    '''
+    Read new lines of the sensor log, which also updates the rollups.
+    '''
+    try:
+        read_log(Config.sensor_log)
+    except OSError as e:
+        logger.warning('update_sensors: %s', e)
+
+def get_sensor_history(topic=None, field=None, days=1, width=640):
+    '''
+    History of one sensor field from the rollups, for the /history API.
+    :param topic: MQTT topic; without topic and field, the topics and their fields are listed
+    :param days: days of history, ending at the newest reading
+    :param width: points wanted; the coarsest resolution that still gives this many is used
+    :return: dict that is returned as JSON
+    '''
+    update_sensors()
+    if not topic or not field:
+        return {'topics': rollups.store.topics()}
+    res,rows = rollups.store.history(topic, field, int(days * 86400), width)
+    return {'topic': topic, 'field': field, 'resolution': res,
+            'columns': ['time', 'min', 'max', 'mean', 'count'],
+            'points': [[t.isoformat(), lo, hi, round(mean, 3), n] for t,lo,hi,mean,n in rows]}
+
+def make_history_page(days=7, width=640):
+    '''
+    Page with a plot of the sensor history.
+    '''
+    update_sensors()
+    import timeplot     # matplotlib is slow to import, so only load it for pages with a plot
+    img = timeplot.stream_history_plot(rollups.store, days, width)
+    return '<html><body><img src="data:image/png;base64,{}"></body></html>'.format(img)
+
+def make_wx_current(the_vals, heading='Current Obs', tzoff=-8, lon_lat=None, home_name='', radar_type='', stale='', plot=None):
     '''
     Generate web page with jinja2.
     :param obs: object of CurrentObs, FcstDailyData, or FcstHourlyData
+    :param stale: HTML from stale_notice, shown when the forecast is old
+    :param plot: sensor plot format, 'png' or 'svg', default Config.plot_format
     :return:
     '''
-    if False:
-        env = Environment(
-            loader=PackageLoader("app"),
-            autoescape=select_autoescape()
-        )
-    else:
-        path = os.path.join(os.path.dirname(__file__), 'templates')
-        loader = FileSystemLoader(searchpath=path)
-        env = Environment(loader=loader)
-    templ = env.get_template('wx_now.html')
+    templ = get_template('wx_now.html')
+    templ_args = current_args(the_vals, heading, home_name)
+    templ_args['chart_url'] = hourly_chart_url(lon_lat, tzoff)
+    # Get home sensors
+    update_sensors()
+    plot = plot if plot in PLOT_FORMATS else Config.plot_format
+    time_plot = get_home_plot(Config.sensor_log, plot)
+    host,node_port = get_node_addr()
+    buttons = make_buttons(exclude=['hourly', 'now'], lon_lat=lon_lat, home_name=home_name, tzoff=tzoff, radar_type=radar_type)  # returns list of HTML string
+    buttons = ''.join(buttons)
+    return render(templ, templ_args, sensors=get_home_sensors(), plot=plot, img_base64=time_plot, buttons=buttons, stale=stale)
+
+def current_args(the_vals, heading='Current Obs', home_name=''):
+    '''
+    :param the_vals: CurrentObs
+    :return: dict of the current conditions values for wx_now.html and frag_current.html
+    '''
     templ_keys = ['temp', 'humidity', 'feels_like', 'wind_speed', 'wind_deg', 'weather_description', 'weather_icon', 'sunrise', 'sunset', 'uv_index', 'feels_like']
     templ_args = {}
     # load all values from the forecast or obs
@@ -482,81 +638,156 @@ def make_wx_current(the_vals, heading='Current Obs', tzoff=-8, lon_lat=None, hom
     templ_args['heading'] = heading
     if home_name:
         templ_args['home_name'] = home_name
-    # Get home sensors
-    read_log('../sensors/mqtt_rcv.log')
-    logger.debug('Finished read_log')
-    #sensors = get_home_sensors('../sensors/mqtt_rcv.log')
-    sensors = get_latest_sensors(sensor_devs)
-    # TODO: should modify the template to take a dict of sensors, but for now ...
-    for s in sensors:
-        templ_args[s] = sensors[s]
-    host,node_port = get_node_addr()
-    buttons = make_buttons(exclude=['hourly', 'now'], lon_lat=lon_lat, home_name=home_name, tzoff=tzoff, radar_type=radar_type)  # returns list of HTML string
-    buttons = ''.join(buttons)
-    logger.debug('call stream_plot')
-    time_plot = timeplot.stream_plot(sensor_devs)
-    return templ.render(templ_args, img_base64=time_plot, buttons=buttons)
+    return templ_args
+
+PLOT_FORMATS = ('png', 'svg')
+
+def get_home_plot(fname, plot='png'):
+    '''
+    Read the sensor log and draw the plot. The plot is kept in shared_cache until the log changes,
+    so it is drawn once for all workers, not once per worker and request.
+    :param fname: sensor log file name
+    :param plot: 'png' drawn by matplotlib, or 'svg' drawn by svgplot, which is much faster
+    :return: base64 PNG, or SVG markup, of the sensor plot
+    '''
+    def read_and_plot():
+        read_log(fname)
+        logger.debug('Finished read_log')
+        if plot == 'svg':
+            import svgplot
+            return svgplot.stream_svg(sensor_in.store.snapshot())
+        logger.debug('call stream_plot')
+        import timeplot     # matplotlib is slow to import, so only load it for pages with a plot
+        return timeplot.stream_plot(sensor_in.store.snapshot())
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return read_and_plot()  # read_log reports the missing file
+    key = 'homeplot:{}:{}:{}:{}:{}'.format(plot, platform.node(), os.path.abspath(fname), st.st_mtime_ns, st.st_size)
+    value,hit = shared_cache.get_cache().get_or_compute(key, Config.home_refresh*60, read_and_plot)
+    (metrics.cache_hits if hit else metrics.cache_misses).labels('home').inc()
+    return value
 
-def make_hourly_fcst_page(data_all, heading='Today', hours=[1,2,3,6,9]):
+def make_hourly_fcst_page(data_all, heading='Today', hours=[1,2,3,6,9], lon_lat=None, tzoff=-8):
     '''
     Generate web page with jinja2.
     :param obs: object of CurrentObs, FcstDailyData, or FcstHourlyData
     :return:
     '''
-    path = os.path.join(os.path.dirname(__file__), 'templates')
-    loader = FileSystemLoader(searchpath=path)
-    env = Environment(loader=loader)
-    templ_all = env.get_template('wx_hourly_many.html')        # complate page with multiple hours
+    templ_all = get_template('wx_hourly_many.html')        # complate page with multiple hours
     all_divs = make_hourly_divs(data_all, hours=hours)
-    return templ_all.render(divs=all_divs)
+    return render(templ_all, divs=all_divs, stale=stale_notice(data_all), chart_url=hourly_chart_url(lon_lat, tzoff))
+
+def forecast_id(data, section=None):
+    '''
+    :param data: ForecastBundle
+    :param section: 'current', 'hourly' or 'daily' to name only that part, which keeps its name while
+    other parts are fetched again
+    :return: string that names this forecast: provider, location and fetch time, for cache keys
+    '''
+    loc = forecast_cache.location_key(*data.lon_lat) if data.lon_lat else ''
+    fetched = data.sections.get(section, data.fetched) if section else data.fetched
+    return '{}:{}:{:.3f}'.format(data.provider, loc, fetched)
+
+def local_datetime(timestamp, tzoff=-8):
+    '''
+    :param timestamp: unix seconds from the forecast
+    :param tzoff: standard time offset, as in the 'tz' request arg; daylight time is applied as DataParse does
+    :return: aware datetime
+    '''
+    tz_local = myTZ.get(str(tzoff))
+    if not tz_local:
+        return dt.datetime.fromtimestamp(timestamp, dt.timezone.utc)
+    tdata = dt.datetime.fromtimestamp(timestamp, tz=dt.timezone(dt.timedelta(hours=tzoff)))
+    return dt.datetime.fromtimestamp(timestamp, dt.timezone(tz_local.utcoffset(tdata)))
+
+def get_hourly_chart(data, tzoff=-8):
+    '''
+    Chart of the next CHART_HOURS hours of a forecast. It is drawn once per forecast and time zone
+    and kept in shared_cache, so pages and the chart route only look it up.
+    :param data: ForecastBundle from get_wx_all
+    :return: (etag, SVG string)
+    '''
+    key = 'chart:{}:{}'.format(forecast_id(data, 'hourly'), tzoff)
+
+    def draw():
+        import svgplot
+        hours = data['hourly'][:CHART_HOURS]
+        times = [local_datetime(h['dt'], tzoff) for h in hours]
+        temps = [c_to_f(h['temp']) for h in hours]
+        pops = [h.get('pop', 0) for h in hours]
+        winds = [metric_to_english('wind_speed', h.get('wind_speed', 0))[0] for h in hours]
+        with metrics.plot_render.labels('chart').time():
+            svg = svgplot.make_forecast_chart(times, temps, pops, winds)
+        return [hashlib.sha1(key.encode()).hexdigest()[:16], svg]
+    value,hit = shared_cache.get_cache().get_or_compute(key, Config.cache_keep, draw)
+    (metrics.cache_hits if hit else metrics.cache_misses).labels('chart').inc()
+    return value[0],value[1]
 
-def make_hourly_divs(the_vals, heading='Today', hours=[1,2,3,4], tzoff=-8):
+def hourly_chart_url(lon_lat=None, tzoff=-8):
+    '''
+    :return: link to the /hourly_chart.svg route, for an IMG tag
+    '''
+    args = {'tz': tzoff}
+    if lon_lat:
+        args['lon_lat'] = lon_lat
+    return '/hourly_chart.svg?{}'.format(urlencode(args))
+
+def make_hourly_divs(the_vals, heading='Today', hours=[1,2,3,4], tzoff=-8, units=US):
     '''
     Generate a DIV that contains other DIVs for each hour.
-    :param the_vals: object of FcstHourlyData
+    Each DIV is rendered once per forecast, see fragment_cache.py.
+    :param the_vals: ForecastBundle
     :param heading:
     :param hours: list of forecast hours from present time
     :return: HTML DIV list
     '''
-    path = os.path.join(os.path.dirname(__file__), 'templates')
-    loader = FileSystemLoader(searchpath=path)
-    env = Environment(loader=loader)
-    templ = env.get_template('fcst_hourly_div.html')     # construct a DIV for each hour
-    templ_keys = ['temp', 'humidity', 'wind_speed', 'wind_deg', 'weather_description', 'weather_icon', 'pop']
+    generation = forecast_id(the_vals, 'hourly') if hasattr(the_vals, 'fetched') else None
     divs = []
-    #tzobj = dt.timezone(dt.timedelta(hours=tz))
-
     for hour in hours:
-        obs = parse_wx_hourly(the_vals, hour, tzoff)
-        templ_args = {}
-        for key in templ_keys:
-            templ_args[key],unitStr = obs.getObsVal(key)
-            if key == 'wind_deg':
-                templ_args['wind_compass'] = DataParse.wind_compass(templ_args['wind_deg'])
-            elif key == 'pop':
-                if float(templ_args[key]) < 0.11:
-                    templ_args.pop('pop') # remove prob-of-precip so it's not displayed
-                else:   # TODO: should handle 'pop' value elsewhere
-                    templ_args[key] = '%d' % int(float(templ_args[key]) * 100.0)
-            else:
-                templ_args[key] = str(templ_args[key])+unitStr
-        dt_obs = dt.datetime.fromisoformat(obs.getObsVal('datetime')[0])
-        templ_args['time'] = dt_obs.strftime("%a %I %p")
-        divs.append(templ.render(templ_args))
+        render_div = lambda hour=hour: make_hourly_div(the_vals, hour, tzoff, units)
+        if generation is None:
+            divs.append(render_div())   # plain OneCall dict, nothing to key the cache on
+        else:
+            key = ('fcst_hourly_div.html', generation, the_vals['hourly'][hour]['dt'], tzoff, units)
+            divs.append(fragments.get_or_render(key, render_div))
     #logger.debug('made {} DIVs'.format(len(divs)))
     #logger.debug('DIV[0]: {}'.format(str(divs[0])))
     return divs
 
+def make_hourly_div(the_vals, hour, tzoff=-8, units=US):
+    '''
+    :param the_vals: ForecastBundle
+    :param hour: forecast hour from present time
+    :return: HTML DIV of one hour
+    '''
+    templ = get_template('fcst_hourly_div.html')     # construct a DIV for each hour
+    templ_keys = ['temp', 'humidity', 'wind_speed', 'wind_deg', 'weather_description', 'weather_icon', 'pop']
+    #tzobj = dt.timezone(dt.timedelta(hours=tz))
+    obs = parse_wx_hourly(the_vals, hour, tzoff)
+    templ_args = {}
+    for key in templ_keys:
+        templ_args[key],unitStr = obs.getObsVal(key, units)
+        if key == 'wind_deg':
+            templ_args['wind_compass'] = DataParse.wind_compass(templ_args['wind_deg'])
+        elif key == 'pop':
+            if float(templ_args[key]) < 0.11:
+                templ_args.pop('pop') # remove prob-of-precip so it's not displayed
+            else:   # TODO: should handle 'pop' value elsewhere
+                templ_args[key] = '%d' % int(float(templ_args[key]) * 100.0)
+        else:
+            templ_args[key] = str(templ_args[key])+unitStr
+    dt_obs = dt.datetime.fromisoformat(obs.getObsVal('datetime')[0])
+    templ_args['time'] = dt_obs.strftime("%a %I %p")
+    return render(templ, templ_args)
+
 def make_wx_hourly(the_vals, heading='Hourly Forecast'):
     '''
     Generate single hour forecast web page with jinja2.
     :param obs: object of CurrentObs, FcstDailyData, or FcstHourlyData
     :return:
     '''
-    path = os.path.join(os.path.dirname(__file__), 'templates')
-    loader = FileSystemLoader(searchpath=path)
-    env = Environment(loader=loader)
-    templ = env.get_template('wx_hourly.html')
+    templ = get_template('wx_hourly.html')
     templ_keys = ['temp', 'humidity', 'wind_speed', 'wind_deg', 'weather_description', 'weather_icon']
 
     templ_args = {}
@@ -569,7 +800,7 @@ def make_wx_hourly(the_vals, heading='Hourly Forecast'):
     templ_args['day_name'] = day_name
     templ_args['time'] = dt_obs.time()
     templ_args['heading'] = heading
-    return templ.render(templ_args)
+    return render(templ, templ_args)
 
 def make_daily_fcst_page(data_all, tzoff=-8, lon_lat=None, home_name='', radar_type=''):
     '''
@@ -582,42 +813,61 @@ def make_daily_fcst_page(data_all, tzoff=-8, lon_lat=None, home_name='', radar_t
     if tzStr in myTZ:
         tz_local = myTZ[tzStr].utcoffset()
     '''
-    path = os.path.join(os.path.dirname(__file__), 'templates')
-    loader = FileSystemLoader(searchpath=path)
-    env = Environment(loader=loader)
-    templ_all = env.get_template('wx_daily_many.html')  # complete page with multiple days
-    templ = env.get_template('fcst_daily_div.html')     # construct a DIV for each day
-    templ_keys = ['sunrise', 'sunset', 'temp_max', 'temp_min', 'humidity', 'wind_speed', 'wind_deg', 'weather_description', 'weather_icon', 'pop']
-    divs = []
-    ndays = len(data_all['daily'])
-    ndays = min(ndays,9)
-
-    for day in range(ndays):
-        #tzobj = dt.timezone(dt.timedelta(hours=tz)) # inside loop in case ndays crosses daylight hours change
-        the_vals = parse_wx_daily(data_all, day, tzoff)
-        templ_args = {}
-        for key in templ_keys:
-            templ_args[key] = the_vals.getObsStr(key)
-            #templ_args[key] = metric_to_english(key,templ_args[key])
-            if key == 'wind_deg':
-                templ_args['wind_compass'] = DataParse.wind_compass(templ_args['wind_deg'])
-            elif key == 'pop':  # probability-of-precipitation
-                if float(templ_args[key]) < 0.11:
-                    templ_args.pop('pop') # remove prob-of-precip so it's not displayed
-                else:   # TODO: should handle 'pop' value elsewhere
-                    templ_args[key] = '%d' % int(float(templ_args[key]) * 100.0)
-        #templ_args = {key:the_vals.getObsStr(key) for key in templ_keys}
-        dt_obs = dt.datetime.fromisoformat(the_vals.getObsStr('datetime'))
-        # day-of-week name
-        day_name = dt_obs.date().strftime('%A')
-        templ_args['day_name'] = day_name[:3]
-        divs.append(templ.render(templ_args, url_for=url_for))
+    templ_all = get_template('wx_daily_many.html')  # complete page with multiple days
+    divs = make_daily_divs(data_all, tzoff)
     host,node_port = get_node_addr()
     buttons = make_buttons(exclude=['hourly', 'daily'], lon_lat=lon_lat, home_name=home_name, tzoff=tzoff, radar_type=radar_type)  # returns list of HTML string
     buttons = ''.join(buttons)
     #logger.debug('make_buttons: {}'.format(buttons))
     #return templ_all.render(divs=divs, node_port=node_port, buttons=buttons, home=home_name)
-    return templ_all.render(url_for=url_for, divs=divs, buttons=buttons, home=home_name)
+    return render(templ_all, url_for=url_for, divs=divs, buttons=buttons, home=home_name, stale=stale_notice(data_all))
+
+def make_daily_divs(data_all, tzoff=-8, ndays=9, units=US):
+    '''
+    Generate a DIV for each day.
+    Each DIV is rendered once per forecast, see fragment_cache.py.
+    :param data_all: ForecastBundle
+    :param ndays: at most this many days, today first
+    :return: HTML DIV list
+    '''
+    generation = forecast_id(data_all, 'daily') if hasattr(data_all, 'fetched') else None
+    divs = []
+    for day in range(min(len(data_all['daily']), ndays)):
+        render_div = lambda day=day: make_daily_div(data_all, day, tzoff, units)
+        if generation is None:
+            divs.append(render_div())   # plain OneCall dict, nothing to key the cache on
+        else:
+            key = ('fcst_daily_div.html', generation, data_all['daily'][day]['dt'], tzoff, units)
+            divs.append(fragments.get_or_render(key, render_div))
+    return divs
+
+def make_daily_div(data_all, day, tzoff=-8, units=US):
+    '''
+    :param data_all: ForecastBundle
+    :param day: 0 for today
+    :return: HTML DIV of one day
+    '''
+    templ = get_template('fcst_daily_div.html')     # construct a DIV for each day
+    templ_keys = ['sunrise', 'sunset', 'temp_max', 'temp_min', 'humidity', 'wind_speed', 'wind_deg', 'weather_description', 'weather_icon', 'pop']
+    #tzobj = dt.timezone(dt.timedelta(hours=tz)) # inside loop in case ndays crosses daylight hours change
+    the_vals = parse_wx_daily(data_all, day, tzoff)
+    templ_args = {}
+    for key in templ_keys:
+        templ_args[key] = the_vals.getObsStr(key, units)
+        #templ_args[key] = metric_to_english(key,templ_args[key])
+        if key == 'wind_deg':
+            templ_args['wind_compass'] = DataParse.wind_compass(templ_args['wind_deg'])
+        elif key == 'pop':  # probability-of-precipitation
+            if float(templ_args[key]) < 0.11:
+                templ_args.pop('pop') # remove prob-of-precip so it's not displayed
+            else:   # TODO: should handle 'pop' value elsewhere
+                templ_args[key] = '%d' % int(float(templ_args[key]) * 100.0)
+    #templ_args = {key:the_vals.getObsStr(key) for key in templ_keys}
+    dt_obs = dt.datetime.fromisoformat(the_vals.getObsStr('datetime'))
+    # day-of-week name
+    day_name = dt_obs.date().strftime('%A')
+    templ_args['day_name'] = day_name[:3]
+    return render(templ, templ_args)
 
 def make_wx_daily(the_vals, heading='Daily'):
     '''
@@ -625,10 +875,7 @@ def make_wx_daily(the_vals, heading='Daily'):
     :param obs: object of CurrentObs, FcstDailyData, or FcstHourlyData
     :return:
     '''
-    path = os.path.join(os.path.dirname(__file__), 'templates')
-    loader = FileSystemLoader(searchpath=path)
-    env = Environment(loader=loader)
-    templ = env.get_template('wx_daily_one.html')
+    templ = get_template('wx_daily_one.html')
     templ_keys = ['temp_max', 'temp_min', 'humidity', 'wind_speed', 'wind_deg', 'weather_description', 'weather_icon']
 
     templ_args = {}
@@ -641,39 +888,164 @@ def make_wx_daily(the_vals, heading='Daily'):
     templ_args['day_name'] = day_name
     #templ_args['time'] = dt_obs.time()
     templ_args['heading'] = heading
-    return templ.render(templ_args)
+    return render(templ, templ_args)
+
+_pool = None    # threads that render the /dashboard panels, started on first use so none are forked
+
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    pool = _pool
+    if pool is not None:
+        return pool
+    with _pool_lock:    # two first requests at once would each start a pool
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(Config.dashboard_threads, thread_name_prefix='panel')
+    return _pool
+
+def get_fragment(name, data, tzoff, draw, section=None):
+    '''
+    HTML of one forecast panel, kept in shared_cache until the next forecast.
+    :param name: names the panel and anything else it depends on, part of the cache key
+    :param data: ForecastBundle the panel is drawn from
+    :param draw: function that returns the HTML
+    :param section: the part of data the panel shows, see forecast_id
+    :return: HTML string
+    '''
+    key = 'frag:{}:{}:{}'.format(name, forecast_id(data, section), tzoff)
+    html,hit = shared_cache.get_cache().get_or_compute(key, Config.cache_keep, draw)
+    (metrics.cache_hits if hit else metrics.cache_misses).labels('panel').inc()     # the DIVs inside count as 'fragment'
+    return html
+
+def make_sensor_panel(plot=None):
+    '''
+    :param plot: sensor plot format, 'png' or 'svg', default Config.plot_format
+    :return: HTML of the home sensor values and plot
+    '''
+    update_sensors()
+    plot = plot if plot in PLOT_FORMATS else Config.plot_format
+    return render(get_template('frag_sensors.html'), sensors=get_home_sensors(), plot=plot,
+                  img_base64=get_home_plot(Config.sensor_log, plot))
+
+def make_dashboard(data, tzoff=-8, lon_lat=None, home_name='', radar_type='', plot=None, hours=(1,2,3,6,9), ndays=6):
+    '''
+    Kiosk page with the current conditions, hourly and daily forecasts and the home sensors,
+    all from one forecast. The panels are rendered in parallel. The forecast panels are kept
+    until the next forecast arrives, so usually only the sensor panel is rendered.
+    :param data: ForecastBundle from get_wx_all
+    :param hours: forecast hours shown in the hourly strip
+    :param ndays: days shown in the daily forecast
+    :return: HTML page
+    '''
+    hours = list(hours)
+
+    def boxes(divs):
+        return ''.join('<div class="box-ivory">{}</div>'.format(div) for div in divs)
+    panels = {
+        'current': lambda: get_fragment('current', data, tzoff, lambda: render(
+            get_template('frag_current.html'), current_args(parse_wx_curr(data, tzoff))), 'current'),
+        'hourly': lambda: get_fragment('hourly{}'.format(hours), data, tzoff, lambda: boxes(
+            make_hourly_divs(data, hours=hours, tzoff=tzoff)), 'hourly'),
+        'daily': lambda: get_fragment('daily{}'.format(ndays), data, tzoff, lambda: boxes(
+            make_daily_divs(data, tzoff, ndays)), 'daily'),
+        'sensors': lambda: make_sensor_panel(plot),
+    }
+    futures = {name: get_pool().submit(func) for name,func in panels.items()}
+    html = {name: future.result() for name,future in futures.items()}
+    buttons = ''.join(make_buttons(lon_lat=lon_lat, home_name=home_name, tzoff=tzoff, radar_type=radar_type))
+    return render(get_template('wx_dashboard.html'), html, home_name=home_name, buttons=buttons,
+                  chart_url=hourly_chart_url(lon_lat, tzoff), stale=stale_notice(data))
 
 def get_wx_all(lon_lat=None, tz_off=-8):
     '''
-    Get data from OpenWeatherMap.
+    Get data from the forecast provider, OpenWeatherMap unless Config.forecast_provider says otherwise.
     Request "all" data, but exclude "minutely" data. So we get current obs, all hourly and all daily.
+    Between Config.forecast_refresh fetches, only current obs are fetched and merged into the cached data.
     Request metric data. If US units are desired, conversion is done when generating display.
     :param lon_lat: a tuple or list of (longitude,latitude)
-    :return: dict that represents JSON. See OpenWeatherMap API for info.
+    :return: providers.ForecastBundle, a dict laid out like OneCall JSON. See OpenWeatherMap API for info.
     '''
-    # get OpenWeather data
-    if lon_lat:
-        lon,lat = lon_lat.split(',')
-    else:
-        lon = Config.location[0]
-        lat = Config.location[1]
-    wx_fcst_url = Config.openweatherPrefix + 'onecall?lat={lat}&lon={lon}&appid={API_key}&exclude=minutely&units=metric'.format(
-    lat=lat, lon=lon, API_key=ApiKeys.openweather_key)
-    request = Request(wx_fcst_url)
-    with urlopen(request) as response:
-        jdata = response.read()
-    data = json.loads(jdata)
-    #logger.debug('get_wx_all: json={}, parsed={}'.format(len(jdata), len(data)))
-    logger.debug('get_wx_all: return data len={}'.format(len(data)))
+    # get forecast from the configured provider, OpenWeather unless Config says otherwise
+    lon,lat = forecast_cache.snap(*providers.parse_lon_lat(lon_lat))   # the forecast is for the grid point
+    key = forecast_cache.location_key(lon, lat)
+    forecast_cache.buckets.note(lon_lat, key)
+    quota.budget.note_request(key)
+    current_age = quota.budget.refresh_interval(key)    # Config.weather_refresh, or longer when the call budget is short
+    metrics.refresh_interval.labels(key).set(current_age)
+    provider = providers.get_provider()
+    max_age = current_age
+    if provider.tiered and Config.forecast_refresh:
+        max_age = max(current_age, Config.forecast_refresh * 60)
+    data = forecasts.get(key, max_age=max_age, current_age=current_age)
+    if data is not None:
+        metrics.cache_hits.labels('forecast').inc()
+        return data
+    # one thread or worker fetches, the others wait here and then find the forecast in the cache
+    with forecasts.single_flight(key):
+        data = forecasts.get(key, max_age=max_age, current_age=current_age)
+        if data is not None:
+            metrics.cache_hits.labels('forecast').inc()
+            return data
+        metrics.cache_misses.labels('forecast').inc()
+        cached = forecasts.get(key, max_age=max_age, current_age=max_age) if max_age > current_age else None
+        try:
+            # fetch_breaker refuses at once while the provider is down, so pages don't wait on the timeout
+            with metrics.upstream_fetch.labels(provider.name).time():
+                if cached is not None:
+                    # the forecasts are still good, only the current obs are due
+                    data = cached.merge(fetch_breaker.call(provider.fetch_current, lon, lat))
+                else:
+                    data = fetch_breaker.call(provider.fetch, lon, lat)
+        except Exception as e:
+            metrics.upstream_errors.labels(provider.name).inc()
+            data = forecasts.last_good(key)
+            if data is None:
+                raise
+            logger.warning('get_wx_all: %s, serving forecast from %s', e, dt.datetime.fromtimestamp(data.fetched))
+            return data.as_stale()
+        forecasts.put(key, data)
+    quota.budget.maybe_save()   # here in the request thread, not on the async_fetch loop that counted the call
+    try:
+        get_hourly_chart(data)  # drawn now for the default time zone, so no page request waits for it
+    except Exception as e:
+        logger.error('get_wx_all: hourly chart: %s', e)
+    logger.debug('get_wx_all: provider=%s, return data len=%s', data.provider, len(data))
     return data
 
+def stale_notice(data):
+    '''
+    :param data: ForecastBundle from get_wx_all
+    :return: HTML that warns the forecast is old, '' if it is current
+    '''
+    if not getattr(data, 'stale', False):
+        return ''
+    fetched = dt.datetime.fromtimestamp(data.fetched).strftime('%a %I:%M %p')
+    return '<div class="stale">Forecast from {}, weather service not responding</div>'.format(fetched)
+
+def onecall_url(lon_lat=None, exclude='minutely'):
+    '''
+    Build the OneCall request URL.
+    :param lon_lat: string "lon,lat" as passed in request args, None for Config.location
+    :param exclude: OneCall sections to leave out of the response
+    :return: URL string
+    '''
+    lon,lat = providers.parse_lon_lat(lon_lat)
+    return providers.OpenWeatherSource().url(lon, lat, exclude)
+
 def parse_wx_curr(data, tzoff=-8):
+    parsed = get_parsed(data, tzoff)
+    if parsed is not None:
+        return parsed.current
     # Construct the current obs data
     currObs = CurrentObs(data, tzoff)
     logger.debug('parse_wx_curr: return currObs')
     return currObs
 
 def parse_wx_daily(data, iday=1, tzoff=-8):
+    parsed = get_parsed(data, tzoff)
+    if parsed is not None and 0 <= iday < len(parsed.daily):
+        return parsed.daily[iday]
     # Construct the current obs data
     currObs = FcstDailyData(data, iday, tzoff)
     return currObs
@@ -683,7 +1055,10 @@ def parse_wx_hourly(data, ihour=1, tzoff=-8):
         # I put this here when OpenWeather messed up and started delivering hourly forecasts for every 6 hours instead
         hr_recs = data['hourly']
         for rec in hr_recs:
-            logger.debug('hourly: dt={}'.format(dt.datetime.fromtimestamp(rec['dt'])))
+            logger.debug('hourly: dt=%s', dt.datetime.fromtimestamp(rec['dt']))
+    parsed = get_parsed(data, tzoff)
+    if parsed is not None and 0 <= ihour < len(parsed.hourly):
+        return parsed.hourly[ihour]
     # Construct the current obs data
     currObs = FcstHourlyData(data, ihour, tzoff)
     return currObs
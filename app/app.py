@@ -2,6 +2,10 @@ from flask import Flask, make_response, request, current_app
 from functools import update_wrapper
 from datetime import timedelta
 import OpenWeatherProvider as ow
+import metrics
+import profiling
+import static_export
+import warmup
 #import radar_disp as radar
 import logging
 import my_logger
@@ -9,6 +13,20 @@ import my_logger
 logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
 
 app = Flask(__name__,static_folder='static')
+profiling.install(app)     # does nothing unless Config turns profiling on
+try:
+    import uwsgi    # only importable when running under uwsgi
+except ImportError:
+    uwsgi = None    # Flask development server, benchmarks
+if uwsgi is not None:
+    warmup.warmup()    # runs in the uwsgi master, the workers fork with everything loaded
+
+def start_export():
+    # threads don't survive the fork, so under uwsgi the first worker runs the exporter
+    if uwsgi is None or uwsgi.worker_id() == 1:
+        static_export.start(app)   # does nothing unless Config.export_dir is set
+if uwsgi is not None:
+    uwsgi.post_fork_hook = start_export
 
 # crossdomain is a decorator
 # got this CORS solution from https://stackoverflow.com/questions/26980713/solve-cross-origin-resource-sharing-with-flask
@@ -56,6 +74,24 @@ def crossdomain(origin=None, methods=None, headers=None,
 def hello_world():
     return 'Hello World!'
 
+@app.route('/history')
+def sensor_history():
+    # /history?topic=gn_home/gn-pi-zero-2/bme280/J&field=temp_c&days=30&width=640
+    # without topic and field it lists what is available
+    args = request.args
+    return ow.get_sensor_history(args.get('topic'), args.get('field'), days=args.get('days', 1, type=float),
+                                 width=args.get('width', 640, type=int))
+
+@app.route('/history_plot')
+def sensor_history_plot():
+    args = request.args
+    return ow.make_history_page(days=args.get('days', 7, type=float), width=args.get('width', 640, type=int))
+
+# Prometheus scrapes this: per-stage timings, cache and upstream counters, memory
+@app.route('/metrics')
+def show_metrics():
+    return current_app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # TODO: each route should look for location params in the request and store those params in the page it generates
 # TODO: each generated page should also store params into link buttons
 # These route requests are usually generated by clicking a button on the display.
@@ -71,15 +107,28 @@ def wx_show_current():
     tzOffset = request.args.get('tz')
     homeName = request.args.get('home_name')
     radarType = request.args.get('radar_type')
+    plot = request.args.get('plot')     # 'png' or 'svg', default Config.plot_format
     if tzOffset:
         tzOffset = int(tzOffset)
     else:
         tzOffset = -8
     wxdata = ow.get_wx_all(lon_lat)
     obs = ow.parse_wx_curr(wxdata, tzoff=tzOffset)
-    html = ow.make_wx_current(obs, heading='Current Weather', tzoff=tzOffset, lon_lat=lon_lat, home_name=homeName, radar_type=radarType)
+    html = ow.make_wx_current(obs, heading='Current Weather', tzoff=tzOffset, lon_lat=lon_lat, home_name=homeName, radar_type=radarType,
+                              stale=ow.stale_notice(wxdata), plot=plot)
     return html
 
+# everything on one page for the wall displays, from one forecast
+@app.route('/dashboard')
+def wx_dashboard():
+    lon_lat = request.args.get('lon_lat')   # None if param not in request
+    tzOffset = request.args.get('tz', -8, type=int)
+    homeName = request.args.get('home_name', '')
+    radarType = request.args.get('radar_type', '')
+    wxdata = ow.get_wx_all(lon_lat)
+    return ow.make_dashboard(wxdata, tzoff=tzOffset, lon_lat=lon_lat, home_name=homeName, radar_type=radarType,
+                             plot=request.args.get('plot'))
+
 @app.route('/all_now')
 def wx_show_all_current():
     wxdata = ow.get_wx_all()
@@ -104,6 +153,17 @@ def wx_show_hour():
     html = ow.make_wx_hourly(obs, heading='Hourly Forecast')
     return html
 
+# the 48 hour chart on /hourly and /now. It changes only with the forecast, so browsers revalidate with the ETag.
+@app.route('/hourly_chart.svg')
+def hourly_chart():
+    lon_lat = request.args.get('lon_lat')
+    tzOffset = request.args.get('tz', -8, type=int)
+    etag,svg = ow.get_hourly_chart(ow.get_wx_all(lon_lat), tzoff=tzOffset)
+    response = current_app.response_class(svg, mimetype='image/svg+xml')
+    response.set_etag(etag)
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
+
 # display a page of multiple hourly forecasts
 @app.route('/hourly')
 def wx_show_hourly():
@@ -129,9 +189,12 @@ def get_hourly_divs():
         hours = [int(h) for h in hoursStr.split(',')]
     else:
         hours = [1,2,3]
-    logger.debug('get_hourly_divs, lon_lat={}, hours={}'.format(lon_lat,hours))
+    logger.debug('get_hourly_divs, lon_lat=%s, hours=%s', lon_lat, hours)
     wxdata = ow.get_wx_all(lon_lat)
     divs = ow.make_hourly_divs(wxdata, hours=hours, tzoff=tzOffset)
+    stale = ow.stale_notice(wxdata)
+    if stale:
+        divs.insert(0, stale)
     return '<br>\n'.join(divs)
 
 @app.route('/daily')
@@ -160,4 +223,5 @@ def node_radar():
     pass
 """
 if __name__ == '__main__':
+    start_export()
     app.run(host='0.0.0.0')
@@ -0,0 +1,167 @@
+# Asynchronous HTTP client for upstream data: OpenWeather OneCall and the NWS forecasts.
+# One asyncio event loop runs in a daemon thread. Flask routes call the sync wrappers
+# (get, get_json, get_many) which hand a coroutine to that loop and wait for the result.
+# Many outstanding fetches therefore cost one thread, not one uwsgi thread each.
+# Only the standard library is used, so nothing new has to be installed on the Pi.
+import asyncio
+import json
+import os
+import ssl
+import threading
+import zlib
+from urllib.parse import urljoin, urlsplit
+import logging
+import metrics
+import my_logger
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+USER_AGENT = 'wx_disp_flask/1.0'
+MAX_REDIRECTS = 5
+
+_loop = None
+_loop_pid = None    # uwsgi forks workers after import, each worker needs its own loop thread
+_loop_lock = threading.Lock()
+_ssl_ctx = None
+
+class HttpError(Exception):
+    '''
+    Raised when the server answers with a status code of 400 or more.
+    '''
+    def __init__(self, url, status, reason=''):
+        Exception.__init__(self, 'HTTP {} {} for {}'.format(status, reason, url))
+        self.url = url
+        self.status = status
+        self.reason = reason
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+def get_loop():
+    '''
+    Return the background event loop, starting its thread on first use.
+    :return: asyncio event loop running in a daemon thread
+    '''
+    global _loop, _loop_pid
+    if _loop is not None and _loop_pid == os.getpid():
+        return _loop
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_run_loop, args=(loop,), name='wx-async', daemon=True)
+            thread.start()
+            _loop = loop
+            _loop_pid = os.getpid()
+            logger.debug('get_loop: started event loop thread in pid %s', _loop_pid)
+    return _loop
+
+def _get_ssl_context():
+    global _ssl_ctx
+    if _ssl_ctx is None:
+        _ssl_ctx = ssl.create_default_context()
+    return _ssl_ctx
+
+async def _read_body(reader, headers):
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                # skip optional trailers up to the blank line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()     # CRLF after each chunk
+        return b''.join(chunks)
+    if 'content-length' in headers:
+        return await reader.readexactly(int(headers['content-length']))
+    return await reader.read()      # Connection: close, read to EOF
+
+async def _fetch_once(url, headers=None):
+    parts = urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    reader, writer = await asyncio.open_connection(parts.hostname, port,
+                                                   ssl=_get_ssl_context() if secure else None)
+    try:
+        req_headers = {'Host': parts.netloc, 'User-Agent': USER_AGENT,
+                       'Accept-Encoding': 'gzip', 'Connection': 'close'}
+        if headers:
+            req_headers.update(headers)
+        request = 'GET {} HTTP/1.1\r\n'.format(path)
+        request += ''.join('{}: {}\r\n'.format(k, v) for k, v in req_headers.items()) + '\r\n'
+        writer.write(request.encode('latin-1'))
+        await writer.drain()
+        raw_status = await reader.readline()
+        status_line = raw_status.decode('latin-1').split(' ', 2)
+        if len(status_line) < 2 or not status_line[0].startswith('HTTP/') or not status_line[1].isdigit():
+            raise ConnectionError('bad status line {!r} from {}'.format(raw_status[:80], parts.netloc))
+        status = int(status_line[1])
+        reason = status_line[2].strip() if len(status_line) > 2 else ''
+        resp_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            resp_headers[name.strip().lower()] = value.strip()
+        body = await _read_body(reader, resp_headers)
+        if resp_headers.get('content-encoding', '').lower() == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return status, reason, resp_headers, body
+    finally:
+        writer.close()
+
+async def fetch(url, headers=None):
+    '''
+    GET a URL on the event loop. Follows redirects.
+    :param url: http or https URL
+    :param headers: optional dict of extra request headers
+    :return: response body as bytes
+    '''
+    for _ in range(MAX_REDIRECTS + 1):
+        status, reason, resp_headers, body = await _fetch_once(url, headers)
+        if status in (301, 302, 303, 307, 308) and 'location' in resp_headers:
+            url = urljoin(url, resp_headers['location'])    # Location may be relative
+            continue
+        if status >= 400:
+            raise HttpError(url, status, reason)
+        return body
+    raise HttpError(url, status, 'too many redirects')
+
+async def fetch_json(url, headers=None):
+    body = await fetch(url, headers)
+    with metrics.json_parse.time():
+        return json.loads(body)
+
+async def fetch_many(urls, headers=None, as_json=False):
+    '''
+    Fetch several URLs concurrently.
+    :return: list in the same order as urls. A failed fetch has its exception in its place.
+    '''
+    func = fetch_json if as_json else fetch
+    return await asyncio.gather(*[func(url, headers) for url in urls], return_exceptions=True)
+
+def run(coro, timeout=None):
+    '''
+    Sync wrapper: run a coroutine on the background loop and wait for it.
+    :param coro: coroutine object
+    :param timeout: seconds to wait, None waits forever. On timeout the coroutine is cancelled.
+    :return: the coroutine result
+    '''
+    future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, timeout), get_loop())
+    return future.result()
+
+def get(url, timeout=None, headers=None):
+    return run(fetch(url, headers), timeout)
+
+def get_json(url, timeout=None, headers=None):
+    return run(fetch_json(url, headers), timeout)
+
+def get_many(urls, timeout=None, headers=None, as_json=False):
+    return run(fetch_many(urls, headers, as_json), timeout)
@@ -0,0 +1,82 @@
+# Circuit breaker for calls to an upstream service.
+# closed:    calls go through; consecutive failures are counted.
+# open:      after failure_threshold failures, calls are refused at once (CircuitOpenError)
+#            so pages do not wait on a service that is down.
+# half_open: after reset_timeout seconds, exactly one probe call is let through.
+#            Success closes the circuit, failure opens it again.
+import threading
+import time
+import logging
+import my_logger
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=3, reset_timeout=60.0):
+        '''
+        :param name: used in log messages
+        :param failure_threshold: consecutive failures that open the circuit
+        :param reset_timeout: seconds to stay open before a probe is allowed
+        '''
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        '''
+        :return: True if a call may go to the service now
+        '''
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                logger.info('CircuitBreaker %s: half open, probing', self.name)
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True     # this caller is the single probe
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                logger.info('CircuitBreaker %s: closed', self.name)
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning('CircuitBreaker %s: open after %s failures', self.name, self.failures)
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Call func through the breaker.
+        :raise CircuitOpenError: the circuit is open, func was not called
+        '''
+        if not self.allow():
+            raise CircuitOpenError('{} circuit is {}'.format(self.name, self.state))
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.failure()
+            raise
+        self.success()
+        return result
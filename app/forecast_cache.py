@@ -0,0 +1,118 @@
+# Cache of forecasts, one entry per location.
+# Entries younger than the TTL are served as they are. Older entries are kept as the
+# "last good" forecast, served (marked stale) when the provider cannot be reached.
+# Forecasts are kept in this process and in the shared_cache store, so a forecast fetched
+# by one uwsgi worker is used by the others instead of being fetched again.
+# Locations are snapped to a grid of Config.location_grid degrees, so kiosks that write the same place
+# with different precision ('-121.95,36.9764016', '-121.950,36.976') share one forecast.
+import threading
+import time
+
+import Config
+import metrics
+import shared_cache
+
+def snap(lon, lat):
+    '''
+    :return: (lon, lat) moved to the nearest point of the Config.location_grid grid
+    '''
+    grid = Config.location_grid
+    if not grid:
+        return lon, lat
+    return round(round(lon / grid) * grid, 6), round(round(lat / grid) * grid, 6)
+
+def location_key(lon, lat):
+    '''
+    :return: cache key of the grid point nearest (lon, lat), used by every cache that is per location
+    '''
+    lon,lat = snap(lon, lat)
+    return '{:.4f},{:.4f}'.format(lon, lat)
+
+class BucketStats:
+    '''
+    The different ways each location key was asked for, to see how many fetches the grid saves.
+    '''
+    def __init__(self, most=100):
+        '''
+        :param most: raw strings remembered per key
+        '''
+        self.raw = {}   # location key to set of lon_lat strings as they came in requests
+        self.most = most
+        self.lock = threading.Lock()
+
+    def note(self, raw, key):
+        '''
+        :param raw: lon_lat as the request gave it, None for Config.location
+        '''
+        raw = 'default' if raw is None else raw if isinstance(raw, str) else ','.join(str(x) for x in raw)
+        seen = self.raw.get(key)
+        if seen is not None and raw in seen:
+            return
+        with self.lock:
+            seen = self.raw.setdefault(key, set())
+            if len(seen) < self.most:
+                seen.add(raw)
+            metrics.location_raw_keys.labels(key).set(len(seen))
+
+    def collapsed(self):
+        '''
+        :return: dict of location key to number of different lon_lat strings that were snapped to it
+        '''
+        with self.lock:
+            return {key: len(seen) for key,seen in self.raw.items()}
+
+buckets = BucketStats()
+
+class ForecastCache:
+    def __init__(self, store=None):
+        '''
+        :param store: shared_cache.Cache, default shared_cache.get_cache() on first use
+        '''
+        self.entries = {}   # location key to ForecastBundle, this process only
+        self.lock = threading.Lock()
+        self._store = store
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = shared_cache.get_cache()
+        return self._store
+
+    def _newest(self, key):
+        bundle = self.entries.get(key)
+        if isinstance(self.store, shared_cache.MemoryCache):
+            return bundle   # nothing to learn from other processes
+        shared = self.store.get('forecast:' + key)
+        if shared is not None and (bundle is None or shared.fetched > bundle.fetched):
+            with self.lock:
+                self.entries[key] = shared
+            bundle = shared
+        return bundle
+
+    def get(self, key, max_age, current_age=None):
+        '''
+        :param max_age: seconds
+        :param current_age: seconds for the current conditions, default max_age; see ForecastBundle.fresh
+        :return: the cached ForecastBundle if younger than max_age, else None
+        '''
+        bundle = self.entries.get(key)
+        if bundle is not None and bundle.fresh(max_age, current_age):
+            return bundle
+        bundle = self._newest(key)
+        if bundle is not None and bundle.fresh(max_age, current_age):
+            return bundle
+        return None
+
+    def last_good(self, key):
+        return self._newest(key)
+
+    def put(self, key, bundle):
+        with self.lock:
+            self.entries[key] = bundle
+        self.store.set('forecast:' + key, bundle, Config.cache_keep)
+
+    def single_flight(self, key):
+        '''
+        Context manager held while fetching key, so only one thread or worker fetches it.
+        '''
+        return self.store.lease('forecast:' + key, timeout=Config.fetch_timeout * 2)
@@ -0,0 +1,53 @@
+# Rendered HTML fragments, such as the DIV of one forecast hour or day.
+# A fragment depends only on its forecast record, so it is keyed by the record's 'dt', the forecast it
+# came from (OpenWeatherProvider.forecast_id, which changes with every fetch), the time zone offset and
+# the units, and it is rendered at most once per forecast. The page builders join cached fragments.
+# Fragments are kept in this process: a lookup is a dict get, where a shared store would cost a round
+# trip per DIV. The pages they are joined into are kept in shared_cache where that matters.
+import collections
+import threading
+
+import Config
+import metrics
+
+class FragmentCache:
+    def __init__(self, size=None):
+        '''
+        :param size: fragments kept, the oldest are dropped first; default Config.fragment_cache_size
+        '''
+        self.size = size or Config.fragment_cache_size
+        self.entries = collections.OrderedDict()    # key to HTML, oldest first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key, render):
+        '''
+        :param key: tuple such as ('fcst_hourly_div.html', forecast_id, dt, tzoff, units)
+        :param render: function that returns the HTML, called on a miss
+        :return: HTML string
+        '''
+        html = self.entries.get(key)
+        if html is not None:
+            self.hits += 1
+            metrics.cache_hits.labels('fragment').inc()
+            return html
+        self.misses += 1
+        metrics.cache_misses.labels('fragment').inc()
+        html = render()
+        with self.lock:
+            self.entries[key] = html
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return html
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+fragments = FragmentCache()
+metrics.fragment_hit_ratio.set_function(fragments.hit_ratio)
@@ -35,7 +35,7 @@ def log_parse_json(line):
     if not sens_dev in sensor_devs:
         sensor_devs[sens_dev] = dict()
         location,computer,sensor = sens_dev.split('/')
-        logger.debug('{},{},{}'.format(location,computer,sensor))
+        logger.debug('%s,%s,%s', location, computer, sensor)
     #ll = line[fld1+1:].strip()
     for fld_name in values[sens_dev]:
         val = values[sens_dev][fld_name]
@@ -0,0 +1,228 @@
+# Prometheus-style metrics, served as text by the /metrics route.
+# Small on purpose: counters, gauges and histograms with optional labels, and nothing else.
+# Recording a value costs a lock and a few additions (about a microsecond on a Pi),
+# far below 1% of a request that fetches, parses and renders.
+import abc
+import bisect
+import datetime as dt
+import os
+import resource
+import threading
+import time
+
+# seconds: upstream fetches take 0.1-10 s, parsing and rendering take 0.1-100 ms
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REGISTRY = []
+
+def _label_str(labelnames, values, extra=''):
+    pairs = ['{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')) for n,v in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class _Metric(abc.ABC):
+    kind = ''
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        pass
+
+    def _default(self):
+        return self.labels()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc), '# TYPE {} {}'.format(self.name, self.kind)]
+        for values,child in sorted(self.children.items()):
+            lines.extend(child.render(self.name, self.labelnames, values))
+        return lines
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self, name, labelnames, values):
+        return ['{}{} {}'.format(name, _label_str(labelnames, values), self.value)]
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.func = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, func):
+        # value is computed when /metrics is read, nothing is done per request
+        self.func = func
+
+    def render(self, name, labelnames, values):
+        value = self.func() if self.func else self.value
+        return ['{}{} {}'.format(name, _label_str(labelnames, values), value)]
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, func):
+        self._default().set_function(func)
+
+class _DailyCounterChild(_CounterChild):
+    '''
+    Counter that starts from zero every local day.
+    '''
+    def __init__(self):
+        _CounterChild.__init__(self)
+        self.day = dt.date.today()
+
+    def inc(self, amount=1):
+        with self.lock:
+            today = dt.date.today()
+            if today != self.day:
+                self.day = today
+                self.value = 0.0
+            self.value += amount
+
+    def render(self, name, labelnames, values):
+        if dt.date.today() != self.day:
+            return ['{}{} 0.0'.format(name, _label_str(labelnames, values))]
+        return _CounterChild.render(self, name, labelnames, values)
+
+class DailyCounter(Counter):
+    kind = 'gauge'  # it goes back to zero at midnight, so to Prometheus it's a gauge
+
+    def _new_child(self):
+        return _DailyCounterChild()
+
+class _Timer:
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.child.observe(time.perf_counter() - self.t0)
+        return False
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def render(self, name, labelnames, values):
+        lines = []
+        total = 0
+        for bound,count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            le = 'le="{}"'.format('+Inf' if bound == float('inf') else bound)
+            lines.append('{}_bucket{} {}'.format(name, _label_str(labelnames, values, le), total))
+        lines.append('{}_sum{} {}'.format(name, _label_str(labelnames, values), self.sum))
+        lines.append('{}_count{} {}'.format(name, _label_str(labelnames, values), total))
+        return lines
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        _Metric.__init__(self, name, doc, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # not Linux: peak RSS is the best we have (KB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def render():
+    '''
+    :return: all metrics in Prometheus text exposition format
+    '''
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# The metrics of this app. Modules import metrics and record into these.
+upstream_fetch = Histogram('wx_upstream_fetch_seconds', 'Forecast provider fetch latency', ['provider'])
+json_parse = Histogram('wx_json_parse_seconds', 'Time to decode upstream JSON')
+dataparse = Histogram('wx_dataparse_seconds', 'DataParse construction time', ['kind'])
+template_render = Histogram('wx_template_render_seconds', 'Jinja2 template render time', ['template'])
+plot_render = Histogram('wx_plot_render_seconds', 'Plot render time', ['format'])
+sensor_ingest = Histogram('wx_sensor_ingest_seconds', 'Sensor log read and parse time')
+static_export = Histogram('wx_static_export_seconds', 'Time to render the exported pages, see static_export.py')
+cache_hits = Counter('wx_cache_hits_total', 'Cache hits', ['cache'])
+cache_misses = Counter('wx_cache_misses_total', 'Cache misses', ['cache'])
+cache_errors = Counter('wx_cache_errors_total', 'Failed shared cache operations, served as misses', ['backend'])
+upstream_errors = Counter('wx_upstream_errors_total', 'Failed or refused forecast fetches', ['provider'])
+api_calls = Counter('wx_api_calls_total', 'Forecast provider calls', ['provider'])
+static_export_files = Counter('wx_static_export_files_total', 'Exported files written because they changed')
+api_calls_today = DailyCounter('wx_api_calls_today', 'Forecast provider calls since local midnight', ['provider'])
+# the OpenWeather call budget, see quota.py
+api_budget = Gauge('wx_api_budget_calls', 'Billed calls allowed in any 24 hours')
+api_calls_24h = Gauge('wx_api_calls_24h', 'Billed calls in the last 24 hours')
+api_projected_calls = Gauge('wx_api_projected_calls', 'Billed calls expected in the next 24 hours')
+api_projected_cost = Gauge('wx_api_projected_cost', 'Cost of the expected calls beyond the free allowance')
+refresh_interval = Gauge('wx_refresh_interval_seconds', 'Age at which a forecast is fetched again', ['location'])
+location_raw_keys = Gauge('wx_location_raw_keys', 'Different lon_lat strings snapped to one location key', ['location'])
+fragment_hit_ratio = Gauge('wx_fragment_hit_ratio', 'Share of forecast DIVs served from the fragment cache')
+sensor_store_size = Gauge('wx_sensor_store_points', 'Sensor values held in memory')
+process_rss = Gauge('wx_process_rss_bytes', 'Resident set size of this process')
+process_rss.set_function(rss_bytes)
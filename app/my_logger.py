@@ -1,17 +1,27 @@
 # Logging the way we like it.
 
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import threading
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 """
-This module generates log files that have a max length of 50K bytes.
+This module generates log files that have a max length of 400K bytes.
 It uses RotatingFileHandler and creates no more than 3 backup files;
-that means that when the file reaches 50K bytes, it is renamed and
+that means that when the file reaches 400K bytes, it is renamed and
 a new logfile is opened.
 Exampe: you name the file "myapp.log". Backup files will be named:
 myapp.log.1, myapp.log.2, myapp.log.3. You can change the number of backups
 by editing this code.
 
+Every module logs to the same file, so there is one RotatingFileHandler per file, owned by
+a QueueListener thread. Loggers only put records on an unbounded queue, which never blocks,
+so request threads never wait on file I/O or rotation. Records are formatted by the writer
+thread, so pass arguments %-style and let logging do the work only when the level is enabled:
+    logger.debug('calc_scale: vals= %s,%s', y0, y1)      # not '...'.format(y0, y1)
+
 Explanation of logger levels.
 Specify level=logging.CRITICAL, etc.
 Each level includes messages from the levels before it. So specifying WARNING will also
@@ -19,9 +29,77 @@ output CRITICAL and ERROR messages to the logfile.
 DEBUG is most wordy and should be turned off in production runs.
 Print to log file using logger.info('message') or logger.debug or logger.warning, etc.
 When level=logging.INFO, any time the code runs logger.debug, you will not get that message.
+The level of each module can be set in Config.log_levels, e.g. {'sensor_in': 'INFO'},
+which overrides the level passed to setup_logger.
+The WX_LOG_FILE environment variable sends every logger to that file instead; the benchmarks
+use it so they don't write ow.log into the repository.
+
+In loops that run for every line or value, wrap the logger so only 1 in N messages is written:
+    hot_logger = my_logger.sampled(logger, every=100)
 """
 
 defFormatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s : %(message)s')
+
+# types that are safe to format later, in the writer thread
+_IMMUTABLE = (str, int, float, bool, type(None), bytes)
+
+class _LazyQueueHandler(QueueHandler):
+    '''
+    QueueHandler that leaves formatting to the writer thread.
+    Arguments that could change before the writer gets to them (lists, dicts, objects)
+    are turned into the message string now, as QueueHandler normally does for everything.
+    '''
+    def prepare(self, record):
+        if record.exc_info or record.stack_info:
+            return QueueHandler.prepare(self, record)
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(a, _IMMUTABLE) for a in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+class _LogFile:
+    '''
+    The queue, writer thread and file handler for one log file.
+    '''
+    def __init__(self, log_file, formatter):
+        self.log_file = log_file
+        self.formatter = formatter
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = _LazyQueueHandler(self.queue)
+        self.start()
+
+    def start(self):
+        file_handler = RotatingFileHandler(self.log_file, maxBytes=400000, backupCount=3)
+        file_handler.setFormatter(self.formatter)
+        self.listener = QueueListener(self.queue, file_handler, respect_handler_level=False)
+        self.listener.start()
+
+    def restart(self):
+        # after fork the writer thread is gone, but records may already be queued
+        self.queue = queue.SimpleQueue()
+        self.queue_handler.queue = self.queue
+        self.start()
+
+    def stop(self):
+        try:
+            self.listener.stop()
+        except AttributeError:
+            pass    # never started or already stopped
+
+_log_files = {}     # absolute log file name to _LogFile
+_lock = threading.Lock()
+
+def _level_for(name, level):
+    try:
+        import Config
+        level = getattr(Config, 'log_levels', {}).get(name, level)
+    except ImportError:
+        pass
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    return level
+
 def setup_logger(name, log_file, formatter=defFormatter, level=logging.INFO):
     """
     Setup as many loggers as you want
@@ -31,9 +109,52 @@ def setup_logger(name, log_file, formatter=defFormatter, level=logging.INFO):
     :param level: standard logger levels are CRITICAL, ERROR, WARNING, INFO, DEBUG.
     :return: the logger. Use it like this: logger.info('message')
     """
-    handler = RotatingFileHandler(log_file, maxBytes=400000, backupCount=3)
-    handler.setFormatter(formatter)
+    path = os.path.abspath(os.environ.get('WX_LOG_FILE') or log_file)
+    with _lock:
+        log = _log_files.get(path)
+        if log is None:
+            log = _log_files[path] = _LogFile(path, formatter)
     logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
+    logger.setLevel(_level_for(name, level))
+    if log.queue_handler not in logger.handlers:
+        logger.addHandler(log.queue_handler)
     return logger
+
+def _restart_after_fork():
+    for log in _log_files.values():
+        log.restart()
+
+def shutdown():
+    '''
+    Write out queued records and stop the writer threads.
+    '''
+    for log in _log_files.values():
+        log.stop()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_after_fork)
+atexit.register(shutdown)
+
+class sampled:
+    '''
+    Wraps a logger so each message (by its format string) is written once every "every" calls.
+    The count is kept per format string, so different call sites are sampled separately.
+    '''
+    def __init__(self, logger, every=100):
+        self.logger = logger
+        self.every = every
+        self.counts = {}
+
+    def _log(self, level, msg, args, kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        n = self.counts.get(msg, 0)
+        self.counts[msg] = n + 1
+        if n % self.every == 0:
+            self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self._log(logging.DEBUG, msg, args, kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self._log(logging.INFO, msg, args, kwargs)
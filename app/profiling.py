@@ -0,0 +1,131 @@
+# Opt-in per-request profiling with cProfile.
+# Enabled for every request by Config.profile_requests, or for one request when it carries
+# a signature made with Config.profile_secret, as the query param "profile" or the header X-Profile:
+#   python profiling.py /now        prints the signature for route /now
+#   http://pi/now?profile=<signature>
+# Each capture is written to Config.profile_dir as a .prof file (open it with pstats or snakeviz)
+# and a .txt summary sorted by cumulative time. Only the newest Config.profile_keep are kept.
+# /debug/profiles lists them.
+# When neither setting is on, install() registers nothing, so there is no cost at all.
+import cProfile
+import datetime as dt
+import glob
+import hashlib
+import hmac
+import io
+import os
+import pstats
+import sys
+
+from flask import g, request, abort, send_from_directory
+
+import Config
+import logging
+import my_logger
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+def sign(path):
+    '''
+    :param path: request path such as '/now'
+    :return: hex signature that enables profiling of that path
+    '''
+    secret = Config.profile_secret
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return hmac.new(secret, path.encode(), hashlib.sha256).hexdigest()[:32]
+
+def _signed():
+    if not Config.profile_secret:
+        return False
+    sig = request.args.get('profile') or request.headers.get('X-Profile')
+    # bytes, since compare_digest refuses str with non-ASCII characters
+    return bool(sig) and hmac.compare_digest(sig.encode(), sign(request.path).encode())
+
+def _start_profile():
+    if request.path.startswith('/debug/profiles'):
+        return  # looking at the captures would push them out
+    if Config.profile_requests or _signed():
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def _stop_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    try:
+        save(profiler, request.path)
+    except OSError as e:
+        logger.error('profiling: could not save profile: %s', e)
+    return response
+
+def save(profiler, path):
+    '''
+    Write the capture and delete the oldest ones beyond Config.profile_keep.
+    :return: base file name of the capture, without extension
+    '''
+    os.makedirs(Config.profile_dir, exist_ok=True)
+    route = path.strip('/').replace('/', '_') or 'root'
+    name = '{}_{}_{}'.format(dt.datetime.now().strftime('%Y%m%d-%H%M%S-%f'), os.getpid(), route)
+    base = os.path.join(Config.profile_dir, name)
+    profiler.dump_stats(base + '.prof')
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(40)
+    with open(base + '.txt', 'w') as f:
+        f.write(summary.getvalue())
+    for old in list_profiles()[Config.profile_keep:]:
+        for ext in ('.prof', '.txt'):
+            try:
+                os.remove(os.path.join(Config.profile_dir, old + ext))
+            except OSError:
+                pass
+    logger.info('profiling: saved %s', base)
+    return name
+
+def list_profiles():
+    '''
+    :return: capture names, newest first
+    '''
+    files = glob.glob(os.path.join(Config.profile_dir, '*.prof'))
+    return sorted((os.path.basename(f)[:-5] for f in files), reverse=True)
+
+def _file_link(fname):
+    '''
+    :return: URL of a capture file, signed when the secret is what lets it be fetched
+    '''
+    path = '/debug/profiles/' + fname
+    if Config.profile_secret and not Config.profile_requests:
+        return '{}?profile={}'.format(path, sign(path))
+    return path
+
+def profiles_index():
+    if Config.profile_secret and not Config.profile_requests and not _signed():
+        abort(404)
+    rows = ['<tr><td>{}</td><td><a href="{}">summary</a></td><td><a href="{}">.prof</a></td></tr>'.format(
+            name, _file_link(name + '.txt'), _file_link(name + '.prof')) for name in list_profiles()]
+    return '<html><body><h3>Profiles in {}</h3><table>{}</table></body></html>'.format(Config.profile_dir, ''.join(rows))
+
+def profile_file(fname):
+    if Config.profile_secret and not Config.profile_requests and not _signed():
+        abort(404)
+    if not fname.endswith(('.prof', '.txt')):
+        abort(404)
+    return send_from_directory(os.path.abspath(Config.profile_dir), fname)
+
+def install(app):
+    '''
+    Register the profiling hooks and /debug/profiles, but only if profiling is configured.
+    '''
+    if not Config.profile_requests and not Config.profile_secret:
+        return False
+    app.before_request(_start_profile)
+    app.after_request(_stop_profile)
+    app.add_url_rule('/debug/profiles', 'profiles_index', profiles_index)
+    app.add_url_rule('/debug/profiles/<fname>', 'profile_file', profile_file)
+    logger.info('profiling: installed, every request=%s', Config.profile_requests)
+    return True
+
+if __name__ == '__main__':
+    # print the signature to append to a URL
+    for path in sys.argv[1:]:
+        print('{}?profile={}'.format(path, sign(path)))
@@ -0,0 +1,359 @@
+# Forecast providers.
+# Every provider returns a ForecastBundle: the forecast normalized to the layout of an
+# OpenWeather OneCall response, which is what the DataParse classes in OpenWeatherProvider read.
+#   {'current': {...}, 'hourly': [{...}, ...], 'daily': [{...}, ...]}
+# Values are metric (°C, m/s, mb), times are unix seconds, 'weather' is a list holding one dict
+# with 'id', 'main', 'description' and 'icon' (an OpenWeather icon name, since the templates
+# fetch icons from openweathermap.org).
+#
+# OpenWeatherSource can also fetch the current conditions alone, leaving out the hourly and daily
+# forecasts with the OneCall exclude parameter; get_wx_all merges them into the cached bundle, and
+# ForecastBundle.sections says when each part was fetched.
+#
+# HedgedProvider wraps two providers: if the primary has not answered within its recent p95
+# latency, the secondary is asked as well and whichever answers first is used.
+import abc
+import asyncio
+import collections
+import datetime as dt
+import time
+from urllib.request import urlopen, Request
+
+import Config
+import ApiKeys
+import async_fetch
+import logging
+import metrics
+import my_logger
+import quota
+import selective_json
+import shared_cache
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+CURRENT_SECTIONS = ('current', 'minutely')    # what OpenWeatherSource.fetch_current brings
+
+class ForecastBundle(dict):
+    '''
+    Normalized forecast. It is a dict, so it can be handed to DataParse like raw OneCall JSON.
+    Attributes:
+    provider: name of the provider that produced it
+    lon_lat: (lon, lat) floats of the request
+    fetched: unix time when the data was received, the newest part of it after a merge
+    sections: dict of section ('current', 'hourly', 'daily', 'minutely') to unix time it was received
+    stale: True when served from cache because the provider could not be reached
+    '''
+    def __init__(self, current, hourly, daily, provider='', lon_lat=None, fetched=None, minutely=None, sections=None):
+        dict.__init__(self, current=current, hourly=hourly, daily=daily)
+        if minutely is not None:
+            self['minutely'] = minutely     # OneCall nowcast, only with Config.fetch_minutely
+        self.provider = provider
+        self.lon_lat = lon_lat
+        self.fetched = fetched if fetched else time.time()
+        self.sections = sections if sections else {section: self.fetched for section in self}
+        self.stale = False
+
+    def as_stale(self):
+        '''
+        :return: a copy marked stale, the cached original is left alone
+        '''
+        bundle = ForecastBundle(self['current'], self['hourly'], self['daily'], provider=self.provider,
+                                lon_lat=self.lon_lat, fetched=self.fetched, minutely=self.get('minutely'),
+                                sections=self.sections)
+        bundle.stale = True
+        return bundle
+
+    def merge(self, part):
+        '''
+        :param part: ForecastBundle holding only some sections, e.g. from OpenWeatherSource.fetch_current
+        :return: new bundle with the sections of part replacing those of self
+        '''
+        sections = dict(self.sections)
+        sections.update(part.sections)
+        data = {section: self.get(section) for section in self.sections}
+        data.update((section, part.get(section)) for section in part.sections)
+        return ForecastBundle(data['current'], data['hourly'], data['daily'], provider=part.provider,
+                              lon_lat=self.lon_lat, fetched=max(sections.values()),
+                              minutely=data.get('minutely'), sections=sections)
+
+    def fresh(self, max_age, current_age=None, now=None):
+        '''
+        :param max_age: seconds, the hourly and daily forecasts
+        :param current_age: seconds, the current conditions and nowcast; default max_age
+        :return: True when every section is younger than its age
+        '''
+        now = now or time.time()
+        if current_age is None:
+            current_age = max_age
+        return all(now - t < (current_age if section in CURRENT_SECTIONS else max_age)
+                   for section,t in self.sections.items())
+
+    def to_dict(self):
+        '''
+        :return: plain data for shared_cache
+        '''
+        return {'data': dict(self), 'provider': self.provider, 'fetched': self.fetched,
+                'lon_lat': list(self.lon_lat) if self.lon_lat else None, 'sections': self.sections}
+
+    @classmethod
+    def from_dict(cls, d):
+        data = d['data']
+        lon_lat = tuple(d['lon_lat']) if d['lon_lat'] else None
+        return cls(data['current'], data['hourly'], data['daily'], provider=d['provider'],
+                   lon_lat=lon_lat, fetched=d['fetched'], minutely=data.get('minutely'),
+                   sections=d.get('sections'))
+
+shared_cache.register_type('bundle', ForecastBundle, ForecastBundle.to_dict, ForecastBundle.from_dict)
+
+def parse_lon_lat(lon_lat=None):
+    '''
+    :param lon_lat: "lon,lat" string from request args, a (lon,lat) pair, or None for Config.location
+    :return: (lon, lat) as floats
+    '''
+    if not lon_lat:
+        return float(Config.location[0]), float(Config.location[1])
+    if isinstance(lon_lat, str):
+        lon_lat = lon_lat.split(',')
+    return float(lon_lat[0]), float(lon_lat[1])
+
+class ForecastProvider(abc.ABC):
+    '''
+    Child classes implement fetch_async, which runs on the async_fetch event loop
+    and returns a ForecastBundle.
+    '''
+    name = ''
+    billed = False  # calls count against quota.budget
+    tiered = False  # has fetch_current
+
+    @abc.abstractmethod
+    async def fetch_async(self, lon, lat):
+        pass
+
+    def count_call(self):
+        # every upstream request counts against the API allowance
+        metrics.api_calls.labels(self.name).inc()
+        metrics.api_calls_today.labels(self.name).inc()
+        if self.billed:
+            quota.budget.record_call()
+
+    def fetch(self, lon, lat, timeout=None):
+        '''
+        Sync wrapper for Flask routes.
+        '''
+        if timeout is None:
+            timeout = Config.fetch_timeout
+        return async_fetch.run(self.fetch_async(lon, lat), timeout)
+
+class OpenWeatherSource(ForecastProvider):
+    '''
+    OpenWeather OneCall. Its response already is the normalized layout.
+    '''
+    name = 'openweather'
+    billed = True
+    tiered = True
+
+    def url(self, lon, lat, exclude='minutely'):
+        return Config.openweatherPrefix + 'onecall?lat={lat}&lon={lon}&appid={API_key}&exclude={exclude}&units=metric'.format(
+            lat=lat, lon=lon, API_key=ApiKeys.openweather_key, exclude=exclude)
+
+    def normalize(self, raw, lon, lat, exclude='minutely'):
+        '''
+        :param exclude: as in url(); the sections left out are not in the bundle's sections
+        '''
+        fetched = time.time()
+        sections = {section: fetched for section in ('current', 'hourly', 'daily', 'minutely')
+                    if section not in exclude.split(',')}
+        return ForecastBundle(raw.get('current', {}), raw.get('hourly', []), raw.get('daily', []),
+                              provider=self.name, lon_lat=(lon, lat), fetched=fetched,
+                              minutely=raw.get('minutely'), sections=sections)
+
+    async def fetch_async(self, lon, lat, exclude='minutely'):
+        self.count_call()
+        body = await async_fetch.fetch(self.url(lon, lat, exclude))
+        with metrics.json_parse.time():
+            raw = selective_json.loads(body)
+        return self.normalize(raw, lon, lat, exclude)
+
+    def fetch(self, lon, lat, timeout=None, exclude='minutely'):
+        if timeout is None:
+            timeout = Config.fetch_timeout
+        if Config.use_async_fetch:
+            return async_fetch.run(self.fetch_async(lon, lat, exclude), timeout)
+        self.count_call()
+        with urlopen(Request(self.url(lon, lat, exclude)), timeout=timeout) as response:
+            # with ijson the body is parsed as it arrives, so this times the download too
+            with metrics.json_parse.time():
+                raw = selective_json.load(response)
+        return self.normalize(raw, lon, lat, exclude)
+
+    def fetch_current(self, lon, lat, timeout=None):
+        '''
+        Current conditions only, and the minutely nowcast with Config.fetch_minutely: a few percent of the
+        bytes of a full response. It is billed as a full call.
+        :return: ForecastBundle with empty hourly and daily, to merge into a cached one
+        '''
+        exclude = 'hourly,daily' if Config.fetch_minutely else 'hourly,daily,minutely'
+        return self.fetch(lon, lat, timeout, exclude)
+
+selective_json.register_fields('minutely', ('dt', 'precipitation'))
+
+class NwsSource(ForecastProvider):
+    '''
+    US National Weather Service, api.weather.gov. No API key is needed.
+    The hourly forecast also supplies 'current', since the NWS has no forecast for "now".
+    Daily records are made from the day/night periods of the 7 day forecast.
+    Sunrise and sunset are not available; DataParse treats them as optional.
+    '''
+    name = 'nws'
+    prefix = 'https://api.weather.gov/'
+    # NWS icon names (last part of the icon URL path) to OpenWeather icon and condition id
+    ICONS = {
+        'skc': ('01', 800), 'few': ('02', 801), 'sct': ('03', 802), 'bkn': ('04', 803), 'ovc': ('04', 804),
+        'wind_skc': ('01', 800), 'wind_few': ('02', 801), 'wind_sct': ('03', 802), 'wind_bkn': ('04', 803),
+        'wind_ovc': ('04', 804), 'rain': ('10', 500), 'rain_showers': ('09', 521), 'rain_showers_hi': ('09', 520),
+        'tsra': ('11', 211), 'tsra_sct': ('11', 210), 'tsra_hi': ('11', 210), 'snow': ('13', 601),
+        'rain_snow': ('13', 616), 'sleet': ('13', 611), 'fzra': ('13', 511), 'fog': ('50', 741),
+        'haze': ('50', 721), 'smoke': ('50', 711), 'dust': ('50', 761),
+    }
+    COMPASS = {'N': 0, 'NNE': 22, 'NE': 45, 'ENE': 67, 'E': 90, 'ESE': 112, 'SE': 135, 'SSE': 157,
+               'S': 180, 'SSW': 202, 'SW': 225, 'WSW': 247, 'W': 270, 'WNW': 292, 'NW': 315, 'NNW': 337}
+
+    def __init__(self):
+        self.points = {}    # (lon,lat) to forecast URLs, these never change for a location
+
+    @classmethod
+    def weather(cls, period):
+        icon_url = period.get('icon') or ''
+        icon_name = icon_url.split('?')[0].rstrip('/').split('/')[-1].split(',')[0]
+        icon,wx_id = cls.ICONS.get(icon_name, ('03', 802))
+        day_night = 'd' if period.get('isDaytime', True) else 'n'
+        text = period.get('shortForecast', '')
+        return [{'id': wx_id, 'main': text.split(' ')[-1] if text else '', 'description': text.lower(), 'icon': icon+day_night}]
+
+    @classmethod
+    def wind(cls, period):
+        # windSpeed looks like "10 km/h" or "5 to 15 km/h" when units=si
+        words = (period.get('windSpeed') or '0').split()
+        numbers = [float(w) for w in words if w.replace('.', '', 1).isdigit()]
+        speed = numbers[-1] / 3.6 if numbers else 0.0
+        return speed, cls.COMPASS.get(period.get('windDirection'), 0)
+
+    @classmethod
+    def record(cls, period):
+        wind_speed,wind_deg = cls.wind(period)
+        pop = (period.get('probabilityOfPrecipitation') or {}).get('value') or 0
+        rec = {
+            'dt': int(dt.datetime.fromisoformat(period['startTime']).timestamp()),
+            'temp': float(period['temperature']),
+            'humidity': (period.get('relativeHumidity') or {}).get('value'),
+            'dew_point': (period.get('dewpoint') or {}).get('value'),
+            'wind_speed': wind_speed,
+            'wind_deg': wind_deg,
+            'pop': pop / 100.0,
+            'weather': cls.weather(period),
+        }
+        rec['feels_like'] = rec['temp']
+        return {k:v for k,v in rec.items() if v is not None}
+
+    @classmethod
+    def daily_records(cls, periods):
+        daily = []
+        for period in periods:
+            rec = cls.record(period)
+            if period.get('isDaytime', True) or not daily:
+                rec['temp'] = {'day': rec['temp'], 'max': rec['temp'], 'min': rec['temp']}
+                rec['feels_like'] = {'day': rec['feels_like']}
+                daily.append(rec)
+            else:
+                # night period completes the day before it
+                day = daily[-1]
+                day['temp']['night'] = rec['temp']
+                day['temp']['min'] = min(day['temp']['min'], rec['temp'])
+                day['feels_like']['night'] = rec['feels_like']
+                day['pop'] = max(day.get('pop', 0), rec.get('pop', 0))
+        return daily
+
+    def normalize(self, hourly_json, daily_json, lon, lat):
+        hourly = [self.record(p) for p in hourly_json['properties']['periods']]
+        daily = self.daily_records(daily_json['properties']['periods'])
+        current = dict(hourly[0]) if hourly else {}
+        return ForecastBundle(current, hourly, daily, provider=self.name, lon_lat=(lon, lat))
+
+    async def fetch_async(self, lon, lat):
+        key = (round(lon, 4), round(lat, 4))
+        if key not in self.points:
+            self.count_call()
+            points = await async_fetch.fetch_json('{}points/{:.4f},{:.4f}'.format(self.prefix, lat, lon))
+            self.points[key] = (points['properties']['forecastHourly'], points['properties']['forecast'])
+        hourly_url,daily_url = self.points[key]
+        self.count_call()
+        self.count_call()
+        hourly_json,daily_json = await asyncio.gather(async_fetch.fetch_json(hourly_url + '?units=si'),
+                                                      async_fetch.fetch_json(daily_url + '?units=si'))
+        return self.normalize(hourly_json, daily_json, lon, lat)
+
+class HedgedProvider(ForecastProvider):
+    '''
+    Ask the primary. If it has not answered within hedge_delay (p95 of its recent latencies),
+    or it fails, ask the secondary too. The first good answer wins.
+    '''
+    def __init__(self, primary, secondary, quantile=0.95, window=100, min_samples=10, default_delay=2.0):
+        self.primary = primary
+        self.secondary = secondary
+        self.name = '{}+{}'.format(primary.name, secondary.name)
+        self.quantile = quantile
+        self.latencies = collections.deque(maxlen=window)  # seconds, successful primary fetches
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.hedged = 0     # number of times the secondary was asked
+
+    def hedge_delay(self):
+        if len(self.latencies) < self.min_samples:
+            return self.default_delay
+        samples = sorted(self.latencies)
+        return samples[min(len(samples)-1, int(self.quantile * len(samples)))]
+
+    async def fetch_async(self, lon, lat):
+        t0 = time.monotonic()
+
+        def record_latency(task):
+            # the primary runs to completion even if the secondary won, so slow answers count too
+            if not task.cancelled() and task.exception() is None:
+                self.latencies.append(time.monotonic() - t0)
+
+        primary = asyncio.ensure_future(self.primary.fetch_async(lon, lat))
+        primary.add_done_callback(record_latency)
+        delay = self.hedge_delay()
+        done,_ = await asyncio.wait({primary}, timeout=delay)
+        if done and primary.exception() is None:
+            return primary.result()
+        logger.info('HedgedProvider: primary %s after %.2fs, asking %s',
+                    'failed' if done else 'slow', time.monotonic() - t0, self.secondary.name)
+        self.hedged += 1
+        secondary = asyncio.ensure_future(self.secondary.fetch_async(lon, lat))
+        pending = {secondary} if done else {primary, secondary}
+        error = primary.exception() if done else None
+        while pending:
+            done,pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if secondary in pending:
+                        secondary.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+PROVIDERS = {'openweather': OpenWeatherSource, 'nws': NwsSource}
+_provider = None
+
+def get_provider():
+    '''
+    The provider configured by Config.forecast_provider, hedged with Config.hedge_provider if set.
+    '''
+    global _provider
+    if _provider is None:
+        provider = PROVIDERS[Config.forecast_provider]()
+        if Config.hedge_provider:
+            provider = HedgedProvider(provider, PROVIDERS[Config.hedge_provider](),
+                                      default_delay=Config.hedge_default_delay)
+        _provider = provider
+    return _provider
@@ -0,0 +1,251 @@
+# OpenWeather call budget.
+# OneCall 3.0 bills every call beyond the free allowance, Config.api_daily_budget calls a day, and
+# without a budget the calls follow the page views of all the kiosks. Calls are counted over the
+# last 24 hours and saved to Config.quota_path now and then, so a restart doesn't forget them.
+# Calls are counted on the async_fetch loop, so saving is left to get_wx_all in the request thread.
+# get_wx_all asks refresh_interval() how old a forecast may get before it is fetched again:
+#  - the calls a day are shared between the locations by how often their pages are asked for,
+#    so a location nobody looks at doesn't use the budget of one that is on the wall all day
+#  - never more often than Config.weather_refresh, as before; what a location can't use that way
+#    goes to the others
+#  - once the last 24 hours used more than Config.quota_target of the budget, the intervals are
+#    stretched as what is left shrinks, up to Config.quota_max_refresh; pages are served from older
+#    forecasts instead of failing
+# Calls to free providers (NWS) are not counted. Pages rendered by static_export are not views; it
+# counts the homes it exports itself, see not_counting.
+import collections
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+try:
+    import fcntl    # not on Windows, where workers saving at the same moment may lose calls
+except ImportError:
+    fcntl = None
+
+import Config
+import logging
+import metrics
+import my_logger
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+DAY = 86400
+DEMAND_HALF_LIFE = 6 * 3600     # seconds, page views count half as much after this
+
+class QuotaBudget:
+    def __init__(self, daily_budget=None):
+        '''
+        :param daily_budget: calls allowed in any 24 hours, default Config.api_daily_budget
+        '''
+        self.daily_budget = daily_budget or Config.api_daily_budget
+        self.calls = collections.deque()    # unix times of the calls in the last 24 hours, oldest first
+        self.demand = {}    # location key to [page views decayed by DEMAND_HALF_LIFE, unix time of the last one]
+        self.lock = threading.Lock()
+        self.changed = False
+        self.saved_at = time.monotonic()
+        self.local = threading.local()  # 'quiet' while this thread is in not_counting
+
+    def _expire(self, now):
+        while self.calls and self.calls[0] <= now - DAY:
+            self.calls.popleft()
+
+    def record_call(self, now=None):
+        '''
+        Count one billed upstream call. This runs on the async_fetch loop, so it never touches the file.
+        '''
+        now = now or time.time()
+        with self.lock:
+            self.calls.append(now)
+            self._expire(now)
+            self.changed = True
+
+    def note_request(self, key, now=None):
+        '''
+        Count a page view for location key, whether or not it needs a call.
+        '''
+        if getattr(self.local, 'quiet', False):
+            return
+        now = now or time.time()
+        with self.lock:
+            views,seen = self.demand.get(key, (0.0, now))
+            self.demand[key] = [views * 0.5 ** ((now - seen) / DEMAND_HALF_LIFE) + 1.0, now]
+
+    @contextlib.contextmanager
+    def not_counting(self):
+        '''
+        Context manager: page views in this thread are not counted, e.g. pages rendered to be exported.
+        '''
+        self.local.quiet = True
+        try:
+            yield
+        finally:
+            self.local.quiet = False
+
+    def used(self, now=None):
+        '''
+        :return: calls in the last 24 hours
+        '''
+        now = now or time.time()
+        with self.lock:
+            self._expire(now)
+            return len(self.calls)
+
+    def _weights(self, now):
+        '''
+        :return: dict of location key to its share of the page views, locations not seen for a day left out
+        '''
+        views = {}
+        for key,(count,seen) in list(self.demand.items()):
+            if now - seen > DAY:
+                del self.demand[key]
+                continue
+            views[key] = count * 0.5 ** ((now - seen) / DEMAND_HALF_LIFE)
+        total = sum(views.values())
+        return {key: v / total for key,v in views.items()} if total else {}
+
+    def _allocation(self, now):
+        '''
+        :return: dict of location key to calls a day planned for it. Shares of Config.quota_target of the
+        budget by page views, but no more than one call per Config.weather_refresh; the rest goes to the others.
+        '''
+        most = DAY / (Config.weather_refresh * 60)
+        left = self.daily_budget * Config.quota_target
+        pending = self._weights(now)
+        calls = {}
+        while pending:
+            total = sum(pending.values())
+            full = [key for key,w in pending.items() if left * w / total >= most]
+            if not full:
+                calls.update((key, left * w / total) for key,w in pending.items())
+                break
+            for key in full:
+                calls[key] = most
+                left -= most
+                del pending[key]
+        return calls
+
+    def stretch(self, now=None):
+        '''
+        :return: factor the refresh intervals are stretched by, 1 while the last 24 hours used less than
+        Config.quota_target of the budget, growing as the rest of the budget shrinks
+        '''
+        left = max(0.0, 1.0 - self.used(now) / self.daily_budget)
+        spare = 1.0 - Config.quota_target
+        if left >= spare:
+            return 1.0
+        return spare / max(left, 1e-3)
+
+    def refresh_interval(self, key, now=None):
+        '''
+        :param key: location key, see forecast_cache.location_key
+        :return: seconds a forecast for key is used before it is fetched again
+        '''
+        now = now or time.time()
+        base = Config.weather_refresh * 60
+        with self.lock:
+            calls = self._allocation(now).get(key)
+        if calls is None:
+            interval = base     # first view of this location
+        else:
+            interval = max(base, DAY / calls) if calls > 0 else Config.quota_max_refresh
+        interval *= self.stretch(now)
+        return min(interval, max(base, Config.quota_max_refresh))
+
+    def intervals(self, now=None):
+        '''
+        :return: dict of each location seen in the last day to its refresh interval in seconds
+        '''
+        now = now or time.time()
+        with self.lock:
+            keys = list(self._weights(now))
+        return {key: self.refresh_interval(key, now) for key in keys}
+
+    def projected_calls(self, now=None):
+        '''
+        :return: calls expected in the next 24 hours: each location is fetched once per refresh interval,
+        or once per page view if it is asked for less often than that
+        '''
+        now = now or time.time()
+        total = 0.0
+        with self.lock:
+            weights = self._weights(now)
+            views = {key: self.demand[key][0] for key in weights}
+        for key in weights:
+            # decayed count over the half life is roughly the views a second right now
+            views_per_day = views[key] / (DEMAND_HALF_LIFE / math.log(2)) * DAY
+            total += min(DAY / self.refresh_interval(key, now), views_per_day)
+        return total
+
+    def projected_cost(self, now=None):
+        '''
+        :return: cost of the projected calls beyond Config.api_free_calls, at Config.api_call_price each
+        '''
+        return max(0.0, self.projected_calls(now) - Config.api_free_calls) * Config.api_call_price
+
+    def save(self, path=None):
+        '''
+        Write the calls of the last 24 hours to path (default Config.quota_path) through a temporary file
+        and rename. Calls saved by other processes are kept, so uwsgi workers share one count; the
+        read, merge and write hold a lock on path + '.lock' so two workers don't drop each other's calls.
+        '''
+        path = path or Config.quota_path
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            calls = set(self.calls)
+            self.changed = False
+            self.saved_at = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)    # released when the file is closed
+            calls.update(t for t in self._read(path) if t > now - DAY)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump({'version': 1, 'calls': sorted(calls)}, f)
+            os.replace(tmp, path)
+        with self.lock:
+            self.calls = collections.deque(sorted(calls.union(self.calls)))
+
+    def maybe_save(self):
+        '''
+        Save if a call was counted and Config.quota_save_interval seconds have passed since the last save.
+        '''
+        if self.changed and time.monotonic() - self.saved_at >= Config.quota_save_interval:
+            try:
+                self.save()
+            except OSError as e:
+                logger.error('QuotaBudget: could not save: %s', e)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)['calls']
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error('QuotaBudget: could not load %s: %s', path, e)
+            return []
+
+    def load(self, path=None):
+        '''
+        Read the calls saved by save(). A missing or damaged file counts nothing.
+        '''
+        path = path or Config.quota_path
+        now = time.time()
+        calls = sorted(t for t in self._read(path) if t > now - DAY)
+        with self.lock:
+            self.calls = collections.deque(sorted(set(calls).union(self.calls)))
+        logger.info('QuotaBudget: %s calls in the last 24 hours', len(calls))
+
+budget = QuotaBudget()
+budget.load()
+
+metrics.api_budget.set(budget.daily_budget)
+metrics.api_calls_24h.set_function(budget.used)
+metrics.api_projected_calls.set_function(lambda: round(budget.projected_calls(), 1))
+metrics.api_projected_cost.set_function(lambda: round(budget.projected_cost(), 4))
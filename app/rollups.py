@@ -0,0 +1,254 @@
+# Sensor history at 5 minute, hourly and daily resolution.
+# Every reading ingested by sensor_in updates one bucket per resolution with min, max, sum and count,
+# so keeping the rollups current costs the same for the first and the millionth reading.
+# Buckets are kept in local standard time, a fixed offset from UTC, so the hour repeated when daylight
+# time ends is counted and not taken for older readings. Daily buckets run midnight to midnight standard
+# time (1 to 1 in summer); times are shown in local time with daylight time.
+# The rollups are saved to Config.rollup_path now and then and loaded on start, and readings at or
+# before the newest one already counted for a topic are skipped, so re-reading a log counts nothing twice.
+# The history views read them, and so do the sensor plots once the log spans more than fills their width.
+#   python rollups.py old_logs/*.log       adds archived sensor logs to the saved rollups
+import datetime as dt
+import json
+import os
+import sys
+import threading
+import time
+
+import Config
+import logging
+import my_logger
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+MINUTES_5 = 300
+HOUR = 3600
+DAY = 86400
+RESOLUTIONS = (MINUTES_5, HOUR, DAY)    # seconds, finest first
+
+_EPOCH = dt.datetime(1970, 1, 1)
+STD_OFFSET = -time.timezone     # seconds east of UTC of local standard time
+
+def unix_seconds(iso_time, after=None):
+    '''
+    :param iso_time: time as written by the MQTT client, local without an offset, e.g. '2023-01-03T12:10:10'
+    :param after: unix seconds of the reading before it from the same sensor. A local time in the hour
+    repeated when daylight time ends is taken as the second pass when the first would go back before it.
+    :return: unix seconds
+    '''
+    t = dt.datetime.fromisoformat(iso_time)
+    seconds = t.timestamp()
+    if t.tzinfo is None and after is not None and seconds <= after:
+        second_pass = t.replace(fold=1).timestamp()
+        if second_pass > after:
+            seconds = second_pass
+    return seconds
+
+def standard_seconds(iso_time, after=None):
+    '''
+    :param after: as in unix_seconds, but in standard seconds
+    :return: seconds since 1970-01-01 00:00 local standard time, what the buckets are keyed on
+    '''
+    return int(unix_seconds(iso_time, None if after is None else after - STD_OFFSET)) + STD_OFFSET
+
+def to_datetime(seconds):
+    '''
+    :param seconds: standard seconds, see standard_seconds
+    :return: local time with daylight time, for display
+    '''
+    return dt.datetime.fromtimestamp(seconds - STD_OFFSET)
+
+class Rollups:
+    def __init__(self, keep=None):
+        '''
+        :param keep: dict of resolution to seconds of history kept, default Config.rollup_keep
+        '''
+        self.keep = keep if keep is not None else Config.rollup_keep
+        # (topic, field) to {resolution: {bucket start: [min, max, sum, count]}}
+        # bucket dicts are in time order, since readings arrive in time order
+        self.series = {}
+        self.newest = {}    # topic to local seconds of its newest reading counted
+        self.lock = threading.Lock()
+        self.changed = False
+        self.saved_at = time.monotonic()
+
+    def add(self, topic, values):
+        '''
+        Count one reading.
+        :param topic: MQTT topic, e.g. 'gn_home/gn-pi-zero-2/bme280/J'
+        :param values: dict from the JSON log line, with 'time' and float values
+        :return: False if the reading was skipped because it is not newer than the last one counted
+        '''
+        with self.lock:
+            t = standard_seconds(values['time'], self.newest.get(topic))
+            if t <= self.newest.get(topic, -1):
+                return False
+            self.newest[topic] = t
+            starts = [(res, t - t % res) for res in RESOLUTIONS]
+            for field,value in values.items():
+                if field in ('time', 'topic') or not isinstance(value, (int, float)):
+                    continue
+                series = self.series.get((topic, field))
+                if series is None:
+                    series = self.series[(topic, field)] = {res: {} for res in RESOLUTIONS}
+                for res,start in starts:
+                    buckets = series[res]
+                    bucket = buckets.get(start)
+                    if bucket is None:
+                        buckets[start] = [value, value, value, 1]
+                        series[res] = self._expire(buckets, start - self.keep[res], self.keep[res] // 8)
+                    else:
+                        if value < bucket[0]:
+                            bucket[0] = value
+                        if value > bucket[1]:
+                            bucket[1] = value
+                        bucket[2] += value
+                        bucket[3] += 1
+            self.changed = True
+        return True
+
+    @staticmethod
+    def _expire(buckets, cutoff, slack):
+        '''
+        :return: buckets, or a copy without the buckets older than cutoff once the oldest is older than cutoff-slack
+        '''
+        # copied rather than deleted from: iterating a dict steps over the slots of deleted keys,
+        # so next(iter()) after many deletions from the front gets slower and slower
+        if next(iter(buckets)) < cutoff - slack:
+            return {t:b for t,b in buckets.items() if t >= cutoff}
+        return buckets
+
+    def pick_resolution(self, seconds, width):
+        '''
+        :param seconds: time span to show
+        :param width: points wanted, e.g. the plot width in pixels
+        :return: the coarsest resolution that still gives width points over the span, or the finest
+        '''
+        for res in reversed(RESOLUTIONS):
+            if seconds / res >= width and self.keep[res] >= seconds:
+                return res
+        return RESOLUTIONS[0]
+
+    def history(self, topic, field, seconds, width=640, end=None):
+        '''
+        :param seconds: time span to return, ending at end (default the newest reading of topic)
+        :param width: points wanted, see pick_resolution
+        :return: (resolution, list of (bucket start datetime, min, max, mean, count))
+        '''
+        res = self.pick_resolution(seconds, width)
+        with self.lock:
+            buckets = self.series.get((topic, field), {}).get(res, {})
+            if end is None:
+                end = self.newest.get(topic, 0)
+            start = end - seconds
+            rows = [(to_datetime(t), b[0], b[1], b[2] / b[3], b[3]) for t,b in buckets.items() if start < t <= end]
+        return res, rows
+
+    def plot_series(self, topic, field, start, end, width, points):
+        '''
+        Means to plot instead of the raw readings of a span, when that is less to draw.
+        :param start: time of the first raw reading, as in the log
+        :param end: time of the last raw reading
+        :param width: points wanted, see pick_resolution
+        :param points: number of raw readings in the span
+        :return: (list of datetimes, list of means) at the coarsest resolution that still gives width points,
+        None when no resolution does with less than half as many points as the raw readings
+        '''
+        t0 = standard_seconds(start)
+        t1 = standard_seconds(end, t0)
+        res = self.pick_resolution(t1 - t0, width)
+        if (t1 - t0) / res < width or (t1 - t0) / res * 2 > points:
+            return None
+        tz = dt.datetime.fromisoformat(start).tzinfo    # so they can be drawn with the raw readings of other topics
+        with self.lock:
+            buckets = self.series.get((topic, field), {}).get(res, {})
+            rows = [(t, b[2] / b[3]) for t,b in buckets.items() if t0 - res < t <= t1]
+        if not rows:
+            return None
+        return [to_datetime(t).replace(tzinfo=tz) for t,_ in rows], [mean for _,mean in rows]
+
+    def topics(self):
+        '''
+        :return: dict of topic to sorted list of fields
+        '''
+        with self.lock:
+            fields = {}
+            for topic,field in self.series:
+                fields.setdefault(topic, []).append(field)
+        return {topic: sorted(f) for topic,f in fields.items()}
+
+    def save(self, path=None):
+        '''
+        Write the rollups to path (default Config.rollup_path) through a temporary file and rename.
+        '''
+        path = path or Config.rollup_path
+        with self.lock:
+            data = {'version': 2, 'newest': self.newest,
+                    'series': [[topic, field, {str(res): [[t] + b for t,b in buckets.items()]
+                                               for res,buckets in series.items()}]
+                               for (topic,field),series in self.series.items()]}
+            self.changed = False
+            self.saved_at = time.monotonic()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    def maybe_save(self):
+        '''
+        Save if something changed and Config.rollup_save_interval seconds have passed since the last save.
+        '''
+        if self.changed and time.monotonic() - self.saved_at >= Config.rollup_save_interval:
+            try:
+                self.save()
+            except OSError as e:
+                logger.error('Rollups: could not save: %s', e)
+
+    def load(self, path=None):
+        '''
+        Read rollups saved by save(). A missing or damaged file leaves them empty.
+        :return: True if loaded
+        '''
+        path = path or Config.rollup_path
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.error('Rollups: could not load %s: %s', path, e)
+            return False
+        # version 1 kept local time with daylight time; from the start of a day it is the same
+        rekey = _from_local if data.get('version', 1) == 1 else lambda t, res: t
+        with self.lock:
+            self.newest = {topic: rekey(t, 0) for topic,t in data['newest'].items()}
+            self.series = {}
+            for topic,field,by_res in data['series']:
+                self.series[(topic, field)] = {res: {rekey(row[0], res): row[1:] for row in by_res.get(str(res), [])}
+                                               for res in RESOLUTIONS}
+        logger.info('Rollups: loaded %s series from %s', len(self.series), path)
+        return True
+
+def _from_local(t, res):
+    '''
+    :param t: seconds since 1970 local time with daylight time, the keys of version 1
+    :return: standard seconds; daily buckets keep their key, the start of the same day
+    '''
+    if res == DAY:
+        return t
+    return int((_EPOCH + dt.timedelta(seconds=t)).timestamp()) + STD_OFFSET
+
+store = Rollups()
+store.load()
+
+if __name__ == '__main__':
+    # backfill from archived logs, oldest first
+    for fname in sorted(sys.argv[1:]):
+        n = 0
+        with open(fname) as f:
+            for line in f:
+                values = json.loads(line)
+                values = {k: (v if k in ('time', 'topic') else float(v)) for k,v in values.items()}
+                n += store.add(values['topic'], values)
+        print('{}: {} readings added'.format(fname, n))
+    store.save()
@@ -0,0 +1,92 @@
+# Decode an OpenWeather OneCall response keeping only the fields that are used.
+# A response holds about 60 records of 15 to 25 fields, plus 'alerts' when there are any, and the
+# DataParse tables don't read all of them: moon times and phase, the daily summary, gusts and rain
+# of the forecasts. OpenWeatherProvider registers the fields of its tables here, by section:
+# 'current', 'hourly' or 'daily'. json.loads drops the others as each record is finished, so they are
+# garbage at once instead of living as long as the cached forecast, about 20% of it. With Config.stream_json and ijson installed (pip install ijson)
+# the response is parsed as it is read and unused fields are never built; that is slower for a
+# OneCall response of 20-30 KB (python -m bench.bench_decode), it pays off only for much larger ones.
+# A section with no registered fields keeps every field, so this is json.loads until something registers.
+import io
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+import Config
+
+SECTIONS = ('current', 'hourly', 'daily', 'minutely')
+RECORDS = {'current': 'current', 'hourly.item': 'hourly', 'daily.item': 'daily', 'minutely.item': 'minutely'}   # ijson prefix to section
+_fields = {}    # section to set of record keys kept
+_any_section = set()    # keys kept in some section
+
+def register_fields(section, keys):
+    '''
+    :param section: 'current', 'hourly', 'daily' or 'minutely'
+    :param keys: record keys that are read, e.g. 'temp' or 'weather'; the whole value of a key is kept
+    '''
+    _fields.setdefault(section, set()).update(keys)
+    _any_section.update(keys)
+
+def _stream(f):
+    '''
+    :param f: file-like object returning bytes, e.g. a urlopen response
+    :return: dict of section to record (current) or list of records (hourly, daily)
+    '''
+    result = {}
+    builder = None
+    for prefix,event,value in ijson.parse(f, use_float=True):
+        if builder is None:
+            if event != 'start_map' or prefix not in RECORDS:
+                continue
+            section = RECORDS[prefix]
+            keep = _fields.get(section)
+            builder = ijson.ObjectBuilder()
+            depth = 0
+            skipping = False
+        if depth == 1 and event in ('map_key', 'end_map'):
+            skipping = event == 'map_key' and keep is not None and value not in keep
+        if not skipping:
+            builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                if section == 'current':
+                    result[section] = builder.value
+                else:
+                    result.setdefault(section, []).append(builder.value)
+                builder = None
+    return result
+
+def _prune(obj):
+    '''
+    json.loads object_hook. Records are the objects with a 'dt'; nested objects such as 'temp' are
+    kept whole. The hook cannot tell which section a record is in, so records keep the fields of all sections.
+    '''
+    if 'dt' in obj and _any_section:
+        return {k:v for k,v in obj.items() if k in _any_section}
+    return obj
+
+def loads(body):
+    '''
+    :param body: bytes or str of a OneCall response
+    :return: dict with the sections found, records holding only the registered fields
+    '''
+    if Config.stream_json and ijson is not None:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        return _stream(io.BytesIO(body))
+    raw = json.loads(body, object_hook=_prune)
+    return {section: raw[section] for section in SECTIONS if section in raw}
+
+def load(f):
+    '''
+    :param f: file-like object returning bytes, read as it is parsed with Config.stream_json
+    '''
+    if Config.stream_json and ijson is not None:
+        return _stream(f)
+    return loads(f.read())
@@ -1,13 +1,94 @@
+import collections
+import datetime as dt
 import json
+import os
+import threading
+import time
+from types import MappingProxyType
 import logging
+import metrics
+import rollups
 import my_logger
 logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+hot_logger = my_logger.sampled(logger)    # for messages written for every log line
 
 # values found in the MQTT JSON messages
 # there are more sensor values, but these are the ones we want
 SENSOR_NAMES = ['time', 'pm25', 'temp_c', 'humidity', 'pressure']
 
-sensor_devs = {}    # collection of SensorVals indexed by MQTT topic name
+_log_pos = (None, None, 0)  # (file name, inode, offset of the first byte not read yet) of the log in the store
+_ingest_lock = threading.Lock()     # held by the one writer: read_log, reset
+
+# With threads in pi_uwsgi.ini two requests can read the log and draw the plot at once.
+# So readings are written by one thread at a time, into objects no reader sees, and readers get
+# snapshots: read-only objects that are replaced, never changed. Taking a snapshot is reading one
+# attribute, no lock, and it stays consistent however long the reader uses it.
+
+class LatestIndex:
+    '''
+    Newest value of each field of each topic, updated by log_parse_json for every reading,
+    so the newest values are found without looking through the readings or the log file,
+    however long ago a device last reported.
+    Each update replaces the topic's entry and the dict that holds the entries, so readers need no lock.
+    '''
+    def __init__(self):
+        # topic to (local time of its newest reading as logged, read-only {field: value}, its unix seconds)
+        self.topics = MappingProxyType({})
+        self.lock = threading.Lock()        # writers only
+
+    def update(self, topic, values):
+        '''
+        :param values: dict from the JSON log line, with 'time'
+        :return: False if an older reading than the newest one held was ignored
+        '''
+        t = values['time']
+        with self.lock:
+            _,fields,old_seconds = self.topics.get(topic, ('', {}, None))
+            # compared as unix seconds, so the hour repeated when daylight time ends is not taken as older
+            seconds = rollups.unix_seconds(t, old_seconds)
+            if old_seconds is not None and seconds < old_seconds:
+                return False
+            fields = dict(fields)
+            for field,value in values.items():
+                if field not in ('time', 'topic'):
+                    fields[field] = value
+            topics = dict(self.topics)
+            topics[topic] = (t, MappingProxyType(fields), seconds)
+            self.topics = MappingProxyType(topics)
+        return True
+
+    def get(self, topic, field, default=None):
+        return self.topics.get(topic, (None, {}))[1].get(field, default)
+
+    def age(self, topic, now=None):
+        '''
+        :param now: local datetime, default now
+        :return: seconds since the newest reading of topic, None if it never reported
+        '''
+        entry = self.topics.get(topic)
+        if entry is None:
+            return None
+        return (now.timestamp() if now else time.time()) - entry[2]
+
+    def snapshot(self, stale_after=None, now=None):
+        '''
+        :param stale_after: seconds after which a topic is stale, None to never mark it
+        :return: dict of topic to {'time', 'age', 'stale', 'values'}, newest topic first
+        '''
+        topics = self.topics
+        now = now.timestamp() if now else time.time()
+        result = {}
+        for topic,(t,values,seconds) in sorted(topics.items(), key=lambda item: item[1][2], reverse=True):
+            age = now - seconds
+            result[topic] = {'time': t, 'age': age, 'stale': stale_after is not None and age > stale_after,
+                             'values': dict(values)}
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.topics = MappingProxyType({})
+
+latest = LatestIndex()  # kept when a new day's log starts, so devices that have not reported yet today still show
 
 class SensorVals:
     '''
@@ -32,6 +113,65 @@ class SensorVals:
             self.vals[val_name] = list()
         self.vals[val_name].append(value)
 
+# what readers get of a SensorVals: vals is a read-only dict of tuples
+SensorSeries = collections.namedtuple('SensorSeries', 'name vals')
+
+class SensorStore:
+    '''
+    The day's readings of every device. Only the writer, read_log, adds readings, to SensorVals in
+    self.writing, and then publishes: the devices that changed are copied to SensorSeries, and a new
+    read-only dict of all of them replaces the old one. snapshot() returns that dict.
+    Devices that did not change keep their SensorSeries, so a publish copies only what is new.
+    '''
+    def __init__(self):
+        self.writing = {}       # topic to SensorVals, the writer's
+        self.changed = set()    # topics with readings not published yet
+        self.published = MappingProxyType({})
+        self.version = 0        # incremented by every publish
+
+    def device(self, topic):
+        '''
+        For the writer.
+        :return: SensorVals of topic to add readings to, a new one for a new topic
+        '''
+        dev = self.writing.get(topic)
+        if dev is None:
+            dev = self.writing[topic] = SensorVals(topic)
+        self.changed.add(topic)
+        return dev
+
+    def publish(self):
+        '''
+        For the writer: make the readings added since the last publish visible to snapshot().
+        '''
+        if not self.changed:
+            return
+        devs = dict(self.published)
+        for topic in self.changed:
+            dev = self.writing[topic]
+            devs[topic] = SensorSeries(dev.name, MappingProxyType({k: tuple(v) for k,v in dev.vals.items()}))
+        self.changed.clear()
+        self.published = MappingProxyType(devs)
+        self.version += 1
+
+    def clear(self):
+        '''
+        For the writer: forget every reading, at once for readers too.
+        '''
+        self.writing.clear()
+        self.changed.clear()
+        self.published = MappingProxyType({})
+        self.version += 1
+
+    def snapshot(self):
+        '''
+        :return: read-only dict of topic to SensorSeries, as of the last publish; never changed afterwards
+        '''
+        return self.published
+
+store = SensorStore()
+sensor_devs = store.writing     # the writer's SensorVals, see SensorStore; readers use store.snapshot()
+
 def log_parse(line):
     global sensor_devs
     """
@@ -41,14 +181,14 @@ def log_parse(line):
     """
     values = {}
     l = line.split(':',maxsplit=1)
-    logger.debug('log_parse: l={}'.format(line))
+    hot_logger.debug('log_parse: l=%s', line)
     #fld1 = line.find(':')
     #sens_dev = line[:fld1].strip()
     sens_dev = l[0].strip()
     if not sens_dev in sensor_devs:
-        sensor_devs[sens_dev] = SensorVals(sens_dev)
         location,computer,sensor = sens_dev.split('/')
-        logger.debug('{},{},{}'.format(location,computer,sensor))
+        logger.debug('%s,%s,%s', location, computer, sensor)
+    dev = store.device(sens_dev)
     #ll = line[fld1+1:].strip()
     ll = l[1].strip()
     ff = ll.split(',')
@@ -59,7 +199,7 @@ def log_parse(line):
             val = fld_val
         else:
             val = float(fld_val)
-        sensor_devs[sens_dev].add_value(fld_name,val)
+        dev.add_value(fld_name,val)
 
 def log_parse_json(line):
     global sensor_devs
@@ -72,36 +212,72 @@ def log_parse_json(line):
     values = json.loads(line)   # values is a dict
     sens_dev = values['topic']  # TODO: should I strip off optional "/J" ending?
     if not sens_dev in sensor_devs:
-        sensor_devs[sens_dev] = SensorVals(sens_dev)    # place to hold all future values for this device
         location,computer,sensor,_ = sens_dev.split('/')
-        logger.debug('log_parse_json: {},{},{}'.format(location,computer,sensor))
+        logger.debug('log_parse_json: %s,%s,%s', location, computer, sensor)
+    dev = store.device(sens_dev)    # place to hold all future values for this device
     for fld_name in values:
         if fld_name == 'topic':
             continue
         val = values[fld_name]  # val is str
         if fld_name != 'time':
-            val = float(val)
-        sensor_devs[sens_dev].add_value(fld_name,val)
+            val = values[fld_name] = float(val)
+        dev.add_value(fld_name,val)
+    latest.update(sens_dev, values)
+    rollups.store.add(sens_dev, values)
 
 def show_sensor_devs():
     global sensor_devs
     logger.debug('sensor_dev keys')
     for key in sensor_devs:
-        logger.debug('-- key = {}'.format(key))
+        logger.debug('-- key = %s', key)
 
 def read_log(fname):
     '''
     Read sensor log files that are created by a separate MQTT client process.
     I generate a new file every day, so sensor data starts at midnight.
+    Only lines added since the last call are read. When it is another file, or the file was replaced
+    by a new day's file, the store is emptied and the file is read from the start.
+    The new readings are published to store.snapshot() when they have all been read.
     :param fname: the log file name
     :return:
     '''
-    with open(fname, 'r') as df:
-        lines = df.readlines()
-    for line in lines:
-        log_parse_json(line)
+    global _log_pos
+    with _ingest_lock, metrics.sensor_ingest.time():
+        with open(fname, 'rb') as df:
+            st = os.fstat(df.fileno())
+            name,inode,offset = _log_pos
+            if name != fname or inode != st.st_ino or st.st_size < offset:
+                store.clear()
+                offset = 0
+            df.seek(offset)
+            data = df.read()
+        end = data.rfind(b'\n') + 1    # a line still being written is read next time
+        for line in data[:end].decode().splitlines():
+            if line.strip():
+                log_parse_json(line)
+        store.publish()
+        _log_pos = (fname, st.st_ino, offset + end)
+    rollups.store.maybe_save()
     #show_sensor_devs()
 
+def reset():
+    '''
+    Forget what was read, so the next read_log starts over.
+    '''
+    global _log_pos
+    with _ingest_lock:
+        store.clear()
+        latest.clear()
+        _log_pos = (None, None, 0)
+
+def store_size():
+    '''
+    :return: number of sensor values published by the store
+    '''
+    return sum(len(vals) for dev in store.snapshot().values() for vals in dev.vals.values())
+
+metrics.sensor_store_size.set_function(store_size)
+
 def load_binary(filename):
     with open(filename, 'rb') as file_handle:
         return file_handle.read()
@@ -0,0 +1,481 @@
+# Key/value cache for forecasts, plots and pages, shared by processes and, optionally, by hosts.
+# With processes > 1 in pi_uwsgi.ini, or several Pis that show the same locations, each one would
+# otherwise fetch its own forecasts and draw its own plots. Config.cache_backend picks the store:
+#   'memory'  a dict in this process, the default; enough for one uwsgi process
+#   'file'    one file per entry in Config.cache_dir, for processes on one host or a shared mount
+#   'sqlite'  a SQLite file (Config.cache_path) that all processes on the host open
+#   'redis'   a Redis server (Config.redis_url) shared by all hosts
+# Entries expire after their TTL and set() replaces an entry atomically.
+# lease() lets one process compute a missing value while the others wait for it.
+#
+# Except in 'memory', values are encoded with msgpack when it is installed, else JSON, and every key
+# starts with 'wx:v<CACHE_VERSION>:' so hosts running different versions don't read each other's entries.
+# A backend that fails (Redis down, disk full) counts as a miss: pages are built as if there were no cache.
+import hashlib
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import Config
+import breaker
+import metrics
+import logging
+import my_logger
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+CACHE_VERSION = 1   # change it when the layout of cached values changes
+
+# Encoding of values. A value is stored as [tag, payload]; tag names a registered type, or is None
+# for plain lists, dicts, strings and numbers (tuples come back as lists).
+_types = {}     # tag to (class, to_dict, from_dict)
+
+def register_type(tag, cls, to_dict, from_dict):
+    '''
+    Let instances of cls be cached, e.g. providers.ForecastBundle.
+    :param to_dict: function returning plain data for an instance
+    :param from_dict: function making an instance from that data
+    '''
+    _types[tag] = (cls, to_dict, from_dict)
+
+def encode(value):
+    '''
+    :return: bytes, b'M' + msgpack or b'J' + JSON
+    '''
+    tag = None
+    for t,(cls,to_dict,_) in _types.items():
+        if type(value) is cls:
+            tag,value = t,to_dict(value)
+            break
+    if msgpack is not None and Config.cache_codec == 'msgpack':
+        return b'M' + msgpack.packb([tag, value], use_bin_type=True)
+    return b'J' + json.dumps([tag, value], separators=(',', ':')).encode()
+
+def decode(blob):
+    if blob[:1] == b'M':
+        if msgpack is None:
+            raise ValueError('entry is msgpack, which is not installed')
+        tag,value = msgpack.unpackb(blob[1:], raw=False)
+    else:
+        tag,value = json.loads(blob[1:])
+    if tag is not None:
+        value = _types[tag][2](value)
+    return value
+
+class Cache:
+    '''
+    Base of the backends. A backend that stores bytes provides _get/_set/_add/_delete_if
+    and the list of exceptions that mean the store failed; keys and values are encoded here.
+    '''
+    name = ''
+    errors = ()
+
+    def key(self, key):
+        return 'wx:v{}:{}'.format(CACHE_VERSION, key)
+
+    def failed(self, op, key, e):
+        metrics.cache_errors.labels(self.name).inc()
+        if isinstance(e, breaker.CircuitOpenError):
+            return  # logged once by the breaker
+        logger.warning('%s: %s %s failed: %s', type(self).__name__, op, key, e)
+
+    def get(self, key):
+        '''
+        :return: the value, or None when missing or expired
+        '''
+        try:
+            blob = self._get(self.key(key))
+            return None if blob is None else decode(blob)
+        except self.errors + (ValueError, KeyError) as e:
+            self.failed('get', key, e)
+            return None
+
+    def set(self, key, value, ttl):
+        '''
+        Store value, replacing any entry for key.
+        :param ttl: seconds until the entry expires
+        '''
+        try:
+            self._set(self.key(key), encode(value), ttl)
+        except self.errors + (TypeError, ValueError) as e:
+            self.failed('set', key, e)
+
+    def add(self, key, value, ttl):
+        '''
+        Store value only if key is missing or expired.
+        :return: True if stored, also when the store failed, so nobody waits on a broken store
+        '''
+        try:
+            return self._add(self.key(key), encode(value), ttl)
+        except self.errors as e:
+            self.failed('add', key, e)
+            return True
+
+    def delete_if(self, key, value):
+        '''
+        Delete the entry if it still holds value.
+        '''
+        try:
+            self._delete_if(self.key(key), encode(value))
+        except self.errors as e:
+            self.failed('delete', key, e)
+
+    @contextmanager
+    def lease(self, name, timeout=30.0):
+        '''
+        Hold the lease on name, across threads and processes, while the body runs.
+        Waits while someone else holds it. After timeout the holder is presumed stuck
+        and the body runs anyway.
+        :return: True if the lease was acquired, False if it timed out
+        '''
+        key = 'lease:' + name
+        token = '{}:{}:{}:{}'.format(platform.node(), os.getpid(), threading.get_ident(), random.random())
+        deadline = time.monotonic() + timeout
+        acquired = self.add(key, token, timeout)
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(0.05)
+            acquired = self.add(key, token, timeout)
+        if not acquired:
+            logger.warning('Cache.lease: gave up waiting for %s', name)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.delete_if(key, token)
+
+    def get_or_compute(self, key, ttl, compute, lease_timeout=30.0):
+        '''
+        :param compute: function returning the value, called by one process at a time for key
+        :return: (value, True if it came from the cache)
+        '''
+        value = self.get(key)
+        if value is not None:
+            return value, True
+        with self.lease(key, lease_timeout):
+            value = self.get(key)   # computed by whoever held the lease before us
+            if value is not None:
+                return value, True
+            value = compute()
+            self.set(key, value, ttl)
+            return value, False
+
+class MemoryCache(Cache):
+    '''
+    Keeps the values themselves, nothing is encoded.
+    '''
+    name = 'memory'
+
+    def __init__(self):
+        self.entries = {}   # key to (expires, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            if random.random() < 0.01:
+                now = time.time()
+                self.entries = {k:e for k,e in self.entries.items() if e[0] >= now}
+
+    def add(self, key, value, ttl):
+        with self.lock:
+            if self.get(key) is not None:
+                return False
+            self.entries[key] = (time.time() + ttl, value)
+            return True
+
+    def delete_if(self, key, value):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == value:
+                del self.entries[key]
+
+class FileCache(Cache):
+    '''
+    One file per entry: 8 byte expiry time, then the encoded value.
+    Files are written to a temporary name and renamed, so a reader sees the old or the new entry.
+    '''
+    name = 'file'
+    errors = (OSError,)
+    _expires = struct.Struct('>d')
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.dirname, hashlib.sha1(key.encode()).hexdigest())
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, None
+        if len(data) < self._expires.size:
+            return None, None   # empty or cut short by a crash or a full disk, as good as missing
+        return self._expires.unpack_from(data)[0], data[self._expires.size:]
+
+    def _write_temp(self, blob, ttl):
+        tmp = os.path.join(self.dirname, '.tmp.{}.{}.{}'.format(os.getpid(), threading.get_ident(), random.random()))
+        with open(tmp, 'wb') as f:
+            f.write(self._expires.pack(time.time() + ttl))
+            f.write(blob)
+        return tmp
+
+    def _get(self, key):
+        expires,blob = self._read(self.path(key))
+        if expires is None or expires < time.time():
+            return None
+        return blob
+
+    def _set(self, key, blob, ttl):
+        os.replace(self._write_temp(blob, ttl), self.path(key))
+        if random.random() < 0.01:
+            self.purge()
+
+    def _add(self, key, blob, ttl):
+        path = self.path(key)
+        tmp = self._write_temp(blob, ttl)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp, path)     # fails if the entry exists, even on another host's view of NFS
+                    return True
+                except FileExistsError:
+                    expires,_ = self._read(path)
+                    if expires is not None and expires >= time.time():
+                        return False
+                    try:
+                        os.remove(path)    # expired, take it over
+                    except FileNotFoundError:
+                        pass
+            return False
+        finally:
+            os.remove(tmp)
+
+    def _delete_if(self, key, blob):
+        path = self.path(key)
+        _,current = self._read(path)
+        if current == blob:
+            os.remove(path)
+
+    def purge(self):
+        '''
+        Delete expired entries and temporary files left by crashed writers.
+        '''
+        now = time.time()
+        for name in os.listdir(self.dirname):
+            path = os.path.join(self.dirname, name)
+            try:
+                if name.startswith('.tmp.'):
+                    if os.path.getmtime(path) < now - 60:
+                        os.remove(path)
+                    continue
+                expires,_ = self._read(path)
+                if expires is not None and expires < now:
+                    os.remove(path)
+            except OSError:
+                pass
+
+class SqliteCache(Cache):
+    '''
+    One table in a SQLite file. WAL mode lets readers in other processes carry on while one writes.
+    Each thread of each process has its own connection.
+    '''
+    name = 'sqlite'
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        db = self.db()
+        db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def db(self):
+        # a connection can't be used after fork, so connections are kept per process id
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')   # a lost cache entry after power loss is harmless
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _get(self, key):
+        row = self.db().execute('SELECT value FROM cache WHERE key=? AND expires>=?', (key, time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def _set(self, key, blob, ttl):
+        db = self.db()
+        now = time.time()
+        db.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?,?,?)', (key, blob, now + ttl))
+        if random.random() < 0.01:
+            db.execute('DELETE FROM cache WHERE expires<?', (now,))
+
+    def _add(self, key, blob, ttl):
+        db = self.db()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM cache WHERE key=? AND expires<?', (key, now))
+            cursor = db.execute('INSERT OR IGNORE INTO cache (key, value, expires) VALUES (?,?,?)',
+                                (key, blob, now + ttl))
+            db.execute('COMMIT')
+        except sqlite3.Error:
+            db.execute('ROLLBACK')
+            raise
+        return cursor.rowcount == 1
+
+    def _delete_if(self, key, blob):
+        self.db().execute('DELETE FROM cache WHERE key=? AND value=?', (key, blob))
+
+class RedisError(Exception):
+    pass
+
+# deletes KEYS[1] only if it still holds ARGV[1], so a lease is released only by its holder
+DELETE_IF_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+class RedisCache(Cache):
+    '''
+    Minimal Redis client speaking RESP over a socket per thread; GET, SET with PX and NX, and EVAL.
+    After repeated failures a circuit breaker skips Redis for a while, so pages don't wait on
+    connect timeouts while the server is down.
+    '''
+    name = 'redis'
+    errors = (OSError, RedisError, breaker.CircuitOpenError)
+
+    def __init__(self, url, timeout=0.5):
+        '''
+        :param url: redis://[:password@]host[:port][/db]
+        :param timeout: seconds for connect and for each reply
+        '''
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.strip('/') or 0)
+        self.timeout = timeout
+        self.local = threading.local()
+        self.breaker = breaker.CircuitBreaker('redis', failure_threshold=3, reset_timeout=30)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.local.sock = sock
+        self.local.reader = sock.makefile('rb')
+        self.local.pid = os.getpid()
+        if self.password:
+            self._command('AUTH', self.password)
+        if self.db:
+            self._command('SELECT', self.db)
+
+    def _close(self):
+        sock = getattr(self.local, 'sock', None)
+        self.local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def _read_reply(self):
+        line = self.local.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('connection closed by redis')
+        kind,rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RedisError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self.local.reader.read(n + 2)
+            return data[:-2]
+        if kind == b'*':
+            n = int(rest)
+            return None if n < 0 else [self._read_reply() for _ in range(n)]
+        raise RedisError('bad reply {!r}'.format(line))
+
+    def _command(self, *args):
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self.local.sock.sendall(b''.join(out))
+        return self._read_reply()
+
+    def command(self, *args):
+        '''
+        Send one command, connecting first if needed.
+        :return: the decoded reply
+        '''
+        def send():
+            if getattr(self.local, 'sock', None) is None or self.local.pid != os.getpid():
+                self._connect()
+            try:
+                return self._command(*args)
+            except (OSError, ValueError):
+                self._close()   # the connection is in an unknown state
+                raise
+        return self.breaker.call(send)
+
+    def _get(self, key):
+        return self.command('GET', key)
+
+    def _set(self, key, blob, ttl):
+        self.command('SET', key, blob, 'PX', max(1, int(ttl * 1000)))
+
+    def _add(self, key, blob, ttl):
+        return self.command('SET', key, blob, 'PX', max(1, int(ttl * 1000)), 'NX') is not None
+
+    def _delete_if(self, key, blob):
+        self.command('EVAL', DELETE_IF_SCRIPT, 1, key, blob)
+
+BACKENDS = {'memory': lambda: MemoryCache(),
+            'file': lambda: FileCache(Config.cache_dir),
+            'sqlite': lambda: SqliteCache(Config.cache_path),
+            'redis': lambda: RedisCache(Config.redis_url, Config.redis_timeout)}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    '''
+    :return: the Cache selected by Config.cache_backend, created on first use
+    '''
+    global _cache
+    cache = _cache
+    if cache is not None:
+        return cache    # every lookup comes here, so no lock once the cache exists
+    with _cache_lock:
+        if _cache is None:
+            _cache = BACKENDS[Config.cache_backend]()
+            logger.info('shared_cache: using %s', type(_cache).__name__)
+    return _cache
@@ -0,0 +1,204 @@
+# Static export: render the kiosk pages to files that nginx serves without asking the app.
+# On a Pi the cheapest request is the one Python never sees. With Config.export_dir set, a background
+# thread renders every route in Config.export_routes for every home in Config.export_homes whenever the
+# forecast is refreshed or a sensor reading arrives, and nginx answers from the files.
+# The app then only regenerates them, and still answers whatever has no file.
+# Files are named by route and query string, the query string as the page buttons write it:
+#   {export_dir}/now/home_name=Home&tz=-8.html      for /now?home_name=Home&tz=-8
+#   {export_dir}/daily/index.html                   for /daily with no query string
+# Each file is written to a temporary name and renamed, so nginx never sends half a page.
+# The kiosk views then never reach the app, and rendering is no view either, so the call budget
+# (quota.py) counts each exported home as one view per Config.weather_refresh instead.
+#   python static_export.py             export once
+#   python static_export.py --loop      export whenever something changed, until killed
+#   python static_export.py --nginx     print the nginx configuration for the exported routes
+import argparse
+import hashlib
+import os
+import threading
+import time
+
+import Config
+import OpenWeatherProvider as ow
+import forecast_cache
+import logging
+import metrics
+import my_logger
+import providers
+import quota
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+EXTENSIONS = {'text/html': 'html', 'image/svg+xml': 'svg', 'image/png': 'png', 'application/json': 'json'}
+# headers the app adds that the exported files need too
+ROUTE_HEADERS = {'hourly_divs': {'Access-Control-Allow-Origin': '*'}}   # see crossdomain in app.py
+
+def page_urls(home):
+    '''
+    :param home: dict from Config.export_homes, with any of 'lon_lat', 'home_name', 'tz', 'radar_type'
+    :return: list of (route, URL) for the routes in Config.export_routes, as the pages link to them
+    '''
+    lon_lat = home.get('lon_lat')
+    tzoff = home.get('tz', -8)
+    urls = []
+    for route in Config.export_routes:
+        if route == 'hourly_chart.svg':
+            urls.append((route, ow.hourly_chart_url(lon_lat, tzoff)))
+        else:
+            args = ow.page_args(lon_lat, home.get('home_name', ''), tzoff, home.get('radar_type', ''))
+            urls.append((route, '/{}?{}'.format(route, args)))
+    return urls
+
+def file_name(route, url, mimetype):
+    '''
+    :return: path of the file for url, relative to Config.export_dir
+    '''
+    query = url.partition('?')[2] or 'index'
+    return os.path.join(route, '{}.{}'.format(query, EXTENSIONS.get(mimetype, 'html')))
+
+def write_atomic(path, body):
+    '''
+    Write body to path through a temporary file and rename, so readers see the old file or the new one.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(body)
+    os.replace(tmp, path)
+
+class Exporter:
+    def __init__(self, app, export_dir=None):
+        '''
+        :param app: the Flask app, pages are rendered through its test client exactly as routes serve them
+        :param export_dir: default Config.export_dir
+        '''
+        self.app = app
+        self.export_dir = export_dir or Config.export_dir
+        self.digests = {}       # file path to md5 of what was written, unchanged pages are not rewritten
+        self.signature = None   # what the pages were made from, see current_signature
+        self.exported_at = 0.0
+        self.routes = {}        # route to file extension, for the nginx configuration
+        self.noted_at = 0.0     # last time the homes were counted as views, see note_views
+
+    def current_signature(self):
+        '''
+        :return: the forecast of every home and the size and time of the sensor log; a new value means a
+        forecast refresh or a sensor reading. Getting the forecasts refreshes them when they are due.
+        '''
+        with quota.budget.not_counting():
+            forecasts = tuple(ow.forecast_id(ow.get_wx_all(home.get('lon_lat'))) for home in Config.export_homes)
+        try:
+            st = os.stat(Config.sensor_log)
+            sensors = (st.st_size, st.st_mtime)
+        except OSError:
+            sensors = None
+        return forecasts, sensors
+
+    def export(self):
+        '''
+        Render every page and write the ones that changed.
+        :return: number of files written
+        '''
+        written = 0
+        client = self.app.test_client()
+        with metrics.static_export.time(), quota.budget.not_counting():
+            for home in Config.export_homes:
+                for route,url in page_urls(home):
+                    response = client.get(url)
+                    if response.status_code != 200:
+                        logger.error('static_export: %s returned %s', url, response.status_code)
+                        continue
+                    name = file_name(route, url, response.mimetype)
+                    self.routes[route] = name.rpartition('.')[2]
+                    body = response.get_data()
+                    digest = hashlib.md5(body).hexdigest()
+                    path = os.path.join(self.export_dir, name)
+                    if self.digests.get(path) == digest and os.path.exists(path):
+                        continue
+                    write_atomic(path, body)
+                    self.digests[path] = digest
+                    written += 1
+        metrics.static_export_files.inc(written)
+        self.exported_at = time.time()
+        logger.info('static_export: %s files written to %s', written, self.export_dir)
+        return written
+
+    def note_views(self):
+        '''
+        Count each home as one view per Config.weather_refresh, as a page shown on a wall all day,
+        however often it is exported; nginx answers the kiosks, so their views are never seen.
+        '''
+        now = time.time()
+        if now - self.noted_at < Config.weather_refresh * 60:
+            return
+        self.noted_at = now
+        for home in Config.export_homes:
+            lon,lat = providers.parse_lon_lat(home.get('lon_lat'))
+            quota.budget.note_request(forecast_cache.location_key(lon, lat), now)
+
+    def export_if_changed(self):
+        '''
+        Export when the forecast or the sensor log changed, and at least every Config.sensor_stale minutes
+        so the pages notice a sensor that stopped reporting.
+        :return: number of files written
+        '''
+        self.note_views()
+        signature = self.current_signature()
+        if signature == self.signature and time.time() - self.exported_at < Config.sensor_stale * 60:
+            return 0
+        written = self.export()
+        self.signature = signature
+        return written
+
+    def run(self):
+        while True:
+            try:
+                self.export_if_changed()
+            except Exception as e:
+                logger.error('static_export: %s', e)
+            time.sleep(Config.export_interval)
+
+    def nginx_conf(self, socket='/tmp/wx.sock'):
+        '''
+        :return: nginx configuration that serves the exported files and passes anything else to the app
+        '''
+        lines = ['# goes in the http block',
+                 'map $args $wx_export_args {', '    ""      index;', '    default $args;', '}',
+                 '',
+                 '# goes in the server block',
+                 'location @wx_app {', '    include uwsgi_params;', '    uwsgi_pass unix:{};'.format(socket), '}']
+        for route in Config.export_routes:
+            ext = self.routes.get(route, 'svg' if route.endswith('.svg') else 'html')
+            lines += ['location = /{} {{'.format(route),
+                      '    root {};'.format(os.path.abspath(self.export_dir))]
+            for header,value in ROUTE_HEADERS.get(route, {}).items():
+                lines.append('    add_header {} "{}";'.format(header, value))
+            lines += ['    expires 1m;',
+                      '    try_files /{}/$wx_export_args.{} @wx_app;'.format(route, ext),
+                      '}']
+        return '\n'.join(lines) + '\n'
+
+def start(app):
+    '''
+    Run an Exporter in a daemon thread, when Config.export_dir is set.
+    :return: the Exporter, None when export is off
+    '''
+    if not Config.export_dir:
+        return None
+    exporter = Exporter(app)
+    threading.Thread(target=exporter.run, name='static_export', daemon=True).start()
+    return exporter
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='render the kiosk pages to files for nginx')
+    parser.add_argument('--dir', help='default Config.export_dir')
+    parser.add_argument('--loop', action='store_true', help='export whenever something changed, until killed')
+    parser.add_argument('--nginx', action='store_true', help='print the nginx configuration')
+    args = parser.parse_args()
+    from app import app
+    exporter = Exporter(app, args.dir or Config.export_dir or '../export')
+    if args.nginx:
+        print(exporter.nginx_conf(), end='')
+    elif args.loop:
+        exporter.run()
+    else:
+        exporter.export()
@@ -0,0 +1,271 @@
+# Sensor plots drawn as SVG, without matplotlib.
+# The same four panels as timeplot.make_plot (temp, humidity, pressure, PM2.5), written directly as
+# polylines and text. A line keeps at most two points per pixel column, the lowest and highest reading
+# in it, so a day of readings is a few KB: small enough to inline in the page, and it scales crisply
+# on the kiosk touchscreens.
+# make_forecast_chart draws the hourly outlook (temperature, chance of precipitation, wind) the same way.
+import datetime as dt
+
+import logging
+import metrics
+import my_logger
+import rollups
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+# colors of the lines, the first colors of matplotlib, so both renderers look alike
+COLORS = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b')
+# panel: field, title, y interval for calc_scale, conversion of the values
+PANELS = (('temp_c', 'Temp F', 5, lambda v: v*1.8+32.0),
+          ('humidity', 'Humidity', 10, None),
+          ('pressure', 'Pressure', 2, None),
+          ('pm25', 'Air Quality 2.5', 10, int))
+# space around the panels for tick labels, in SVG units
+LEFT, RIGHT, TOP, BOTTOM, GAP = 38, 6, 4, 30, 6
+
+def calc_scale(vals, interval=10):
+    '''
+    Calculate Y min/max for a nice plot.
+    Interval is minimum scale of Y axis.
+    Actual interval must fit the min/max vals and must be multiple of interval.
+    :param vals:
+    :param interval:
+    :return: ymin,ymax
+    '''
+    y0 = min(vals)
+    y1 = max(vals)
+    ylen = y1 - y0
+    '''
+    Examples:
+    ylen=8, interval=10, n_interval=1
+    ylen=27, interval=10, n_interval=3
+    ylen=12, interval=5, n_interval=3
+    '''
+    n_interval = int((ylen + interval) / interval)  # number of tick marks?
+    # TODO: try to round minimum to nearest interval multiple
+    limits = int(y0),int(y0)+n_interval*interval
+    logger.debug('calc_scale: vals= %s,%s. scale= %s, %s', y0, y1, limits[0], limits[1])
+    return limits
+
+def column_extremes(xs, ys):
+    '''
+    Thin a line to what can be seen: the lowest and highest point in each pixel column.
+    :param xs: x of each point in pixels, ascending
+    :param ys: y of each point in pixels
+    :return: list of (x, y), at most two per column, in the order of xs
+    '''
+    points = []
+    col = None
+    for x,y in zip(xs, ys):
+        if int(x) != col:
+            if col is not None:
+                points.extend(sorted({lo, hi}))
+            col = int(x)
+            lo = hi = (x, y)
+        elif y < lo[1]:
+            lo = (x, y)
+        elif y > hi[1]:
+            hi = (x, y)
+    if col is not None:
+        points.extend(sorted({lo, hi}))
+    return points
+
+def time_ticks(t0, t1, max_ticks=8, fmt=None):
+    '''
+    :param t0: first time shown, datetime
+    :param t1: last time shown, datetime
+    :param fmt: strftime format of the labels, default hours and minutes, or month and day for long spans
+    :return: list of (datetime, label) on whole hours or days
+    '''
+    span = (t1 - t0).total_seconds()
+    for hours in (1, 2, 3, 6, 12, 24, 48, 168):
+        if span / (hours * 3600) <= max_ticks:
+            break
+    step = dt.timedelta(hours=hours)
+    if hours < 24:
+        t = t0.replace(minute=0, second=0, microsecond=0)
+        t += dt.timedelta(hours=-t.hour % hours)
+    else:
+        t = t0.replace(hour=0, minute=0, second=0, microsecond=0)
+    if fmt is None:
+        fmt = '%H:%M' if span <= 2 * 86400 else '%m-%d'
+    ticks = []
+    while t <= t1:
+        if t >= t0:
+            ticks.append((t, t.strftime(fmt)))
+        t += step
+    return ticks
+
+def y_axis(out, top, height, limits, interval, x, side='left'):
+    '''
+    Write the ticks and labels of a y axis.
+    :param limits: (ymin, ymax) from calc_scale
+    :param interval: the interval given to calc_scale; ticks are a multiple of it, at most 4 gaps apart
+    :param x: x of the axis line
+    :return: function from value to y, clipped to the panel
+    '''
+    y0,y1 = limits
+    y1 = max(y1, y0 + interval)
+    steps = (y1 - y0) // interval
+    tick = interval * -(-steps // 4)
+    sign,anchor = (-1, 'end') if side == 'left' else (1, 'start')
+
+    def to_y(v):
+        return top + height * (1 - (min(max(v, y0), y1) - y0) / (y1 - y0))
+    for v in range(y0, y1 + 1, tick):
+        y = to_y(v)
+        out.append('<line x1="{0}" x2="{1}" y1="{2:.1f}" y2="{2:.1f}" stroke="#000"/>'
+                   '<text x="{3}" y="{4:.1f}" text-anchor="{5}">{6}</text>'.format(
+                    x + 3 * sign, x, y, x + 5 * sign, y + 3.5, anchor, v))
+    return to_y
+
+def polyline(points, color, width=1.2, dash=None):
+    '''
+    :param points: list of (x, y)
+    :return: SVG polyline element
+    '''
+    return '<polyline fill="none" stroke="{}" stroke-width="{}"{} points="{}"/>'.format(
+        color, width, ' stroke-dasharray="{}"'.format(dash) if dash else '',
+        ' '.join('{:.1f},{:.1f}'.format(x, y) for x,y in points))
+
+def collect_series(sensor_devs, sys_name=None, width=None):
+    '''
+    The values drawn in each panel, found the same way as timeplot.make_plot finds them.
+    :param width: pixel columns of the plot; when the rollups fill it with fewer points than the raw
+    readings, their means are drawn instead, see rollups.Rollups.plot_series
+    :return: dict of field to list of (legend label, times, values)
+    '''
+    series = {field: [] for field,_,_,_ in PANELS}
+    for dev_key in sorted(sensor_devs.keys()):
+        location,computer,sensor,_ = dev_key.split('/')
+        if sys_name and sys_name.find(computer) == -1:
+            continue
+        dev = sensor_devs[dev_key]
+        if 'time' not in dev.vals:
+            continue
+        times = None
+        for field,_,_,convert in PANELS:
+            if field not in dev.vals or (field == 'pm25') != (sensor == 'pm25'):
+                continue    # pm25 from the particle sensor, the others from the bme280
+            vals = dev.vals[field]
+            thinned = None
+            if width and vals:
+                thinned = rollups.store.plot_series(dev_key, field, dev.vals['time'][0], dev.vals['time'][-1],
+                                                    width, len(vals))
+            if thinned:
+                field_times,vals = thinned
+            else:
+                if times is None:
+                    times = [dt.datetime.fromisoformat(t) for t in dev.vals['time']]
+                field_times = times
+            if convert:
+                vals = [convert(v) for v in vals]
+            series[field].append((computer[-6:], field_times, vals))
+    return series
+
+def make_svg(sensor_devs, width=500, height=350, sys_name=None):
+    '''
+    Draw the sensor panels.
+    :param sensor_devs: dict of topic to SensorVals or SensorSeries, e.g. sensor_in.store.snapshot()
+    :param width: SVG width, also the number of pixel columns the lines are thinned to
+    :param sys_name: only plot this sensor computer, None for all
+    :return: SVG document as a string
+    '''
+    series = collect_series(sensor_devs, sys_name, width - LEFT - RIGHT)
+    all_times = [times[i] for lines in series.values() for _,times,_ in lines for i in (0, -1)]
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {0} {1}" width="{0}" height="{1}" '
+           'font-family="sans-serif" font-size="10">'.format(width, height)]
+    if not all_times:
+        out.append('<text x="{}" y="{}" text-anchor="middle">No sensor readings</text></svg>'.format(width / 2, height / 2))
+        return ''.join(out)
+    t0,t1 = min(all_times),max(all_times)
+    span = max((t1 - t0).total_seconds(), 1.0)
+    plot_w = width - LEFT - RIGHT
+    panel_h = (height - TOP - BOTTOM - GAP * (len(PANELS) - 1)) / len(PANELS)
+
+    def px(t):
+        return LEFT + (t - t0).total_seconds() / span * plot_w
+    colors = {}     # legend label to color, so a computer has the same color in every panel
+    for i,(field,title,interval,_) in enumerate(PANELS):
+        top = TOP + i * (panel_h + GAP)
+        out.append('<rect x="{}" y="{:.1f}" width="{}" height="{:.1f}" fill="none" stroke="#000"/>'.format(
+            LEFT, top, plot_w, panel_h))
+        lines = [(label, times, vals) for label,times,vals in series[field] if vals]
+        if lines:
+            # if there are multiple devices on one plot, then limits are the min/max required by all
+            limits = [calc_scale(vals, interval) for _,_,vals in lines]
+            to_y = y_axis(out, top, panel_h, (min(l[0] for l in limits), max(l[1] for l in limits)), interval, LEFT)
+            for label,times,vals in lines:
+                color = colors.setdefault(label, COLORS[len(colors) % len(COLORS)])
+                xs = [px(t) for t in times]
+                ys = [to_y(v) for v in vals]
+                out.append(polyline(column_extremes(xs, ys), color))
+        out.append('<text x="{}" y="{:.1f}" text-anchor="middle" font-size="11">{}</text>'.format(
+            LEFT + plot_w / 2, top + 12, title))
+    # time axis under the last panel
+    bottom = height - BOTTOM
+    for t,label in time_ticks(t0, t1):
+        x = px(t)
+        out.append('<line x1="{0:.1f}" x2="{0:.1f}" y1="{1:.1f}" y2="{2:.1f}" stroke="#000"/>'
+                   '<text x="{0:.1f}" y="{3:.1f}" text-anchor="middle">{4}</text>'.format(x, bottom, bottom + 3, bottom + 14, label))
+    # legend in the first panel, upper left
+    for n,(label,color) in enumerate(colors.items()):
+        y = TOP + 12 + n * 12
+        out.append('<line x1="{0}" x2="{1}" y1="{2}" y2="{2}" stroke="{3}" stroke-width="2"/>'
+                   '<text x="{4}" y="{5}">{6}</text>'.format(LEFT + 5, LEFT + 20, y - 3.5, color, LEFT + 24, y, label))
+    out.append('</svg>')
+    return ''.join(out)
+
+def make_forecast_chart(times, temps, pops, winds, width=640, height=170):
+    '''
+    Hourly outlook: temperature over bars of precipitation probability, and wind speed below.
+    :param times: datetime of each hour
+    :param temps: temperature of each hour, °F
+    :param pops: probability of precipitation of each hour, 0 to 1
+    :param winds: wind speed of each hour, mph
+    :return: SVG document as a string
+    '''
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {0} {1}" width="{0}" height="{1}" '
+           'font-family="sans-serif" font-size="10">'.format(width, height)]
+    if len(times) < 2:
+        out.append('<text x="{}" y="{}" text-anchor="middle">No hourly forecast</text></svg>'.format(width / 2, height / 2))
+        return ''.join(out)
+    right = LEFT    # room for the probability axis
+    plot_w = width - LEFT - right
+    temp_h = (height - TOP - BOTTOM - GAP) * 0.65
+    wind_h = height - TOP - BOTTOM - GAP - temp_h
+    wind_top = TOP + temp_h + GAP
+    col_w = plot_w / len(times)
+    xs = [LEFT + (i + 0.5) * col_w for i in range(len(times))]
+    out.append('<rect x="{}" y="{}" width="{}" height="{:.1f}" fill="none" stroke="#000"/>'.format(LEFT, TOP, plot_w, temp_h))
+    out.append('<rect x="{}" y="{:.1f}" width="{}" height="{:.1f}" fill="none" stroke="#000"/>'.format(LEFT, wind_top, plot_w, wind_h))
+    # precipitation probability bars, on their own 0-100% axis at the right
+    to_pop = y_axis(out, TOP, temp_h, (0, 100), 50, LEFT + plot_w, side='right')
+    for x,pop in zip(xs, pops):
+        if pop >= 0.05:
+            y = to_pop(pop * 100)
+            out.append('<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" fill="#9ecae1"/>'.format(
+                x - col_w * 0.4, y, col_w * 0.8, TOP + temp_h - y))
+    to_temp = y_axis(out, TOP, temp_h, calc_scale(temps, 5), 5, LEFT)
+    out.append(polyline([(x, to_temp(v)) for x,v in zip(xs, temps)], COLORS[3], width=2))
+    to_wind = y_axis(out, wind_top, wind_h, calc_scale(winds, 5), 5, LEFT)
+    out.append(polyline([(x, to_wind(v)) for x,v in zip(xs, winds)], '#555', dash='4,2'))
+    out.append('<text x="{}" y="{}" fill="{}">Temp F</text><text x="{}" y="{}" text-anchor="end" fill="#3182bd">Precip %</text>'
+               '<text x="{}" y="{:.1f}" fill="#555">Wind mph</text>'.format(
+                LEFT + 4, TOP + 11, COLORS[3], LEFT + plot_w - 4, TOP + 11, LEFT + 4, wind_top + 11))
+    bottom = height - BOTTOM
+    hour = dt.timedelta(hours=1)
+    for t,label in time_ticks(times[0], times[-1], fmt='%a %I %p'):
+        x = LEFT + ((t - times[0]) / hour + 0.5) * col_w
+        out.append('<line x1="{0:.1f}" x2="{0:.1f}" y1="{1:.1f}" y2="{2:.1f}" stroke="#000"/>'
+                   '<text x="{0:.1f}" y="{3:.1f}" text-anchor="middle">{4}</text>'.format(x, bottom, bottom + 3, bottom + 14, label))
+    out.append('</svg>')
+    return ''.join(out)
+
+def stream_svg(sensor_devs, width=500, height=350):
+    '''
+    :return: make_svg for all sensor computers, to inline in the page
+    '''
+    with metrics.plot_render.labels('svg').time():
+        svg = make_svg(sensor_devs, width, height)
+    logger.debug('stream_svg: %s bytes', len(svg))
+    return svg
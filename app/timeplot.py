@@ -5,36 +5,37 @@
 # When imported and called from a Flask process it generates a plot as HTTP stream.
 import io
 import datetime as dt
+import matplotlib
+if __name__ != '__main__':
+    # served pages only save PNGs; naming the backend skips the search for a GUI backend,
+    # which is slow and fails under uwsgi where there is no display
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import base64
 from sensor_in import log_parse, log_parse_json, sensor_devs, SENSOR_NAMES
 import logging
+import metrics
 import my_logger
+import rollups
+from svgplot import calc_scale   # shared with the SVG plots, which do without matplotlib
 logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
 
-def calc_scale(vals, interval=10):
-    '''
-    Calculate Y min/max for a nice plot.
-    Interval is minimum scale of Y axis.
-    Actual interval must fit the min/max vals and must be multiple of interval.
-    :param vals:
-    :param interval:
-    :return: ymin,ymax
-    '''
-    y0 = min(vals)
-    y1 = max(vals)
-    ylen = y1 - y0
-    '''
-    Examples:
-    ylen=8, interval=10, n_interval=1
-    ylen=27, interval=10, n_interval=3
-    ylen=12, interval=5, n_interval=3
-    '''
-    n_interval = int((ylen + interval) / interval)  # number of tick marks?
-    # TODO: try to round minimum to nearest interval multiple
-    limits = int(y0),int(y0)+n_interval*interval
-    logger.debug('calc_scale: vals= {},{}. scale= {}, {}'.format(y0,y1,limits[0],limits[1]))
-    return limits
+PLOT_WIDTH = 500    # pixels across the axes of the default 640 pixel figure
+
+def plot_points(dev_key, dev, senskey, raw_times, width=PLOT_WIDTH):
+    '''
+    :param raw_times: dict of dev_key to the datetimes of its raw readings, filled when they are needed
+    :return: (times, values) of one sensor field: the rollup means when they fill width with fewer
+    points than the raw readings (see rollups.Rollups.plot_series), else the raw readings
+    '''
+    vals = dev.vals[senskey]
+    if vals:
+        thinned = rollups.store.plot_series(dev_key, senskey, dev.vals['time'][0], dev.vals['time'][-1], width, len(vals))
+        if thinned:
+            return thinned
+    if dev_key not in raw_times:
+        raw_times[dev_key] = [dt.datetime.fromisoformat(t) for t in dev.vals['time']]
+    return raw_times[dev_key], vals
 
 def make_plot(sensor_devs, sys_name='gn-pi-zero-2'):
     '''
@@ -49,8 +50,9 @@ def make_plot(sensor_devs, sys_name='gn-pi-zero-2'):
     axnum = {'temp_c': 0, 'humidity': 1, 'pressure': 2, 'pm25': 3}
     fig,axs = plt.subplots(len(axnum))
     yaxlim = {} # if there are multiple devices on one plot, then limits are the min/max required by all
+    raw_times = {}  # see plot_points
     dev_keys = sorted(sensor_devs.keys())   # these will be MQTT topic names
-    logger.debug('dev_keys:sorted = {}'.format(dev_keys))
+    logger.debug('dev_keys:sorted = %s', dev_keys)
     for dev_key in dev_keys:
         # TODO: should I strip optional "/J" from end of dev_keys?
         location,computer,sensor,_ = dev_key.split('/')
@@ -58,17 +60,16 @@ def make_plot(sensor_devs, sys_name='gn-pi-zero-2'):
         if sys_name and sys_name.find(computer) == -1:
             continue    # don't plot this data
         dev = sensor_devs[dev_key]
-        logger.debug('device = {}'.format(dev.name))
+        logger.debug('device = %s', dev.name)
         for key in dev.vals:
             # dev.vals is a dict that holds lists of values from each sensor, e.g., 'temp_c' and 'pressure'
-            logger.debug('  key={} has {} values'.format(key,len(dev.vals[key])))
+            logger.debug('  key=%s has %s values', key, len(dev.vals[key]))
         if dev_key.find('bme280') >= 0 or dev_key.find('pm25') >= 0:
-            vtimes = [dt.datetime.fromisoformat(t) for t in dev.vals['time']]
             if dev_key.find('bme280') >= 0:
                 # TODO: should have common method for each of the graphs, rather than repeat code
                 senskey = 'temp_c'
                 iplt = axnum[senskey]
-                vals = dev.vals[senskey]
+                vtimes,vals = plot_points(dev_key, dev, senskey, raw_times)
                 vals = [val*1.8+32.0 for val in vals]   # TODO: should have selector for C or F
                 y0,y1 = calc_scale(vals, interval=5)
                 if senskey in yaxlim:
@@ -83,7 +84,7 @@ def make_plot(sensor_devs, sys_name='gn-pi-zero-2'):
                 ########
                 senskey = 'humidity'
                 iplt = axnum[senskey]
-                vals = dev.vals[senskey]
+                vtimes,vals = plot_points(dev_key, dev, senskey, raw_times)
                 y0,y1 = calc_scale(vals, interval=10)
                 if senskey in yaxlim:
                     yaxlim[senskey] = (min(yaxlim[senskey][0],y0), max(yaxlim[senskey][1],y1))
@@ -96,7 +97,7 @@ def make_plot(sensor_devs, sys_name='gn-pi-zero-2'):
                 ########
                 senskey = 'pressure'
                 iplt = axnum[senskey]
-                vals = dev.vals[senskey]
+                vtimes,vals = plot_points(dev_key, dev, senskey, raw_times)
                 y0,y1 = calc_scale(vals, interval=2)
                 if senskey in yaxlim:
                     yaxlim[senskey] = (min(yaxlim[senskey][0],y0), max(yaxlim[senskey][1],y1))
@@ -111,7 +112,8 @@ def make_plot(sensor_devs, sys_name='gn-pi-zero-2'):
                 #senskey = 'PM2_5'
                 senskey = 'pm25'
                 iplt = axnum[senskey]
-                vals = [int(v) for v in dev.vals[senskey]]
+                vtimes,vals = plot_points(dev_key, dev, senskey, raw_times)
+                vals = [int(v) for v in vals]
                 y0,y1 = calc_scale(vals, interval=10)
                 if senskey in yaxlim:
                     yaxlim[senskey] = (min(yaxlim[senskey][0],y0), max(yaxlim[senskey][1],y1))
@@ -125,6 +127,57 @@ def make_plot(sensor_devs, sys_name='gn-pi-zero-2'):
     axs[0].legend(loc="upper left")
     return fig,axs
 
+# history plot: field, title, conversion of the values
+HISTORY_FIELDS = (('temp_c', 'Temp F', lambda v: v*1.8+32.0), ('humidity', 'Humidity', None),
+                  ('pressure', 'Pressure', None), ('pm25', 'Air Quality 2.5', None))
+RES_NAMES = {300: '5 min', 3600: 'hourly', 86400: 'daily'}
+
+def make_history_plot(store, days, width=640, dpi=100):
+    '''
+    Plot the mean of each sensor with its min/max range, from the rollups.
+    The resolution is picked per series so there are about width points, one per pixel.
+    :param store: rollups.Rollups
+    :param days: days of history to show
+    :param width: plot width in pixels
+    :return: fig,axs
+    '''
+    fig,axs = plt.subplots(len(HISTORY_FIELDS), figsize=(width / dpi, 4.8), dpi=dpi)
+    topics = store.topics()
+    for ax,(field,title,convert) in zip(axs, HISTORY_FIELDS):
+        res_used = set()
+        for topic in sorted(topics):
+            if field not in topics[topic]:
+                continue
+            res,rows = store.history(topic, field, days * 86400, width)
+            if not rows:
+                continue
+            res_used.add(res)
+            times = [r[0] for r in rows]
+            lows,highs,means = [r[1] for r in rows],[r[2] for r in rows],[r[3] for r in rows]
+            if convert:
+                lows,highs,means = [convert(v) for v in lows],[convert(v) for v in highs],[convert(v) for v in means]
+            computer = topic.split('/')[1]
+            line, = ax.plot(times, means, label=computer[-6:])
+            ax.fill_between(times, lows, highs, color=line.get_color(), alpha=0.25, linewidth=0)
+        ax.yaxis.set_major_locator(plt.MaxNLocator(4))
+        ax.set_title('{} ({})'.format(title, ', '.join(RES_NAMES[r] for r in sorted(res_used))), y=1.0, pad=-14)
+    fig.autofmt_xdate()
+    axs[0].legend(loc="upper left")
+    return fig,axs
+
+def stream_history_plot(store, days, width=640):
+    '''
+    :return: base64 PNG of make_history_plot, for an IMG tag
+    '''
+    with metrics.plot_render.labels('png').time():
+        fig,axs = make_history_plot(store, days, width)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png')
+        img_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
+        buf.close()
+        plt.close(fig)
+    return img_base64
+
 def stream_plot(sensor_devs):
     '''
     Called when package is used for HTML display.
@@ -133,13 +186,15 @@ def stream_plot(sensor_devs):
     '''
     #global sensor_devs
     logger.debug('stream_plot: start')
-    fig,axs = make_plot(sensor_devs, sys_name=None)
-    # this technique from https://stackoverflow.com/questions/14824522/dynamically-serving-a-matplotlib-image-to-the-web-using-python
-    # it stuffs base64 encoded image into HTML IMG tag.
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    img_base64 = base64.b64encode(buf.getvalue()).decode('utf-8').replace('\n', '')
-    buf.close()
+    with metrics.plot_render.labels('png').time():
+        fig,axs = make_plot(sensor_devs, sys_name=None)
+        # this technique from https://stackoverflow.com/questions/14824522/dynamically-serving-a-matplotlib-image-to-the-web-using-python
+        # it stuffs base64 encoded image into HTML IMG tag.
+        buf = io.BytesIO()
+        plt.savefig(buf, format='png')
+        img_base64 = base64.b64encode(buf.getvalue()).decode('utf-8').replace('\n', '')
+        buf.close()
+        plt.close(fig)  # pyplot keeps every figure alive until closed
     #return send_file(img_base64, mimetype='image/png')
     sensor_devs = {}    # in Flask must delete sensor_devs after each plot
     return img_base64
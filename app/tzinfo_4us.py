@@ -1,4 +1,5 @@
 from datetime import tzinfo, timedelta, datetime, timezone
+from functools import lru_cache
 
 ZERO = timedelta(0)
 HOUR = timedelta(hours=1)
@@ -90,6 +91,7 @@ DSTEND_1987_2006 = datetime(1, 10, 25, 2)
 DSTSTART_1967_1986 = datetime(1, 4, 24, 2)
 DSTEND_1967_1986 = DSTEND_1987_2006
 
+@lru_cache(maxsize=None)    # called for every timestamp parsed, the answer only changes by year
 def us_dst_range(year):
     # Find start and end times for US DST. For years before 1967, return
     # start = end for no DST.
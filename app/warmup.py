@@ -0,0 +1,75 @@
+# Load everything a request needs before the first request arrives.
+# uwsgi imports app.py in the master and then forks the workers (unless lazy-apps is set),
+# so what is loaded here is shared by all workers, copy-on-write, and each worker is ready
+# to serve as soon as it is forked. app.py calls warmup() when it runs under uwsgi.
+#   python warmup.py        runs every step and prints how long each one took
+import datetime as dt
+import os
+import time
+
+import Config
+import logging
+import my_logger
+logger = my_logger.setup_logger(__name__, '../ow.log', level=logging.DEBUG)
+
+def load_templates():
+    '''
+    Compile every template into the shared jinja Environment.
+    '''
+    import OpenWeatherProvider as ow
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.html'):
+            ow.get_template(name)
+
+def load_tz():
+    '''
+    Fill the DST tables for this year and next, for every US zone.
+    '''
+    import OpenWeatherProvider as ow
+    now = dt.datetime.now()
+    for tz in ow.myTZ.values():
+        for year in (now.year, now.year + 1):
+            tz.utcoffset(now.replace(year=year, tzinfo=tz))
+
+def load_plot():
+    '''
+    Import matplotlib and draw one figure, which loads fonts and the Agg backend.
+    '''
+    import timeplot
+    fig,_ = timeplot.plt.subplots(1)
+    timeplot.plt.close(fig)
+
+def load_forecast():
+    '''
+    Fetch the forecast for the home location, so the first pages come from the cache.
+    '''
+    import OpenWeatherProvider as ow
+    ow.get_wx_all(Config.location)
+
+STEPS = {'templates': load_templates, 'tz': load_tz, 'plot': load_plot, 'forecast': load_forecast}
+
+def warmup(steps=None):
+    '''
+    Run the warmup steps. A step that fails is logged and skipped, the app still starts.
+    :param steps: names from STEPS, default Config.warmup_steps
+    :return: dict of step name to seconds taken, None for a step that failed
+    '''
+    if steps is None:
+        steps = Config.warmup_steps
+    times = {}
+    for name in steps:
+        t0 = time.perf_counter()
+        try:
+            STEPS[name]()
+            times[name] = time.perf_counter() - t0
+        except Exception as e:
+            logger.warning('warmup: %s failed: %s', name, e)
+            times[name] = None
+    logger.info('warmup: %s', ', '.join('{}={}'.format(name, 'failed' if t is None else '{:.3f}s'.format(t))
+                                         for name,t in times.items()))
+    return times
+
+if __name__ == '__main__':
+    for name,t in warmup(list(STEPS)).items():
+        print('{:10s} {}'.format(name, 'failed' if t is None else '{:.3f} s'.format(t)))
@@ -0,0 +1,27 @@
+# Benchmarks and test harnesses for the wx app.
+# Run them from the repository root, e.g.: python -m bench.bench_async
+# The app modules live in app/ and open files relative to it ('../ow.log', templates),
+# so the benchmarks work from inside app/ just like pi_uwsgi.ini does with chdir.
+import os
+import sys
+import tempfile
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(REPO_DIR, 'app')
+
+def use_app_dir():
+    '''
+    Make the app modules importable and chdir into app/.
+    ApiKeys.py is not in git; benchmarks never talk to the real OpenWeather,
+    so a placeholder key is used when it is missing.
+    The app logs to a temporary file (WX_LOG_FILE) instead of ow.log, so a run leaves the tree clean.
+    '''
+    os.environ.setdefault('WX_LOG_FILE', os.path.join(tempfile.gettempdir(), 'wx_bench.log'))
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    os.chdir(APP_DIR)
+    try:
+        import ApiKeys
+    except ImportError:
+        sys.modules['ApiKeys'] = types.SimpleNamespace(openweather_key='bench', google_maps_key='bench')
@@ -0,0 +1,54 @@
+# Compare the blocking urllib fetch (the original get_wx_all code) with async_fetch.
+# A local stub server answers each request after --delay seconds.
+#   python -m bench.bench_async --requests 20 --delay 0.2
+import argparse
+import json
+import threading
+import time
+from urllib.request import urlopen, Request
+
+from bench import use_app_dir
+from bench.stub_server import StubServer
+
+def urllib_sequential(urls):
+    for url in urls:
+        with urlopen(Request(url)) as response:
+            json.loads(response.read())
+
+def urllib_threads(urls):
+    # what uwsgi does with one thread per outstanding request
+    threads = [threading.Thread(target=urllib_sequential, args=([url],)) for url in urls]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def async_many(urls):
+    import async_fetch
+    results = async_fetch.get_many(urls, as_json=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        raise errors[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=20, help='number of concurrent fetches')
+    parser.add_argument('--delay', type=float, default=0.2, help='stub server response delay, seconds')
+    args = parser.parse_args()
+    use_app_dir()
+    server = StubServer(delay=args.delay).start()
+    urls = ['{}onecall?n={}'.format(server.url, i) for i in range(args.requests)]
+    results = {}
+    for name,func,threads in (('urllib_sequential', urllib_sequential, 1),
+                              ('urllib_threads', urllib_threads, args.requests),
+                              ('async_fetch', async_many, 1)):
+        t0 = time.perf_counter()
+        func(urls)
+        elapsed = time.perf_counter() - t0
+        results[name] = {'seconds': round(elapsed, 4), 'threads': threads}
+        print('{:20s} {:8.3f} s  threads={}'.format(name, elapsed, threads))
+    server.stop()
+    print(json.dumps(results))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# Shared cache backends: encoded sizes, get/set times, and API calls saved by sharing.
+#   python -m bench.bench_cache                  uses bench.fake_redis for the redis backend
+#   python -m bench.bench_cache --redis-url redis://pi1.local:6379/0
+# The node simulation runs N processes, each standing in for a Pi with its own in-process cache,
+# all asking for the same locations, and counts forecast fetches with and without the shared store.
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import statistics
+import tempfile
+import time
+
+from bench import use_app_dir, fixtures
+from bench.fake_redis import FakeRedisServer
+
+def sizes(bundle, home):
+    import shared_cache
+    import Config
+    result = {}
+    for name,value in (('forecast', bundle), ('home', home)):
+        row = {'pickle': len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))}
+        for codec in ('json', 'msgpack'):
+            Config.cache_codec = codec
+            if codec == 'msgpack' and shared_cache.msgpack is None:
+                continue
+            row[codec] = len(shared_cache.encode(value))
+        result[name] = row
+    Config.cache_codec = 'msgpack'
+    return result
+
+def time_backend(store, bundle, repeat=200):
+    def timed(func):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            func()
+            times.append((time.perf_counter() - t0) * 1000.0)
+        return round(statistics.median(times), 4)
+    key = 'forecast:bench'
+    store.set(key, bundle, 60)
+    assert store.get(key) == bundle, 'round trip changed the forecast'
+    return {'set_ms': timed(lambda: store.set(key, bundle, 60)),
+            'get_ms': timed(lambda: store.get(key)),
+            'get_miss_ms': timed(lambda: store.get('forecast:missing'))}
+
+def node(args):
+    '''
+    One simulated Pi: its own process and in-process cache, the shared store from Config.
+    :return: number of forecasts it fetched
+    '''
+    backend, url, locations, rounds, seed = args
+    use_app_dir()
+    import Config
+    Config.cache_backend = backend
+    Config.redis_url = url
+    import OpenWeatherProvider as ow
+    import forecast_cache
+    import providers
+    import shared_cache
+    from bench.run import install_fixture_provider
+    # forked from main(), so forget the parent's caches
+    shared_cache._cache = None
+    ow.forecasts = forecast_cache.ForecastCache()
+    install_fixture_provider(fixtures.onecall_payload())
+    fetched = []
+    source = providers._provider
+    fetch = source.fetch
+
+    def counting_fetch(lon, lat, timeout=None):
+        fetched.append((lon, lat))
+        time.sleep(0.05)    # upstream latency, so the nodes overlap
+        return fetch(lon, lat, timeout)
+    source.fetch = counting_fetch
+    rnd = random.Random(seed)
+    for _ in range(rounds):
+        for lon_lat in rnd.sample(locations, len(locations)):
+            ow.get_wx_all(lon_lat)
+    return len(fetched)
+
+def simulate(backend, url, n_nodes=4, n_locations=5, rounds=3):
+    # new locations for each run, so a real Redis doesn't answer from an earlier run
+    offset = random.random()
+    locations = ['{:.4f},{:.4f}'.format(-122.0 + i * 0.5 + offset, 37.0 + i * 0.25) for i in range(n_locations)]
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(n_nodes) as pool:
+        calls = pool.map(node, [(backend, url, locations, rounds, seed) for seed in range(n_nodes)])
+    return {'nodes': n_nodes, 'locations': n_locations, 'fetches': sum(calls), 'per_node': calls}
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the shared cache backends')
+    parser.add_argument('--redis-url', help='real Redis to test; default a bench.fake_redis server')
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--locations', type=int, default=5)
+    args = parser.parse_args()
+    use_app_dir()
+    import shared_cache
+    import OpenWeatherProvider as ow
+    from bench.run import install_fixture_provider
+    install_fixture_provider(fixtures.onecall_payload())
+    bundle = ow.get_wx_all()
+    home = 'iVBORw0KGgo' * 4000    # a ~44 KB sensor plot
+    fake = None
+    url = args.redis_url
+    if not url:
+        fake = FakeRedisServer().start()
+        url = fake.url
+    results = {'msgpack': shared_cache.msgpack is not None, 'sizes': sizes(bundle, home), 'backends': {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        stores = {'memory': shared_cache.MemoryCache(),
+                  'file': shared_cache.FileCache(os.path.join(tmpdir, 'files')),
+                  'sqlite': shared_cache.SqliteCache(os.path.join(tmpdir, 'cache.sqlite')),
+                  'redis': shared_cache.RedisCache(url)}
+        for name,store in stores.items():
+            results['backends'][name] = time_backend(store, bundle)
+    results['nodes'] = {'memory': simulate('memory', url, args.nodes, args.locations),
+                        'redis': simulate('redis', url, args.nodes, args.locations)}
+    if fake:
+        results['fake_redis_commands'] = fake.commands
+        fake.stop()
+    print(json.dumps(results, indent=1))
+
+if __name__ == '__main__':
+    main()
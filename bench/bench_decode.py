@@ -0,0 +1,86 @@
+# OneCall decode: json.loads of the whole response against selective_json, which keeps only the
+# fields the DataParse tables read. Checks that the parsed records come out the same either way.
+#   python -m bench.bench_decode
+# selective_json prunes in a json.loads object_hook; the 'stream' rows set Config.stream_json and
+# parse with ijson, when it is installed.
+import io
+import json
+import statistics
+import time
+import tracemalloc
+
+from bench import use_app_dir, fixtures
+
+def response(alerts=True):
+    '''
+    :return: bytes of a OneCall 3.0 response, with a weather alert as OpenWeather sends one.
+    The fixture records are from the 2.5 examples, so the fields 3.0 added are filled in.
+    '''
+    payload = fixtures.onecall_payload()
+    for rec in [payload['current']] + payload['hourly']:
+        rec.update({'visibility': 10000, 'wind_gust': round(rec['wind_speed'] * 1.6, 2), 'rain': {'1h': 0.21}})
+    for rec in payload['daily']:
+        rec.update({'moonrise': rec['dt'] + 7200, 'moonset': rec['dt'] + 50000, 'moon_phase': 0.25,
+                    'summary': 'Expect a day of partly cloudy with rain', 'wind_gust': 9.3, 'rain': 2.41})
+    if alerts:
+        payload['alerts'] = [{'sender_name': 'NWS San Francisco', 'event': 'Heat Advisory',
+                              'start': payload['current']['dt'], 'end': payload['current']['dt'] + 86400,
+                              'description': 'Hot temperatures expected. ' * 40, 'tags': ['Extreme temperature value']}]
+    return json.dumps(payload).encode('utf-8')
+
+def timed(func, repeat=50):
+    func()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return round(statistics.median(times), 4)
+
+def peak_kb(func):
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return round(peak / 1024, 1)
+
+def held_kb(func):
+    tracemalloc.start()
+    result = func()
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return round(held / 1024, 1)
+
+def parsed(ow, raw):
+    import providers
+    bundle = providers.OpenWeatherSource().normalize(raw, -122.08, 37.39)
+    p = ow.ParsedForecast(bundle, -8)
+    return [(r.values, r.display) for r in [p.current] + p.hourly + p.daily]
+
+def main():
+    use_app_dir()
+    import Config
+    import OpenWeatherProvider as ow
+    import selective_json
+    body = response()
+    decoders = {'json.loads': lambda: json.loads(body),
+                'selective_json.loads': lambda: selective_json.loads(body),
+                'selective_json.load': lambda: selective_json.load(io.BytesIO(body))}
+    expected = parsed(ow, json.loads(body))
+    results = {'ijson': selective_json.ijson is not None, 'body_kb': round(len(body) / 1024, 1)}
+    for stream in ((False, True) if selective_json.ijson else (False,)):
+        Config.stream_json = stream
+        for name,decode in decoders.items():
+            if stream and name == 'json.loads':
+                continue
+            assert parsed(ow, decode()) == expected, '{} changed the parsed forecast'.format(name)
+            results[name + (' stream' if stream else '')] = {'ms': timed(decode), 'peak_kb': peak_kb(decode),
+                                                             'held_kb': held_kb(decode)}
+    Config.stream_json = False
+    print(json.dumps(results, indent=1))
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# Import and startup time of the app modules, each measured in a fresh interpreter.
+# This is what a uwsgi worker (or the master, before it forks) pays before serving its first page.
+#   python -m bench.bench_import                  startup table
+#   python -m bench.bench_import --tree app       python -X importtime, slowest imports of "import app"
+# bench.run includes the same measurements, so they are compared against the baseline too.
+import argparse
+import statistics
+import subprocess
+import sys
+
+from bench import REPO_DIR
+
+# name: statement timed in the child, after bench.use_app_dir()
+STARTUP = {
+    'import OpenWeatherProvider': 'import OpenWeatherProvider',
+    'import timeplot': 'import timeplot',
+    'import app': 'import app',
+    'first /daily': ('import app\n'
+                     'from bench.run import install_fixture_provider\n'
+                     'install_fixture_provider(fixtures.onecall_payload())\n'
+                     'assert app.app.test_client().get("/daily").status_code == 200'),
+    'warmup templates,tz,plot': 'import app, warmup\nwarmup.warmup(("templates", "tz", "plot"))',
+}
+
+CHILD = '''
+import sys, time
+sys.path.insert(0, {repo!r})
+import bench
+from bench import fixtures
+bench.use_app_dir()
+t0 = time.perf_counter()
+{stmt}
+print(time.perf_counter() - t0)
+'''
+
+def child_time(stmt):
+    '''
+    :return: seconds the statement took in a new interpreter
+    '''
+    out = subprocess.check_output([sys.executable, '-c', CHILD.format(repo=REPO_DIR, stmt=stmt)], cwd=REPO_DIR)
+    return float(out.decode().strip().splitlines()[-1])
+
+def measure_startup(stmt, repeat=5):
+    '''
+    Same result layout as bench.run.measure, in milliseconds.
+    '''
+    times = [child_time(stmt) * 1000.0 for _ in range(repeat)]
+    return {'min_ms': round(min(times), 4), 'median_ms': round(statistics.median(times), 4),
+            'mean_ms': round(statistics.mean(times), 4), 'repeat': repeat}
+
+def import_tree(module, top=25):
+    '''
+    :return: the slowest imports of module by cumulative time, from python -X importtime
+    '''
+    code = 'import sys\nsys.path.insert(0, {!r})\nimport bench\nbench.use_app_dir()\nimport {}'.format(REPO_DIR, module)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO_DIR,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    rows = []
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # import time:       512 |       1024 |   matplotlib.pyplot
+        self_us,cumulative_us,name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description='import and startup time of the wx app')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--tree', metavar='MODULE', help='show the slowest imports of MODULE')
+    args = parser.parse_args()
+    if args.tree:
+        print('{:>10s} {:>10s}  module'.format('cum ms', 'self ms'))
+        for cumulative,self_us,name in import_tree(args.tree):
+            print('{:10.1f} {:10.1f}  {}'.format(cumulative / 1000.0, self_us / 1000.0, name))
+        return
+    for name,stmt in STARTUP.items():
+        res = measure_startup(stmt, args.repeat)
+        print('{:28s} {:10.1f} ms median  {:10.1f} ms min'.format(name, res['median_ms'], res['min_ms']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Memory held by parsed forecasts, for 10 and 100 cached locations.
+#   python -m bench.bench_memory
+# Compares the raw forecasts, the parsed records as they were (a dict of [value, units] per record and
+# one dict of formatted strings per unit system), and the slotted records with shared strings.
+# The old layout is rebuilt here from the new records, copying what the old code allocated per record.
+import datetime as dt
+import json
+import tracemalloc
+
+from bench import use_app_dir, fixtures
+
+def traced(build):
+    '''
+    :return: (result of build(), bytes allocated by it and still held)
+    '''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, used
+
+def copy_str(s):
+    return s.encode().decode() if isinstance(s, str) else s
+
+def legacy_record(record):
+    '''
+    :return: the dicts a DataParse held before it had __slots__, with their own strings and datetimes
+    '''
+    import OpenWeatherProvider as ow
+    obs = {}
+    for name,value,unit in zip(record.fields, record.values, record.units):
+        if unit is not None:
+            obs[name] = [value.replace() if isinstance(value, dt.datetime) else value, unit]
+    display = {}
+    for units,formatted in zip((ow.METRIC, ow.US), record.display):
+        display[units] = {name: (copy_str(f[0]), f[1], copy_str(f[2]))
+                          for name,f in zip(record.fields, formatted) if f is not None}
+    return {'obs': obs, 'display': display}
+
+def legacy_forecast(parsed):
+    return {'current': legacy_record(parsed.current),
+            'hourly': [legacy_record(r) for r in parsed.hourly],
+            'daily': [legacy_record(r) for r in parsed.daily]}
+
+def measure(n_locations, tzoff=-8):
+    import OpenWeatherProvider as ow
+    from bench.run import install_fixture_provider
+    import providers
+
+    install_fixture_provider(fixtures.onecall_payload())
+    source = providers._provider
+
+    def fetch_all():
+        # each location decoded from its own JSON text, as get_wx_all does
+        return [source.normalize(json.loads(json.dumps(fixtures.onecall_payload(seed=i))),
+                                 -122.0 + i * 0.01, 37.0 + i * 0.01)
+                for i in range(n_locations)]
+    bundles, raw = traced(fetch_all)
+    ow._shared.clear()
+    ow._formatted.clear()
+    parsed, slotted = traced(lambda: [ow.ParsedForecast(b, tzoff) for b in bundles])
+    _, legacy = traced(lambda: [legacy_forecast(p) for p in parsed])
+    records = sum(1 + len(p.hourly) + len(p.daily) for p in parsed)
+    return {'locations': n_locations, 'records': records,
+            'raw_kb': round(raw / 1024, 1),
+            'legacy_kb': round(legacy / 1024, 1),
+            'slotted_kb': round(slotted / 1024, 1),
+            'slotted_per_record_b': round(slotted / records),
+            'legacy_per_record_b': round(legacy / records),
+            'shared_strings': len(ow._shared) + len(ow._formatted)}
+
+def main():
+    use_app_dir()
+    results = [measure(n) for n in (10, 100)]
+    print(json.dumps(results, indent=1))
+    return results
+
+if __name__ == '__main__':
+    main()
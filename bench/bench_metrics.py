@@ -0,0 +1,30 @@
+# Cost of recording metrics, to check instrumentation stays below 1% of request time.
+#   python -m bench.bench_metrics
+import json
+import time
+
+from bench import use_app_dir
+
+def main(n=100000):
+    use_app_dir()
+    import metrics
+    hist = metrics.Histogram('bench_seconds', 'benchmark only', ['stage'])
+    counter = metrics.Counter('bench_total', 'benchmark only', ['cache'])
+    t0 = time.perf_counter()
+    for _ in range(n):
+        with hist.labels('render').time():
+            pass
+    timer_us = (time.perf_counter() - t0) / n * 1e6
+    t0 = time.perf_counter()
+    for _ in range(n):
+        counter.labels('forecast').inc()
+    counter_us = (time.perf_counter() - t0) / n * 1e6
+    # a request records about 10 timings and 5 counters
+    per_request_us = 10 * timer_us + 5 * counter_us
+    results = {'timer_us': round(timer_us, 3), 'counter_us': round(counter_us, 3),
+               'per_request_us': round(per_request_us, 1)}
+    print(json.dumps(results))
+    return results
+
+if __name__ == '__main__':
+    main()
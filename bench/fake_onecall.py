@@ -0,0 +1,111 @@
+# Local stand-in for the OpenWeather OneCall API.
+# Serves bench.fixtures payloads with configurable latency, jitter and error rate,
+# and counts the calls so a load test can report how many reached "OpenWeather".
+#   python -m bench.fake_onecall --port 8089 --latency 0.3 --jitter 0.1 --error-rate 0.02
+# then run the app with WX_OPENWEATHER_PREFIX=http://127.0.0.1:8089/data/3.0/
+# GET /stats returns {"calls": n, "errors": n}.
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from bench import fixtures
+
+class OneCallHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        if parts.path == '/stats':
+            self._send(200, json.dumps(server.stats()).encode())
+            return
+        if not parts.path.endswith('/onecall'):
+            self._send(404, b'{"cod":404,"message":"not found"}')
+            return
+        with server.lock:
+            server.calls += 1
+        delay = max(0.0, server.latency + random.uniform(-server.jitter, server.jitter))
+        time.sleep(delay)
+        if random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            self._send(503, b'{"cod":503,"message":"service unavailable"}')
+            return
+        query = parse_qs(parts.query)
+        body = server.payload_for(query.get('lon', [''])[0], query.get('lat', [''])[0], query.get('exclude', [''])[0])
+        with server.lock:
+            server.bytes += len(body)
+        self._send(200, body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeOneCallServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port=0, latency=0.2, jitter=0.0, error_rate=0.0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), OneCallHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0      # response bodies sent
+        self.lock = threading.Lock()
+        self.payloads = {}
+
+    def payload_for(self, lon, lat, exclude=''):
+        # current obs start at this hour, so pages look live
+        hour = int(time.time()) // 3600 * 3600
+        key = (lon, lat, hour, exclude)
+        if key not in self.payloads:
+            payload = fixtures.onecall_payload(start=hour, seed=hash((lon, lat)) & 0xffff)
+            payload = {k:v for k,v in payload.items() if k not in exclude.split(',')}
+            payloads = {k:v for k,v in self.payloads.items() if k[2] == hour}
+            payloads[key] = json.dumps(payload).encode()
+            self.payloads = payloads
+        return self.payloads[key]
+
+    def stats(self):
+        return {'calls': self.calls, 'errors': self.errors, 'bytes': self.bytes}
+
+    @property
+    def prefix(self):
+        return 'http://127.0.0.1:{}/data/3.0/'.format(self.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='fake OpenWeather OneCall server')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered with 503')
+    args = parser.parse_args()
+    server = FakeOneCallServer(args.port, args.latency, args.jitter, args.error_rate)
+    print('serving OneCall at {}'.format(server.prefix))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
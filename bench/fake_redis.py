@@ -0,0 +1,137 @@
+# Local stand-in for a Redis server, enough for shared_cache.RedisCache:
+# PING, AUTH, SELECT, GET, SET (EX, PX, NX, XX), DEL, EXISTS, DBSIZE, FLUSHDB, and EVAL of the
+# compare-and-delete script that releases a lease. Counts commands so tests can see the traffic.
+#   python -m bench.fake_redis --port 6390
+# then run the app with WX_CACHE_BACKEND=redis WX_REDIS_URL=redis://127.0.0.1:6390/0
+import argparse
+import socketserver
+import threading
+import time
+
+from bench import use_app_dir
+
+class RedisHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()     # inline command, as typed in telnet
+        args = []
+        for _ in range(int(line[1:])):
+            n = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(n + 2)[:-2])
+        return args
+
+    def reply(self, value):
+        if value is None:
+            out = b'$-1\r\n'
+        elif isinstance(value, Exception):
+            out = b'-ERR ' + str(value).encode() + b'\r\n'
+        elif value is True:
+            out = b'+OK\r\n'
+        elif isinstance(value, int):
+            out = b':%d\r\n' % value
+        else:
+            out = b'$%d\r\n%s\r\n' % (len(value), value)
+        self.wfile.write(out)
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            try:
+                self.reply(self.server.execute(args))
+            except Exception as e:
+                self.reply(e)
+            self.wfile.flush()
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port), RedisHandler)
+        self.data = {}      # key to (value, expires or None)
+        self.lock = threading.Lock()
+        self.commands = {}  # command name to count
+
+    @property
+    def url(self):
+        return 'redis://127.0.0.1:{}/0'.format(self.server_address[1])
+
+    def _live(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] < time.time():
+            del self.data[key]
+            return None
+        return entry
+
+    def execute(self, args):
+        cmd = args[0].upper().decode()
+        with self.lock:
+            self.commands[cmd] = self.commands.get(cmd, 0) + 1
+            if cmd == 'PING':
+                return True
+            if cmd in ('AUTH', 'SELECT'):
+                return True
+            if cmd == 'GET':
+                entry = self._live(args[1])
+                return None if entry is None else entry[0]
+            if cmd == 'SET':
+                key,value = args[1], args[2]
+                expires = None
+                opts = [a.upper() for a in args[3:]]
+                if b'EX' in opts:
+                    expires = time.time() + int(args[3 + opts.index(b'EX') + 1])
+                if b'PX' in opts:
+                    expires = time.time() + int(args[3 + opts.index(b'PX') + 1]) / 1000.0
+                exists = self._live(key) is not None
+                if (b'NX' in opts and exists) or (b'XX' in opts and not exists):
+                    return None
+                self.data[key] = (value, expires)
+                return True
+            if cmd == 'DEL':
+                return sum(1 for key in args[1:] if self._live(key) is not None and self.data.pop(key))
+            if cmd == 'EXISTS':
+                return sum(1 for key in args[1:] if self._live(key) is not None)
+            if cmd == 'DBSIZE':
+                return sum(1 for key in list(self.data) if self._live(key) is not None)
+            if cmd == 'FLUSHDB':
+                self.data.clear()
+                return True
+            if cmd == 'EVAL':
+                import shared_cache     # importable after use_app_dir()
+                if args[1].decode() != shared_cache.DELETE_IF_SCRIPT:
+                    raise ValueError('only the shared_cache delete-if script is supported')
+                key,value = args[3], args[4]
+                entry = self._live(key)
+                if entry is not None and entry[0] == value:
+                    del self.data[key]
+                    return 1
+                return 0
+        raise ValueError("unknown command '{}'".format(cmd))
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='fake Redis server for the shared cache')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    use_app_dir()
+    server = FakeRedisServer(args.port)
+    print('serving {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Recorded-style inputs for the benchmarks, made without network access.
+# OneCall payloads are seeded from the records in examples/forecasts.txt and examples/curr_obs.txt
+# (those are in Kelvin, the app asks OpenWeather for metric) and filled out to 48 hours and 8 days.
+# Sensor logs are JSON lines like the MQTT client writes, a bme280 and a pm25 reading every 5 minutes.
+import copy
+import datetime as dt
+import json
+import math
+import os
+import random
+
+from bench import REPO_DIR
+
+EXAMPLES_DIR = os.path.join(REPO_DIR, 'examples')
+KELVIN_KEYS = ('temp', 'feels_like', 'dew_point', 'temp_min', 'temp_max')
+
+def _first_record(text, marker):
+    '''
+    The example files are annotated JSON with "..." in place of repeated records,
+    so pull out the first complete {...} that follows marker.
+    '''
+    start = text.index('{', text.index(marker))
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] == '{':
+            depth += 1
+        elif text[i] == '}':
+            depth -= 1
+            if depth == 0:
+                return json.loads(text[start:i+1])
+    raise ValueError('no record after {}'.format(marker))
+
+def _to_celsius(rec):
+    for key in KELVIN_KEYS:
+        if isinstance(rec.get(key), dict):
+            rec[key] = {k: round(v - 273.15, 2) for k,v in rec[key].items()}
+        elif key in rec:
+            rec[key] = round(rec[key] - 273.15, 2)
+    return rec
+
+def example_records():
+    '''
+    :return: (current, hourly, daily) records from the example files, in OneCall layout and metric
+    '''
+    with open(os.path.join(EXAMPLES_DIR, 'forecasts.txt')) as f:
+        fcst = f.read()
+    with open(os.path.join(EXAMPLES_DIR, 'curr_obs.txt')) as f:
+        obs = _first_record(f.read(), 'API response')
+    hourly = _to_celsius(_first_record(fcst, '"hourly"'))
+    daily = _to_celsius(_first_record(fcst, '"daily"'))
+    # the current weather API nests values differently than OneCall 'current'
+    main = _to_celsius(dict(obs['main']))
+    current = {
+        'dt': obs['dt'], 'sunrise': obs['sys']['sunrise'], 'sunset': obs['sys']['sunset'],
+        'temp': main['temp'], 'feels_like': main['feels_like'], 'pressure': main['pressure'],
+        'humidity': main['humidity'], 'dew_point': hourly['dew_point'], 'uvi': hourly['uvi'],
+        'clouds': obs['clouds']['all'], 'visibility': obs['visibility'],
+        'wind_speed': obs['wind']['speed'], 'wind_deg': obs['wind']['deg'], 'weather': obs['weather'],
+    }
+    return current, hourly, daily
+
+def onecall_payload(start=1595242800, n_hours=48, n_days=8, seed=1):
+    '''
+    A full OneCall response ("exclude=minutely", metric).
+    :param start: unix time of the current observation, on the hour
+    :param seed: same seed, same payload
+    '''
+    rnd = random.Random(seed)
+    current, hour_rec, day_rec = example_records()
+    current = copy.deepcopy(current)
+    current['dt'] = start
+    hourly = []
+    for i in range(n_hours):
+        rec = copy.deepcopy(hour_rec)
+        rec['dt'] = start + 3600 * i
+        diurnal = 5.0 * math.sin(2 * math.pi * (i % 24 - 9) / 24.0)
+        rec['temp'] = round(hour_rec['temp'] + diurnal + rnd.uniform(-0.5, 0.5), 2)
+        rec['feels_like'] = round(rec['temp'] - 2.0, 2)
+        rec['wind_speed'] = round(rnd.uniform(0.5, 8.0), 2)
+        rec['wind_deg'] = rnd.randrange(360)
+        rec['pop'] = round(rnd.uniform(0, 1), 2)
+        hourly.append(rec)
+    daily = []
+    for i in range(n_days):
+        rec = copy.deepcopy(day_rec)
+        rec['dt'] = start + 86400 * i
+        rec['sunrise'] = current['sunrise'] + 86400 * i
+        rec['sunset'] = current['sunset'] + 86400 * i
+        shift = rnd.uniform(-3, 3)
+        rec['temp'] = {k: round(v + shift, 2) for k,v in day_rec['temp'].items()}
+        rec['pop'] = round(rnd.uniform(0, 1), 2)
+        daily.append(rec)
+    return {'lat': 37.39, 'lon': -122.08, 'timezone': 'America/Los_Angeles', 'timezone_offset': -25200,
+            'current': current, 'hourly': hourly, 'daily': daily}
+
+SENSOR_TOPICS = ('gn_home/gn-pi-zero-2/bme280/J', 'gn_home/gn-pi-zero-2/pm25/J')
+LOG_DAYS = {'1d': 1, '1w': 7, '1m': 30}
+
+def sensor_lines(days=1, start='2023-01-03T00:00:10', interval=300, seed=1):
+    '''
+    :return: list of JSON lines, as written by the MQTT client to mqtt_rcv.log
+    '''
+    rnd = random.Random(seed)
+    t0 = dt.datetime.fromisoformat(start)
+    lines = []
+    for i in range(int(days * 86400 / interval)):
+        t = (t0 + dt.timedelta(seconds=i * interval)).isoformat()
+        temp_c = 15.0 + 5.0 * math.sin(2 * math.pi * (i * interval / 86400.0 - 0.4)) + rnd.uniform(-0.3, 0.3)
+        lines.append(json.dumps({'time': t, 'temp_c': '{:.1f}'.format(temp_c), 'temp_f': '{:.1f}'.format(temp_c * 1.8 + 32),
+                                 'humidity': '{:.1f}'.format(rnd.uniform(40, 80)),
+                                 'pressure': '{:.1f}'.format(1012 + rnd.uniform(-4, 4)), 'topic': SENSOR_TOPICS[0]}))
+        lines.append(json.dumps({'time': t, 'pm10': rnd.randrange(5), 'pm25': rnd.randrange(10),
+                                 'pm100': rnd.randrange(15), 'topic': SENSOR_TOPICS[1]}))
+    return lines
+
+def write_sensor_log(path, days=1, **kwargs):
+    with open(path, 'w') as f:
+        f.write('\n'.join(sensor_lines(days, **kwargs)) + '\n')
+    return path
@@ -0,0 +1,189 @@
+# Load test: drive the wx app with concurrent clients and report throughput and latency.
+# OpenWeather is replaced by bench.fake_onecall, so the number of upstream calls is known.
+#
+# Spawn uwsgi with the processes/threads to size (needs uwsgi installed), app and fake server included:
+#   python -m bench.loadtest --spawn uwsgi --processes 1 --threads 2 --concurrency 8 --duration 30
+# Or use the Flask development server when uwsgi is not available:
+#   python -m bench.loadtest --spawn flask --concurrency 8
+# Or test an app that is already running, e.g. on the Pi behind nginx, started with
+# WX_OPENWEATHER_PREFIX pointing at a fake server started by hand (python -m bench.fake_onecall):
+#   python -m bench.loadtest --url http://pi.local/ --fake-stats http://127.0.0.1:8089/stats
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import urlopen
+from urllib.error import URLError, HTTPError
+
+from bench import APP_DIR, fixtures, use_app_dir
+from bench.fake_onecall import FakeOneCallServer
+from bench.fake_redis import FakeRedisServer
+
+DEFAULT_PATHS = '/now,/daily,/hourly_divs'
+
+def percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(len(sorted_vals) - 1, int(q * len(sorted_vals)))]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def spawn_app(kind, port, env, processes=1, threads=2):
+    '''
+    Start the app in a subprocess, the way pi_uwsgi.ini runs it.
+    :param kind: 'uwsgi' or 'flask'
+    '''
+    if kind == 'uwsgi':
+        if not shutil.which('uwsgi'):
+            sys.exit('uwsgi is not installed, use --spawn flask')
+        cmd = ['uwsgi', '--http', '127.0.0.1:{}'.format(port), '--chdir', APP_DIR, '--wsgi-file', 'app.py',
+               '--callable', 'app', '--master', '--processes', str(processes), '--threads', str(threads),
+               '--disable-logging', '--die-on-term']
+    else:
+        cmd = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads']
+    proc = subprocess.Popen(cmd, cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}/'.format(port)
+    for _ in range(100):
+        try:
+            urlopen(url, timeout=1).read()
+            return proc, url
+        except (URLError, ConnectionError, OSError):
+            if proc.poll() is not None:
+                sys.exit('{} exited with status {}'.format(kind, proc.returncode))
+            time.sleep(0.2)
+    proc.terminate()
+    sys.exit('{} did not start'.format(kind))
+
+def worker(base_url, paths, query, deadline, max_requests, results, lock, timeout):
+    while time.monotonic() < deadline:
+        with lock:
+            if max_requests and len(results) >= max_requests:
+                return
+        path = random.choice(paths)
+        t0 = time.perf_counter()
+        status = 0
+        try:
+            with urlopen(base_url.rstrip('/') + path + query, timeout=timeout) as response:
+                response.read()
+                status = response.status
+        except HTTPError as e:
+            status = e.code
+        except (URLError, OSError):
+            status = -1     # connection refused, timeout
+        elapsed = time.perf_counter() - t0
+        with lock:
+            results.append((path, status, elapsed))
+
+def summarize(results, seconds):
+    def stats(rows):
+        lat = sorted(r[2] * 1000.0 for r in rows if r[1] == 200)
+        return {'requests': len(rows), 'errors': sum(1 for r in rows if r[1] != 200),
+                'rps': round(len(rows) / seconds, 2) if seconds else 0.0,
+                'p50_ms': round(percentile(lat, 0.50), 2), 'p95_ms': round(percentile(lat, 0.95), 2),
+                'p99_ms': round(percentile(lat, 0.99), 2)}
+    summary = {'all': stats(results)}
+    for path in sorted(set(r[0] for r in results)):
+        summary[path] = stats([r for r in results if r[0] == path])
+    return summary
+
+def get_calls(stats_url):
+    if not stats_url:
+        return None
+    with urlopen(stats_url, timeout=5) as response:
+        return json.loads(response.read())['calls']
+
+def main():
+    parser = argparse.ArgumentParser(description='load test for the wx app')
+    parser.add_argument('--url', help='base URL of a running app; omit with --spawn')
+    parser.add_argument('--spawn', choices=('uwsgi', 'flask'), help='start the app and a fake OneCall server')
+    parser.add_argument('--processes', type=int, default=1, help='uwsgi processes, as in pi_uwsgi.ini')
+    parser.add_argument('--threads', type=int, default=2, help='uwsgi threads, as in pi_uwsgi.ini')
+    parser.add_argument('--cache', choices=('memory', 'file', 'sqlite', 'redis'), default='memory',
+                        help='Config.cache_backend of the spawned app; redis uses a bench.fake_redis server')
+    parser.add_argument('--paths', default=DEFAULT_PATHS, help='comma separated routes to request')
+    parser.add_argument('--query', default='', help='query string added to every path, e.g. "?lon_lat=-121.95,36.97"')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds')
+    parser.add_argument('--requests', type=int, default=0, help='stop after this many requests')
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--latency', type=float, default=0.3, help='fake OneCall latency, seconds')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--fake-stats', help='stats URL of a fake_onecall started by hand')
+    parser.add_argument('--out', help='write the report JSON here')
+    args = parser.parse_args()
+    if not args.url and not args.spawn:
+        parser.error('give --url or --spawn')
+
+    proc = None
+    fake = None
+    fake_redis = None
+    tmpdir = tempfile.mkdtemp(prefix='wx_load_')
+    stats_url = args.fake_stats
+    base_url = args.url
+    try:
+        if args.spawn:
+            fake = FakeOneCallServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate).start()
+            stats_url = 'http://127.0.0.1:{}/stats'.format(fake.server_address[1])
+            env = dict(os.environ, WX_OPENWEATHER_PREFIX=fake.prefix,
+                       WX_SENSOR_LOG=fixtures.write_sensor_log(os.path.join(tmpdir, 'mqtt_rcv.log'), 1),
+                       WX_CACHE_BACKEND=args.cache, WX_CACHE_PATH=os.path.join(tmpdir, 'wx_cache.sqlite'),
+                       WX_CACHE_DIR=os.path.join(tmpdir, 'cache'), WX_ROLLUP_PATH=os.path.join(tmpdir, 'rollups.json'))
+            if args.cache == 'redis':
+                use_app_dir()   # fake_redis checks scripts against shared_cache
+                fake_redis = FakeRedisServer().start()
+                env['WX_REDIS_URL'] = fake_redis.url
+            if not os.path.exists(os.path.join(APP_DIR, 'ApiKeys.py')):
+                # the fake server takes any key
+                with open(os.path.join(tmpdir, 'ApiKeys.py'), 'w') as f:
+                    f.write("openweather_key = 'loadtest'\n")
+                env['PYTHONPATH'] = os.pathsep.join(filter(None, [tmpdir, env.get('PYTHONPATH')]))
+            proc, base_url = spawn_app(args.spawn, free_port(), env, args.processes, args.threads)
+        paths = [p.strip() for p in args.paths.split(',') if p.strip()]
+        calls0 = get_calls(stats_url)
+        results = []
+        lock = threading.Lock()
+        t0 = time.monotonic()
+        deadline = t0 + args.duration
+        threads = [threading.Thread(target=worker, args=(base_url, paths, args.query, deadline, args.requests,
+                                                         results, lock, args.timeout))
+                   for _ in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        seconds = time.monotonic() - t0
+        calls1 = get_calls(stats_url)
+        report = {'config': {'spawn': args.spawn, 'processes': args.processes, 'threads': args.threads, 'cache': args.cache,
+                             'concurrency': args.concurrency, 'paths': paths, 'latency': args.latency,
+                             'jitter': args.jitter, 'error_rate': args.error_rate},
+                  'seconds': round(seconds, 2),
+                  'upstream_calls': None if calls0 is None else calls1 - calls0,
+                  'results': summarize(results, seconds)}
+        text = json.dumps(report, indent=1)
+        print(text)
+        if args.out:
+            with open(args.out, 'w') as f:
+                f.write(text)
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(10)
+        if fake:
+            fake.stop()
+        if fake_redis:
+            fake_redis.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
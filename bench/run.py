@@ -0,0 +1,247 @@
+# Offline benchmark suite.
+# Times the parse, page build, sensor log and plot code in isolation, and every Flask route
+# end to end through the test client. Forecasts are replayed from bench.fixtures, nothing
+# touches the network. Results are JSON so a run can be compared with a stored baseline:
+#   python -m bench.run --out bench_output.json
+#   python -m bench.run --baseline bench/baseline.json --threshold 0.2
+# Run it on the Pi for numbers that mean anything; relative changes are what to look at.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import use_app_dir, REPO_DIR
+from bench import fixtures, bench_import
+
+def measure(func, repeat=20):
+    '''
+    Call func once to warm up, then repeat times.
+    :return: dict of timings in milliseconds
+    '''
+    func()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return {'min_ms': round(min(times), 4), 'median_ms': round(statistics.median(times), 4),
+            'mean_ms': round(statistics.mean(times), 4), 'repeat': repeat}
+
+def install_fixture_provider(payload):
+    '''
+    Make get_wx_all replay payload instead of calling OpenWeather.
+    providers can only be imported after use_app_dir(), hence the class inside.
+    '''
+    import providers
+
+    class FixtureSource(providers.OpenWeatherSource):
+        name = 'fixture'
+
+        def fetch(self, lon, lat, timeout=None, exclude='minutely'):
+            raw = {section: v for section,v in payload.items() if section not in exclude.split(',')}
+            return self.normalize(raw, lon, lat, exclude)
+
+        async def fetch_async(self, lon, lat, exclude='minutely'):
+            return self.fetch(lon, lat, exclude=exclude)
+    providers._provider = FixtureSource()
+
+def sensor_logs(tmpdir):
+    return {label: fixtures.write_sensor_log(os.path.join(tmpdir, 'mqtt_rcv_{}.log'.format(label)), days)
+            for label,days in fixtures.LOG_DAYS.items()}
+
+def suite(tmpdir, quick=False):
+    '''
+    :return: list of (name, func, repeat)
+    '''
+    import Config
+    import OpenWeatherProvider as ow
+    import rollups
+    import sensor_in
+    import shared_cache
+    import svgplot
+    import tail
+    import timeplot
+
+    r = 3 if quick else 1    # divide repeats when quick
+    payload = fixtures.onecall_payload()
+    install_fixture_provider(payload)
+    bundle = ow.get_wx_all()
+    curr = ow.parse_wx_curr(bundle)
+    hour = ow.parse_wx_hourly(bundle)
+    day = ow.parse_wx_daily(bundle)
+    logs = sensor_logs(tmpdir)
+    Config.sensor_log = logs['1d']
+    Config.rollup_path = os.path.join(tmpdir, 'rollups.json')
+    sample_line = fixtures.sensor_lines(1)[0]
+
+    def load(label):
+        # from scratch: read_log only reads new lines, and rollups skip readings they have counted
+        sensor_in.reset()
+        rollups.store = rollups.Rollups()
+        sensor_in.read_log(logs[label])
+
+    def clear_caches():
+        ow.forecasts.entries.clear()
+        shared_cache.get_cache().entries.clear()    # the default MemoryCache
+        sensor_in.reset()
+        ow.fragments.clear()
+        ow._parsed.clear()
+        ow._parsed_sections.clear()
+
+    def uncached(func):
+        # as on the first request after a new forecast, every DIV is rendered
+        def wrapped():
+            ow.fragments.clear()
+            return func()
+        return wrapped
+
+    def fresh(func):
+        # each call reads the sensor log from scratch and draws the plot, as /now does on a cache miss
+        def wrapped():
+            clear_caches()
+            return func()
+        return wrapped
+
+    def tail_log(label):
+        with open(logs[label], 'r') as f:
+            tail.tail(f, lines=4)
+
+    cases = [
+        ('json.loads onecall', lambda: json.loads(json.dumps(payload)), 50//r),
+        ('DataParse CurrentObs', lambda: ow.parse_wx_curr(bundle), 200//r),
+        ('DataParse FcstHourlyData', lambda: ow.parse_wx_hourly(bundle, 1), 200//r),
+        ('DataParse FcstDailyData', lambda: ow.parse_wx_daily(bundle, 1), 200//r),
+        # the whole forecast, parsed and formatted once when it is first used
+        ('ParsedForecast', lambda: ow.ParsedForecast(bundle), 20//r or 1),
+        ('getObsStr', lambda: day.getObsStr('temp_max'), 2000//r),
+        ('make_wx_current', fresh(lambda: ow.make_wx_current(curr, heading='Current Weather')), 5//r or 1),
+        ('make_hourly_fcst_page', uncached(lambda: ow.make_hourly_fcst_page(bundle)), 50//r),
+        ('make_hourly_fcst_page cached', lambda: ow.make_hourly_fcst_page(bundle), 50//r),
+        ('make_hourly_divs', uncached(lambda: ow.make_hourly_divs(bundle, hours=[1,2,3])), 50//r),
+        ('make_wx_hourly', lambda: ow.make_wx_hourly(hour), 50//r),
+        ('make_daily_fcst_page', uncached(lambda: ow.make_daily_fcst_page(bundle)), 50//r),
+        ('make_daily_fcst_page cached', lambda: ow.make_daily_fcst_page(bundle), 50//r),
+        ('make_wx_daily', lambda: ow.make_wx_daily(day), 50//r),
+        ('log_parse_json line', lambda: sensor_in.log_parse_json(sample_line), 2000//r),
+    ]
+    for label in fixtures.LOG_DAYS:
+        cases.append(('read_log {}'.format(label), lambda label=label: load(label), (20 if label == '1d' else 3)//r or 1))
+        cases.append(('tail.tail {}'.format(label), lambda label=label: tail_log(label), 200//r))
+    for label in ('1d', '1w') if quick else fixtures.LOG_DAYS:
+        load(label)
+        devs = sensor_in.store.snapshot()
+        cases.append(('stream_plot {}'.format(label), lambda devs=devs: timeplot.stream_plot(devs), 3 if label == '1d' else 1))
+        cases.append(('svgplot.make_svg {}'.format(label), lambda devs=devs: svgplot.make_svg(devs), 10//r or 1))
+    load('1d')
+    cases.append(('read_log 1d no new lines', lambda: sensor_in.read_log(logs['1d']), 200//r))
+    # the home sensors box, from the latest-value index instead of tailing the log
+    cases.append(('get_home_sensors', ow.get_home_sensors, 2000//r))
+    # a month of rollups: the plot reads about 720 hourly points per series instead of 8640 readings
+    load('1m')
+    month = rollups.store
+    topic = fixtures.SENSOR_TOPICS[0]
+    cases.append(('rollups history 30d', lambda: month.history(topic, 'temp_c', 30 * 86400, 640), 200//r))
+    cases.append(('stream_history_plot 30d', lambda: timeplot.stream_history_plot(month, 30), 3))
+    # end to end, caches cleared so each request parses the replayed payload
+    import app as wxapp
+    client = wxapp.app.test_client()
+
+    def route(path, cached=False):
+        def get():
+            if not cached:
+                clear_caches()
+            response = client.get(path)
+            assert response.status_code == 200, '{} returned {}'.format(path, response.status_code)
+        return get
+    for path,repeat in (('/now', 3), ('/now?plot=svg', 10), ('/daily', 30), ('/hourly_divs', 30), ('/hourly', 30),
+                        ('/one_day', 30), ('/one_hour', 30), ('/all_now', 30), ('/hourly_chart.svg', 30)):
+        cases.append(('route {}'.format(path), route(path), max(1, repeat//r)))
+    cases.append(('route /dashboard?plot=svg', route('/dashboard?plot=svg'), 10//r))
+    cases.append(('route /now cached', route('/now', cached=True), 30//r))
+    # forecast panels from the fragment cache, only the sensor panel is rendered
+    cases.append(('route /dashboard?plot=svg cached', route('/dashboard?plot=svg', cached=True), 30//r))
+    return cases
+
+def git_rev():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def run(quick=False, only=None):
+    use_app_dir()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name,func,repeat in suite(tmpdir, quick):
+            if only and only not in name:
+                continue
+            try:
+                results[name] = measure(func, repeat)
+            except Exception as e:
+                # a broken case is reported, it doesn't stop the rest of the suite
+                results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+                print('{:32s} ERROR {}'.format(name, results[name]['error']), file=sys.stderr)
+                continue
+            print('{:32s} {:10.3f} ms median'.format(name, results[name]['median_ms']), file=sys.stderr)
+    # startup, each in a new interpreter
+    for name,stmt in bench_import.STARTUP.items():
+        if only and only not in name:
+            continue
+        try:
+            results[name] = bench_import.measure_startup(stmt, 2 if quick else 5)
+        except subprocess.CalledProcessError as e:
+            results[name] = {'error': str(e)}
+            print('{:32s} ERROR {}'.format(name, results[name]['error']), file=sys.stderr)
+            continue
+        print('{:32s} {:10.3f} ms median'.format(name, results[name]['median_ms']), file=sys.stderr)
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'git': git_rev(), 'python': platform.python_version(),
+                     'machine': platform.machine(), 'node': platform.node()},
+            'results': results}
+
+def compare(current, baseline, threshold=0.2):
+    '''
+    :return: list of (name, baseline ms, current ms, ratio) for cases slower by more than threshold
+    '''
+    slower = []
+    for name,res in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base or 'error' in base or 'error' in res:
+            continue
+        ratio = res['median_ms'] / base['median_ms'] if base['median_ms'] else 1.0
+        print('{:32s} {:10.3f} -> {:10.3f} ms  x{:.2f}'.format(name, base['median_ms'], res['median_ms'], ratio), file=sys.stderr)
+        if ratio > 1.0 + threshold:
+            slower.append((name, base['median_ms'], res['median_ms'], ratio))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the wx app')
+    parser.add_argument('--out', help='write results JSON to this file (default: stdout)')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown ratio reported as regression')
+    parser.add_argument('--quick', action='store_true', help='fewer repeats, skip the 1 month plot')
+    parser.add_argument('--only', help='run only cases whose name contains this string')
+    args = parser.parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    results = run(args.quick, args.only)
+    text = json.dumps(results, indent=1)
+    if out:
+        with open(out, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if baseline:
+        with open(baseline) as f:
+            slower = compare(results, json.load(f), args.threshold)
+        for name,base,cur,ratio in slower:
+            print('REGRESSION {}: {:.3f} -> {:.3f} ms (x{:.2f})'.format(name, base, cur, ratio), file=sys.stderr)
+        sys.exit(1 if slower else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Stress the sensor store: one thread appends readings to a log as the MQTT client does, two threads
+# call read_log as two /now requests do with threads = 2, and reader threads draw from snapshots.
+# Every snapshot must hold as many values of each field as times, and only grow between publishes.
+#   python -m bench.stress_sensors --seconds 5 --readers 4
+#   python -m bench.stress_sensors --unsafe      readers use the writer's sensor_devs, as before the store had snapshots
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bench import use_app_dir, fixtures
+
+def main():
+    parser = argparse.ArgumentParser(description='concurrent reads and writes of the sensor store')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2, help='threads calling read_log')
+    parser.add_argument('--unsafe', action='store_true', help="read sensor_in.sensor_devs instead of snapshots")
+    args = parser.parse_args()
+    use_app_dir()
+    import Config
+    import rollups
+    import sensor_in
+    import svgplot
+    sys.setswitchinterval(1e-5)    # switch threads far more often than usual, to find races sooner
+    with tempfile.TemporaryDirectory() as tmpdir:
+        Config.rollup_path = os.path.join(tmpdir, 'rollups.json')
+        rollups.store = rollups.Rollups()
+        sensor_in.reset()
+        log = os.path.join(tmpdir, 'mqtt_rcv.log')
+        lines = fixtures.sensor_lines(days=3)
+        open(log, 'w').close()
+        stop = threading.Event()
+        counts = {'appended': 0, 'read_log': 0, 'snapshots': 0, 'plots': 0}
+        errors = []
+
+        def appender():
+            with open(log, 'a') as f:
+                for line in lines:
+                    if stop.is_set():
+                        break
+                    f.write(line + '\n')
+                    f.flush()
+                    counts['appended'] += 1
+                    if counts['appended'] % 20 == 0:
+                        time.sleep(0.001)
+
+        def writer():
+            while not stop.is_set():
+                sensor_in.read_log(log)
+                counts['read_log'] += 1
+
+        def reader(draw):
+            sizes = {}
+            while not stop.is_set():
+                snap = sensor_in.sensor_devs if args.unsafe else sensor_in.store.snapshot()
+                for topic,dev in list(snap.items()):
+                    n = len(dev.vals['time'])
+                    for field,vals in dev.vals.items():
+                        if len(vals) != n:
+                            errors.append('{} {}: {} values, {} times'.format(topic, field, len(vals), n))
+                    if n < sizes.get(topic, 0):
+                        errors.append('{}: snapshot shrank from {} to {}'.format(topic, sizes[topic], n))
+                    sizes[topic] = n
+                time.sleep(0)
+                if not all(len(v) == len(dev.vals['time']) for dev in snap.values() for v in dev.vals.values()):
+                    errors.append('snapshot changed while it was read')
+                counts['snapshots'] += 1
+                if draw:
+                    svgplot.make_svg(snap)
+                    counts['plots'] += 1
+                sensor_in.latest.snapshot(stale_after=900)
+
+        threads = [threading.Thread(target=appender)]
+        threads += [threading.Thread(target=writer) for _ in range(args.writers)]
+        threads += [threading.Thread(target=reader, args=(i == 0,)) for i in range(args.readers)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        sensor_in.read_log(log)
+        snap = sensor_in.store.snapshot()
+        held = {topic: len(dev.vals['time']) for topic,dev in snap.items()}
+        t0 = time.perf_counter()
+        for _ in range(100000):
+            sensor_in.store.snapshot()
+        snapshot_us = (time.perf_counter() - t0) / 100000 * 1e6
+    results = dict(counts, seconds=round(elapsed, 2), errors=len(errors), first_errors=errors[:5],
+                   held=held, lines_per_topic=counts['appended'] // 2, snapshot_us=round(snapshot_us, 3))
+    print(json.dumps(results, indent=1))
+    if errors or sum(held.values()) != counts['appended']:
+        sys.exit(1)
+    return results
+
+if __name__ == '__main__':
+    main()
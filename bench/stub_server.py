@@ -0,0 +1,46 @@
+# Local HTTP server that answers every GET after a fixed delay.
+# Stands in for OpenWeather and the radar/icon servers when benchmarking fetch code.
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class DelayedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count += 1
+
+    def log_message(self, format, *args):
+        pass    # keep benchmark output clean
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, delay=0.2, body=None, port=0):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), DelayedHandler)
+        self.delay = delay
+        self.body = body if body is not None else json.dumps({'current': {}, 'hourly': [], 'daily': []}).encode()
+        self.count = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()